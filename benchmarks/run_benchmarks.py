@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""
+Scaling benchmarks of lammps_interface.
+
+The structures in test_struct are replicated n x n x n, and each stage of
+the program is timed for each force field. Scaling exponents are fitted
+to time ~ N_atoms^k for every stage, and the results are appended to a
+history file so that runs can be compared over time.
+
+    python benchmarks/run_benchmarks.py
+    python benchmarks/run_benchmarks.py --structures IRMOF-1 --sizes 1,2,3 -ff UFF
+
+The unreplicated IRMOF-1 output of each force field is also compared to
+the files in benchmarks/golden, so that changes made for performance
+do not silently change the parameters. The golden files can be
+regenerated with --update-golden.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import traceback
+
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from lammps_interface import api
+from lammps_interface.CIFIO import CIF
+from lammps_interface.InputHandler import __version__
+from lammps_interface.profiling import Profiler
+
+STRUCT_DIR = os.path.join(os.path.dirname(BENCH_DIR), "test_struct")
+GOLDEN_DIR = os.path.join(BENCH_DIR, "golden")
+GOLDEN_STRUCTURE = "IRMOF-1"
+
+# replications run by default, the flexible ZIF is already ~3000 atoms.
+DEFAULT_SIZES = {"IRMOF-1": (1, 2),
+                 "CoBDP_FlexZIF": (1,)}
+FORCE_FIELDS = ("UFF", "UFF4MOF", "Dreiding", "BTW_FF")
+
+# the profiled steps reported for each benchmark.
+STAGES = (("read", ("from_CIF",)),
+          ("bonding", ("compute_min_img_distances", "compute_bonding")),
+          ("typing", ("compute_init_typing", "compute_bond_typing")),
+          ("sbu_detection", ("detect_clusters",)),
+          ("topology", ("set_graph",)),
+          ("force_field", ("assign_force_fields",)),
+          ("supercell", ("compute_simulation_size",)),
+          ("data_file", ("construct_data_file",)),
+          ("input_file", ("construct_input_file",)),
+          ("total", None))
+
+
+def replicate_cif(cif_file, n, filename):
+    """Write an n x n x n replica of a P1 cif file. The bonds of the
+    original file are not carried over, so bonding is computed for the
+    replicated structures.
+
+    """
+    cif = CIF()
+    cif.read(cif_file)
+    data = cif._data
+    heads = cif._headings[cif.block_order.index('atoms')]
+    columns = [[v.strip() for v in data[h]] for h in heads]
+    frac = [heads.index(k) for k in ('_atom_site_fract_x', '_atom_site_fract_y', '_atom_site_fract_z')]
+
+    lines = ["data_%s_%ix%ix%i"%(cif.name, n, n, n),
+             "_symmetry_space_group_name_H-M    'P1'",
+             "_symmetry_Int_Tables_number       1",
+             "loop_",
+             "_symmetry_equiv_pos_as_xyz",
+             "  x,y,z"]
+    for key in ('_cell_length_a', '_cell_length_b', '_cell_length_c'):
+        lines.append("%-33s %.4f"%(key, n*float(re.sub(r"\(.*\)", "", data[key].strip()))))
+    for key in ('_cell_angle_alpha', '_cell_angle_beta', '_cell_angle_gamma'):
+        lines.append("%-33s %s"%(key, data[key].strip()))
+    lines.append("loop_")
+    lines += heads
+    rows = list(zip(*columns))
+    for i in range(n):
+        for j in range(n):
+            for k in range(n):
+                shift = (i, j, k)
+                for row in rows:
+                    row = list(row)
+                    for f, s in zip(frac, shift):
+                        row[f] = "%.6f"%((float(re.sub(r"\(.*\)", "", row[f])) + s)/n)
+                    lines.append(" ".join(row))
+    with open(filename, 'w') as f:
+        f.write("\n".join(lines) + "\n")
+
+
+def stage_times(profiler):
+    """Wall time of each benchmark stage, summed over all the calls."""
+    summed = {}
+    for record in profiler.records:
+        summed[record['name']] = summed.get(record['name'], 0.) + record.get('wall', 0.)
+    times = {}
+    for stage, names in STAGES:
+        if names is None:
+            times[stage] = sum(profiler.totals().values())
+        else:
+            times[stage] = sum([summed.get(i, 0.) for i in names])
+    return times
+
+
+def run_case(cif_file, force_field, workdir):
+    """Run one structure with one force field.
+
+    returns the benchmark record and the rendered files
+    """
+    profiler = Profiler()
+    record = {'force_field': force_field, 'status': 'ok', 'error': None}
+    files = {}
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        sim = api.build_simulation(cif_file, profiler=profiler, force_field=force_field)
+        files = sim.render_lammps_files()
+        record['natoms'] = sim.graph.number_of_nodes()
+        record['times'] = stage_times(profiler)
+        record['max_rss_kb'] = profiler.report()['max_rss_kb']
+    except (Exception, SystemExit) as e:
+        traceback.print_exc()
+        record['status'] = 'failed'
+        record['error'] = "%s: %s"%(e.__class__.__name__, e)
+    finally:
+        os.chdir(cwd)
+    return record, files
+
+
+def fit_exponents(records):
+    """Fit time ~ N^k for each structure, force field and stage with
+    more than one size.
+
+    """
+    groups = {}
+    for r in records:
+        if r['status'] == 'ok':
+            groups.setdefault((r['structure'], r['force_field']), []).append(r)
+    exponents = {}
+    for (structure, ff), rs in sorted(groups.items()):
+        if len(set(r['natoms'] for r in rs)) < 2:
+            continue
+        natoms = np.log([r['natoms'] for r in rs])
+        fits = {}
+        for stage, names in STAGES:
+            times = np.array([r['times'][stage] for r in rs])
+            if np.any(times <= 0.):
+                continue
+            fits[stage] = float(np.polyfit(natoms, np.log(times), 1)[0])
+        exponents["%s/%s"%(structure, ff)] = fits
+    return exponents
+
+
+def _normalize_input(content):
+    """Lines of an input file, ignoring the order of lines, of styles in
+    hybrid lines and random seeds.
+
+    """
+    lines = []
+    for line in content.splitlines():
+        tokens = line.split()
+        if len(tokens) > 2 and tokens[1] in ('hybrid', 'hybrid/overlay'):
+            line = " ".join(tokens[:2] + sorted(tokens[2:]))
+        line = re.sub(r"(langevin .*\$\{tdamp\}) \d+", r"\1 SEED", line)
+        line = re.sub(r"(velocity .* create [\d.]+) \d+", r"\1 SEED", line)
+        lines.append(line)
+    return sorted(lines)
+
+
+def _normalize_data(content):
+    lines = content.splitlines()
+    if lines and lines[0].startswith("Created on"):
+        lines = lines[1:]
+    return lines
+
+
+def compare_golden(force_field, files):
+    """Compare the data and input file to the golden files of this
+    force field. returns a list of the files that differ.
+
+    """
+    differ = []
+    for name, normalize in (("data.%s"%GOLDEN_STRUCTURE, _normalize_data),
+                            ("in.%s"%GOLDEN_STRUCTURE, _normalize_input)):
+        with open(os.path.join(GOLDEN_DIR, force_field, name), 'r') as f:
+            golden = f.read()
+        if normalize(golden) != normalize(files.get(name, "")):
+            differ.append(name)
+    return differ
+
+
+def main():
+    parser = ArgumentParser(description="Scaling benchmarks of lammps_interface")
+    parser.add_argument("--structures", default=",".join(sorted(DEFAULT_SIZES.keys())),
+                        help="Comma separated names of structures in test_struct.")
+    parser.add_argument("--sizes", default=None,
+                        help="Comma separated replications n (n x n x n) used for all "+
+                             "structures. Default is 1,2 for IRMOF-1 and 1 for CoBDP_FlexZIF.")
+    parser.add_argument("-ff", "--force-fields", dest="force_fields", default=",".join(FORCE_FIELDS),
+                        help="Comma separated force fields.")
+    parser.add_argument("--history", default=os.path.join(BENCH_DIR, "history.json"),
+                        help="File to which the results are appended.")
+    parser.add_argument("--label", default="",
+                        help="Label stored with the results in the history file.")
+    parser.add_argument("--update-golden", action="store_true", default=False,
+                        help="Overwrite the golden files with the output of this run.")
+    args = parser.parse_args()
+
+    structures = args.structures.split(",")
+    force_fields = args.force_fields.split(",")
+    tmpdir = tempfile.mkdtemp(prefix="lammps_interface_bench_")
+
+    records = []
+    mismatches = []
+    try:
+        for structure in structures:
+            sizes = DEFAULT_SIZES.get(structure, (1,))
+            if args.sizes is not None:
+                sizes = [int(i) for i in args.sizes.split(",")]
+            for n in sizes:
+                cif_file = os.path.join(STRUCT_DIR, "%s.cif"%structure)
+                if n > 1:
+                    replica = os.path.join(tmpdir, "%s_%ix%ix%i.cif"%(structure, n, n, n))
+                    replicate_cif(cif_file, n, replica)
+                    cif_file = replica
+                for ff in force_fields:
+                    workdir = tempfile.mkdtemp(dir=tmpdir)
+                    record, files = run_case(cif_file, ff, workdir)
+                    record.update({'structure': structure, 'replication': n})
+                    if structure == GOLDEN_STRUCTURE and n == 1 and record['status'] == 'ok':
+                        if args.update_golden:
+                            if not os.path.isdir(os.path.join(GOLDEN_DIR, ff)):
+                                os.makedirs(os.path.join(GOLDEN_DIR, ff))
+                            for name in ("data.%s"%structure, "in.%s"%structure):
+                                with open(os.path.join(GOLDEN_DIR, ff, name), 'w') as f:
+                                    f.write(files[name])
+                        elif os.path.isdir(os.path.join(GOLDEN_DIR, ff)):
+                            record['golden_mismatch'] = compare_golden(ff, files)
+                            if record['golden_mismatch']:
+                                mismatches.append((ff, record['golden_mismatch']))
+                    records.append(record)
+                    if record['status'] == 'ok':
+                        print("%-15s %-3i %-9s %8i atoms %10.2f s"%(structure, n, ff,
+                              record['natoms'], record['times']['total']))
+                    else:
+                        print("%-15s %-3i %-9s FAILED %s"%(structure, n, ff, record['error']))
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    exponents = fit_exponents(records)
+    for key, fits in sorted(exponents.items()):
+        print("%-25s %s"%(key, " ".join(["%s=%.2f"%(s, fits[s]) for s, _ in STAGES if s in fits])))
+
+    history = []
+    if os.path.isfile(args.history):
+        with open(args.history, 'r') as f:
+            history = json.load(f)
+    history.append({'date': datetime.today().strftime("%Y-%m-%d %H:%M:%S"),
+                    'version': __version__,
+                    'label': args.label,
+                    'python': sys.version.split()[0],
+                    'numpy': np.__version__,
+                    'records': records,
+                    'exponents': exponents})
+    with open(args.history, 'w') as f:
+        json.dump(history, f, indent=2)
+    print("Results appended to %s"%(args.history))
+
+    if mismatches:
+        for ff, names in mismatches:
+            print("ERROR: %s output differs from the golden files: %s"%(ff, ", ".join(names)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
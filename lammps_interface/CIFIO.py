@@ -18,8 +18,12 @@ class CIF(object):
             self.read(file)
 
     def read(self, filename):
-        filestream = open(filename, 'r')
-        filelines = filestream.readlines()
+        """filename can be a path or an open file-like object."""
+        if hasattr(filename, 'readlines'):
+            filelines = filename.readlines()
+        else:
+            with open(filename, 'r') as filestream:
+                filelines = filestream.readlines()
         blocks = []
         loopcount = 0
         loopentries = {}
@@ -80,8 +84,6 @@ class CIF(object):
                 for key, val in zip(loopentries[loopcount], split_line):
                     self.add_data(loopcount, **{key:self.general_label(val)})
 
-        filestream.close()
-
     def get_time(self):
         t = date.today()
         return t.strftime("%A %d %B %Y")
@@ -4,6 +4,10 @@ Force field methods.
 from .uff import UFF_DATA
 from .uff4mof import UFF4MOF_DATA
 from .dreiding import DREIDING_DATA
+from .parameter_tables import UFF_TABLE, UFF4MOF_TABLE, DREIDING_TABLE
+from .parameter_tables import UFF_TYPE_INDEX, UFF4MOF_TYPE_INDEX
+from .parameter_tables import lj_pair_parameters, uff_bond_parameters, uff_angle_parameters
+from .parameter_tables import dreiding_bond_parameters, cosine_squared_constants
 from .uff_nonbonded import UFF_DATA_nonbonded
 from .BTW import BTW_angles, BTW_dihedrals, BTW_opbends, BTW_atoms, BTW_bonds, BTW_charges
 from .Dubbeldam import Dub_atoms, Dub_bonds, Dub_angles, Dub_dihedrals, Dub_impropers
@@ -11,17 +15,19 @@ from .Dubbeldam import Dub_atoms, Dub_bonds, Dub_angles, Dub_dihedrals, Dub_impr
 from .MOFFF import MOFFF_angles, MOFFF_dihedrals, MOFFF_opbends, MOFFF_atoms, MOFFF_bonds
 from .water_models import SPC_E_atoms, TIP3P_atoms, TIP4P_atoms, TIP5P_atoms
 from .gas_models import EPM2_atoms, EPM2_angles
+from .table_cache import TABLE_CACHE
+from .errors import ForceFieldError, OptionsError
 from .lammps_potentials import BondPotential, AnglePotential, DihedralPotential, ImproperPotential, PairPotential
 from .atomic import METALS
 from .atomic import organic, non_metals, noble_gases, metalloids, lanthanides, actinides, transition_metals
 from .atomic import alkali, alkaline_earth, main_group, metals
 import math
 import numpy as np
+from scipy.special import erf
 from operator import mul
 import itertools
 import abc
 import re
-import sys
 from .Molecules import *
 
 
@@ -114,6 +120,49 @@ class ForceField(object):
             except KeyError:
                 pass
 
+    def angle_triples(self):
+        """Return the (a, b, c) node triples of all angles stored in the graph,
+        where b is the central atom.
+
+        """
+        triples = []
+        for b, data in self.graph.nodes_iter2(data=True):
+            for (a, c) in data.get('angles', {}).keys():
+                triples.append((a, b, c))
+        return triples
+
+    def dihedral_quads(self):
+        """Return the (a, b, c, d) node quadruplets of all dihedrals stored
+        in the graph, where b-c is the central bond.
+
+        """
+        quads = []
+        for b, c, data in self.graph.edges_iter2(data=True):
+            for (a, d) in data.get('dihedrals', {}).keys():
+                quads.append((a, b, c, d))
+        return quads
+
+    def measure_angles(self, triples):
+        """Measure the angles (in degrees) of a list of (a, b, c) triples
+        in one pass over the graph geometry. Force fields call this
+        before assigning angle terms which depend on the input geometry.
+
+        returns a dictionary (a, b, c) -> angle
+        """
+        if not triples:
+            return {}
+        return dict(zip(triples, self.graph.compute_angles_between(triples).tolist()))
+
+    def measure_dihedrals(self, quads):
+        """Measure the dihedral angles (in degrees) of a list of
+        (a, b, c, d) quadruplets in one pass over the graph geometry.
+
+        returns a dictionary (a, b, c, d) -> dihedral angle
+        """
+        if not quads:
+            return {}
+        return dict(zip(quads, self.graph.compute_dihedrals_between(quads).tolist()))
+
 class UserFF(ForceField):
 
     def __init__(self, graph):
@@ -513,17 +562,14 @@ class OverwriteFF(ForceField):
         elif(baseFF == "DREIDING"):
             self = Dreiding(struct)
         elif(baseFF == "CVFF"):
-            print("CVFF not implemented yet...")
-            sys.exit()
+            raise ForceFieldError("CVFF not implemented yet...")
             pass
         elif(baseFF == "CHARMM"):
-            print("CHARMM not implemented yet...")
-            sys.exit()
+            raise ForceFieldError("CHARMM not implemented yet...")
             pass
         else:
             # etc. TODO worth adding in these additional FF types
-            print("Invalid base FF requested\nExiting...")
-            sys.exit()
+            raise ForceFieldError("Invalid base FF requested\nExiting...")
 
         # Overwrite any parameters specified by user_input.txt
         parse_user_input("user_input.txt")
@@ -688,8 +734,7 @@ class BTW_FF(ForceField):
         mof_sbus = set(self.graph.inorganic_sbus.keys())
         BTW_sbus = set(["Cu Paddlewheel", "Zn4O", "Zr_UiO"])
         if not (mof_sbus <= BTW_sbus):
-            print("The system cannot be simulated with BTW-FF!")
-            sys.exit()
+            raise ForceFieldError("The system cannot be simulated with BTW-FF!")
         elif ( len(mof_sbus)> 1):
             print("No exact charge for the IRMOF is available from BTW-FF. Average charges in BTW-FF is used.")
             chrg_flag="TFF_" # Transferable FF charges (average values)
@@ -709,8 +754,7 @@ class BTW_FF(ForceField):
             else:
                 #print("No exact charge for the IRMOF is available from BTW-FF. Average charges in BTW-FF is used.")
                 #chrg_flag="TFF_"
-                print("Cannot parameterize this MOF with BTW-FF.")
-                sys.exit()
+                raise ForceFieldError("Cannot parameterize this MOF with BTW-FF.")
         else:
             sbu_type = next(iter(mof_sbus))
             chrg_flag=sbu_type+"_"
@@ -726,11 +770,9 @@ class BTW_FF(ForceField):
 
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
 
             elif atom['element'] == "Zn":
                 try:
@@ -741,11 +783,9 @@ class BTW_FF(ForceField):
                         atom['charge']=BTW_charges[chrg_key]
 
                     else:
-                        print("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
 
 
             elif atom['element'] == "Zr":
@@ -757,11 +797,9 @@ class BTW_FF(ForceField):
                         atom['charge']=BTW_charges[chrg_key]
 
                     else:
-                        print("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
 
 
             if atom['force_field_type'] is None:
@@ -800,8 +838,7 @@ class BTW_FF(ForceField):
                         chrg_key = chrg_flag+atom['force_field_type']
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("Oxygen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Oxygen number %i type cannot be detected!"%node)
                 elif (atom['element'] == "C") and special:
                     # Zn4O case
                     if atom['special_flag'] == "C_Zn4O":
@@ -819,8 +856,7 @@ class BTW_FF(ForceField):
                         chrg_key = chrg_flag+atom['force_field_type']
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("Carbon number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Carbon number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "H") and special:
                     # only UiO case
@@ -829,13 +865,11 @@ class BTW_FF(ForceField):
                         chrg_key = chrg_flag+atom['force_field_type']
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("Hydrogen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Hydrogen number %i type cannot be detected!"%node)
 
                 # currently no oxygens assigned types outside of metal SBUs
                 elif (atom['element'] == "O") and not special:
-                    print("Oxygen number %i type cannot be detected!"%node)
-                    sys.exit()
+                    raise ForceFieldError("Oxygen number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "C") and not special:
                     # all organic SBUs have the same types..
@@ -853,8 +887,7 @@ class BTW_FF(ForceField):
 
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("Carbon number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Carbon number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "H") and not special:
                     if set(neighbour_elements)<=set(["C"]):
@@ -863,8 +896,7 @@ class BTW_FF(ForceField):
 
                         atom['charge']=BTW_charges[chrg_key]
                     else:
-                        print("Hydrogen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Hydrogen number %i type cannot be detected!"%node)
 
         # Assigning force field type of bonds
         for a, b, bond in self.graph.edges_iter2(data=True):
@@ -878,8 +910,7 @@ class BTW_FF(ForceField):
             elif bond_fflabel2 in BTW_bonds:
                 bond['force_field_type']=bond_fflabel2
             else:
-                print ("BTW-FF cannot be used for the system!\nNo parameter found for bond %s"%(bond_fflabel1))
-                sys.exit()
+                raise ForceFieldError("BTW-FF cannot be used for the system!\nNo parameter found for bond %s"%(bond_fflabel1))
 
         #Assigning force field type of angles
         missing_labels=[]
@@ -1166,6 +1197,8 @@ class MOF_FF(ForceField):
         self.pair_in_data = False
         self.keep_metal_geometry = False
         self.graph = None
+        # tabulated damped coulomb potentials, set to None to disable.
+        self.table_cache = TABLE_CACHE
         # override existing arguments with kwargs
         for key, value in kwargs.items():
             setattr(self, key, value)
@@ -1186,8 +1219,7 @@ class MOF_FF(ForceField):
         mof_sbus = set(self.graph.inorganic_sbus.keys())
         MOF_FF_sbus = set(["Cu Paddlewheel", "Zn4O", "Zr_UiO"])
         if not (mof_sbus <= MOF_FF_sbus):
-            print("The system cannot be simulated with MOF-FF!")
-            sys.exit()
+            raise ForceFieldError("The system cannot be simulated with MOF-FF!")
 
         #Assigning force field type of atoms
         for node, atom in self.graph.nodes_iter2(data=True):
@@ -1198,11 +1230,9 @@ class MOF_FF(ForceField):
                         atom['force_field_type'] = "165"
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
                     else:
-                        print("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Cu %i is not assigned to a Cu Paddlewheel! exiting"%(node))
 
             elif atom['element'] == "Zn":
                 try:
@@ -1211,11 +1241,9 @@ class MOF_FF(ForceField):
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
 
                     else:
-                        print("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Zn %i is not assigned to a Zn4O! exiting"%(node))
 
 
             elif atom['element'] == "Zr":
@@ -1225,11 +1253,9 @@ class MOF_FF(ForceField):
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
 
                     else:
-                        print("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
-                        sys.exit()
+                        raise ForceFieldError("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
                 except KeyError:
-                    print("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
-                    sys.exit()
+                    raise ForceFieldError("ERROR: Zr %i is not assigned to a Zr_UiO! exiting"%(node))
 
 
             if atom['force_field_type'] is None:
@@ -1262,8 +1288,7 @@ class MOF_FF(ForceField):
                         atom['force_field_type'] = "167"
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
                     else:
-                        print("Oxygen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Oxygen number %i type cannot be detected!"%node)
                 elif (atom['element'] == "C") and special:
                     # Zn4O case
                     if atom['special_flag'] == "C_Zn4O":
@@ -1278,8 +1303,7 @@ class MOF_FF(ForceField):
                         atom['force_field_type'] = "168"
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
                     else:
-                        print("Carbon number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Carbon number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "H") and special:
                     # only UiO case
@@ -1287,13 +1311,11 @@ class MOF_FF(ForceField):
                         atom['force_field_type'] = "105"
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
                     else:
-                        print("Hydrogen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Hydrogen number %i type cannot be detected!"%node)
 
                 # currently no oxygens assigned types outside of metal SBUs
                 elif (atom['element'] == "O") and not special:
-                    print("Oxygen number %i type cannot be detected!"%node)
-                    sys.exit()
+                    raise ForceFieldError("Oxygen number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "C") and not special:
                     # all organic SBUs have the same types..
@@ -1310,16 +1332,14 @@ class MOF_FF(ForceField):
                         elif mof_sbus == set(['Cu Paddlewheel']):
                             atom['charge']=  0.15   #special charge for C_ph - C_carb
                     else:
-                        print("Carbon number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Carbon number %i type cannot be detected!"%node)
 
                 elif (atom['element'] == "H") and not special:
                     if set(neighbour_elements)<=set(["C"]):
                         atom['force_field_type'] = "5"
                         atom['charge']=MOFFF_atoms[atom['force_field_type']][6]
                     else:
-                        print("Hydrogen number %i type cannot be detected!"%node)
-                        sys.exit()
+                        raise ForceFieldError("Hydrogen number %i type cannot be detected!"%node)
 
 #                atom['charge']=0
         # THE REST OF THIS SHOULD BE IN SEPARATE FUNCTIONS AS PER OTHER FF's DESCRIBED HERE
@@ -1624,16 +1644,19 @@ class MOF_FF(ForceField):
         F_ij = - (K*qi*qj) * (2/(pi^(.5) * sig_ij)) * [ e^(-r_ij^2/sig_ij^2) / r_ij - erf(r_ij/sig_ij)/r_ij^2 ]
         ---
 
-        N is set to 1000 by default
+        N is set to 5000 by default
+
+        The tables are computed for all points at once, and stored in
+        self.table_cache keyed by (ff1, ff2, qi, qj, sig_ij, cutoff, N)
+        so identical tables are reused between structures. Increase
+        table_cache.TABLE_VERSION when the tables computed here change.
 
         """
-        str = ""
         # kcal/mol energy units assumed...
         K = 332.063711
 
         n = 5000
         rlow=0.01
-        R = np.linspace(rlow, self.cutoff+2., n)
         ff1 = node1['force_field_type']
         ff2 = node2['force_field_type']
 
@@ -1642,22 +1665,33 @@ class MOF_FF(ForceField):
         sigi = MOFFF_atoms[ff1][7]
         sigj = MOFFF_atoms[ff2][7]
         sigij = math.sqrt(sigi**2+sigj**2)
-        E_coeff = K*qi*qj
-        str += "# damped coulomb potential for %s - %s\n"%(ff1, ff2)
-        str += "GAUSS_%s_%s\n"%(ff1, ff2)
-        str += "N %i R %.2f %.f\n\n"%(n, rlow, self.cutoff+2.)
         data['table_potential'].style = 'linear'
         data['table_potential'].N = n
         data['table_potential'].keyword = 'ewald'
         data['table_potential'].cutoff = self.cutoff
         data['table_potential'].entry = "GAUSS_%s_%s"%(ff1, ff2)
-        data['table_potential'].N = n
 
-        for i, r in enumerate(R):
-            rsq = r**2
-            e = E_coeff*math.erf(r/sigij)/r
-            f = -E_coeff  * (math.exp(-(rsq)/(sigij**2))/ r* 2/(math.sqrt(math.pi) * sigij) - math.erf(r/sigij)/(rsq))
-            str += "%i %.3f %f %f\n"%(i+1, r, e, f)
+        key = ('GAUSS', ff1, ff2, qi, qj, sigij, self.cutoff, n, rlow)
+        if self.table_cache is not None:
+            str = self.table_cache.get(key)
+            if str is not None:
+                return(str)
+
+        E_coeff = K*qi*qj
+        str = "# damped coulomb potential for %s - %s\n"%(ff1, ff2)
+        str += "GAUSS_%s_%s\n"%(ff1, ff2)
+        str += "N %i R %.2f %.f\n\n"%(n, rlow, self.cutoff+2.)
+
+        R = np.linspace(rlow, self.cutoff+2., n)
+        rsq = R**2
+        erf_r = erf(R/sigij)
+        e = E_coeff*erf_r/R
+        f = -E_coeff * (np.exp(-rsq/(sigij**2))/R * 2/(math.sqrt(math.pi) * sigij) - erf_r/rsq)
+        rows = np.column_stack((np.arange(1, n+1), R, e, f))
+        str += ("%i %.3f %f %f\n"*n)%tuple(rows.ravel().tolist())
+
+        if self.table_cache is not None:
+            self.table_cache.put(key, str)
         return(str)
 
     def special_commands(self):
@@ -1719,8 +1753,7 @@ class FMOFCu(ForceField):
                                 atom['charge']=FMOFCu_atoms[atom['force_field_type']][6]
 
                         else:
-                            print("Oxygen number : %i could not be recognized!"%atom.index)
-                            sys.exit()
+                            raise ForceFieldError("Oxygen number : %i could not be recognized!"%atom.index)
 
                     elif (atom['element'] == "H"):
                         if ("O" in neighbour_elements):
@@ -2119,34 +2152,75 @@ class UFF(ForceField):
             self.detect_ff_terms()
             self.compute_force_field_terms()
 
+    def compute_atomic_pair_terms(self):
+        """Evaluate the L-J parameters of all atoms at once from UFF_TABLE,
+        pair_terms then reads them from self.pair_parameters.
+
+        """
+        nodes = list(self.graph.nodes())
+        labels = [self.graph.node[n]['force_field_type'] for n in nodes]
+        eps, sig = lj_pair_parameters(UFF_TABLE, labels, 'D1', 'x1')
+        self.pair_parameters = dict(zip(nodes, zip(eps.tolist(), sig.tolist())))
+        ForceField.compute_atomic_pair_terms(self)
+
+    def compute_bond_terms(self):
+        """Evaluate the harmonic bond parameters of all edges at once from
+        UFF_TABLE, bond_term then reads them from self.bond_parameters.
+
+        """
+        edges, labels1, labels2, orders = [], [], [], []
+        for n1, n2, data in self.graph.edges_iter2(data=True):
+            edges.append((n1, n2))
+            labels1.append(self.graph.node[n1]['force_field_type'])
+            labels2.append(self.graph.node[n2]['force_field_type'])
+            orders.append(data['order'])
+        r0, K = uff_bond_parameters(UFF_TABLE, labels1, labels2, orders)
+        self.bond_parameters = dict(zip(edges, zip(r0.tolist(), K.tolist())))
+        ForceField.compute_bond_terms(self)
+
+    def compute_angle_terms(self):
+        """Evaluate theta0, the force constants and the cosine expansion
+        coefficients of all angles at once from UFF_TABLE, angle_term then
+        reads them from self.angle_parameters.
+
+        """
+        triples = self.angle_triples()
+        measured = {}
+        if self.keep_metal_geometry:
+            measured = self.measure_angles([(a, b, c) for (a, b, c) in triples
+                                            if self.graph.node[b]['atomic_number'] in METALS])
+        labels_a, labels_c, theta0, r_ab, r_bc = [], [], [], [], []
+        for a, b, c in triples:
+            b_data = self.graph.node[b]
+            labels_a.append(self.graph.node[a]['force_field_type'])
+            labels_c.append(self.graph.node[c]['force_field_type'])
+            try:
+                theta0.append(measured[(a, b, c)])
+            except KeyError:
+                theta0.append(UFF_TABLE[b_data['force_field_type']]['theta0'])
+            r_ab.append(self.graph[a][b]['potential'].R0)
+            r_bc.append(self.graph[b][c]['potential'].R0)
+        ka, c0, c1, c2 = uff_angle_parameters(UFF_TABLE, labels_a, labels_c, theta0, r_ab, r_bc)
+        self.angle_parameters = dict(zip(triples, zip(np.asarray(theta0, dtype=np.float64).tolist(),
+                                                      ka.tolist(), c0.tolist(), c1.tolist(), c2.tolist())))
+        ForceField.compute_angle_terms(self)
+
     def pair_terms(self, node, data, cutoff, charges=True):
         """Add L-J term to atom"""
         if(charges):
             data['pair_potential'] = PairPotential.LjCutCoulLong()
         else:
             data['pair_potential'] = PairPotential.LjCut()
-        data['pair_potential'].eps = UFF_DATA[data['force_field_type']][3]
-        data['pair_potential'].sig = UFF_DATA[data['force_field_type']][2]*(2**(-1./6.))
+        eps, sig = self.pair_parameters[node]
+        data['pair_potential'].eps = eps
+        data['pair_potential'].sig = sig
         data['pair_potential'].cutoff = cutoff
 
     def bond_term(self, edge):
-        """Harmonic assumed"""
+        """Harmonic assumed, parameters from UFF_TABLE"""
         n1, n2, data = edge
         n1_data, n2_data = self.graph.node[n1], self.graph.node[n2]
-        fflabel1, fflabel2 = n1_data['force_field_type'], n2_data['force_field_type']
-        r_1 = UFF_DATA[fflabel1][0]
-        r_2 = UFF_DATA[fflabel2][0]
-        chi_1 = UFF_DATA[fflabel1][8]
-        chi_2 = UFF_DATA[fflabel2][8]
-
-        rbo = -0.1332*(r_1 + r_2)*math.log(data['order'])
-        ren = r_1*r_2*(((math.sqrt(chi_1) - math.sqrt(chi_2))**2))/(chi_1*r_1 + chi_2*r_2)
-        r0 = (r_1 + r_2 + rbo - ren)
-        # The values for K in the UFF paper were set such that in the final
-        # harmonic function, they would be divided by '2' to satisfy the
-        # form K/2(R-Req)**2
-        # in Lammps, the value for K is already assumed to be divided by '2'
-        K = 664.12*(UFF_DATA[fflabel1][5]*UFF_DATA[fflabel2][5])/(r0**3) / 2.
+        r0, K = self.bond_parameters[(n1, n2)]
         if (self.keep_metal_geometry) and (n1_data['atomic_number'] in METALS
             or n2_data['atomic_number'] in METALS):
             r0 = data['length']
@@ -2188,20 +2262,15 @@ class UFF(ForceField):
         sf = ['linear', 'trigonal-planar', 'square-planar', 'octahedral']
         a, b, c, data = angle
         angle_type = self.uff_angle_type(b)
-        a_data = self.graph.node[a]
         b_data = self.graph.node[b]
-        c_data = self.graph.node[c]
-        ab_bond = self.graph[a][b]
-        bc_bond = self.graph[b][c]
-
-        auff, buff, cuff = a_data['force_field_type'], b_data['force_field_type'], c_data['force_field_type']
 
-        theta0 = UFF_DATA[buff][1]
+        # theta0 is the measured angle if the central atom is a metal and
+        # keep_metal_geometry is requested (see compute_angle_terms)
+        theta0, ka, c0, c1, c2 = self.angle_parameters[(a, b, c)]
         # just check if the central node is a metal, then apply a rigid angle term.
         # NB: Functional form may change dynamics, but at this point we will not
         # concern ourselves if the force constants are big.
         if (self.keep_metal_geometry) and (b_data['atomic_number'] in METALS):
-            theta0 = self.graph.compute_angle_between(a, b, c)
             # should put this angle in the general - non-linear case
             # unless the angle is 0 or 180 deg - then linear case.
             # here the K value will be scaled by the number of neighbors
@@ -2211,23 +2280,6 @@ class UFF(ForceField):
             if np.allclose(theta0, 180.0, atol=0.1):
                 angle_type = 'linear'
 
-        cosT0 = np.cos(theta0*DEG2RAD)
-        sinT0 = np.sin(theta0*DEG2RAD)
-        c2 = 1.0 / (4.0*sinT0*sinT0)
-        c1 = -4.0 * c2 * cosT0
-        c0 = c2 * (2.0*cosT0*cosT0 + 1.0)
-
-        za = UFF_DATA[auff][5]
-        zc = UFF_DATA[cuff][5]
-
-        r_ab = ab_bond['potential'].R0
-        r_bc = bc_bond['potential'].R0
-        r_ac = math.sqrt(r_ab*r_ab + r_bc*r_bc - 2.*r_ab*r_bc*cosT0)
-
-        beta = 664.12/r_ab/r_bc
-        ka = beta*(za*zc /(r_ac**5.))*r_ab*r_bc
-        ka *= (3.*r_ab*r_bc*(1. - cosT0*cosT0) - r_ac*r_ac*cosT0)
-
         if angle_type in sf or (angle_type == 'tetrahedral' and int(theta0) == 90):
             if angle_type == 'linear':
                 kappa = ka
@@ -2298,8 +2350,7 @@ class UFF(ForceField):
         elif coord_type == "8":
             return 'cubic-antiprism'
         else:
-            print("ERROR: Cannot find coordination type for %s"%name)
-            sys.exit()
+            raise ForceFieldError("ERROR: Cannot find coordination type for %s"%name)
 
     def dihedral_term(self, dihedral):
         """Use a small cosine Fourier expansion
@@ -2484,8 +2535,15 @@ class UFF(ForceField):
         organics = ["C", "N", "O", "S"]
         halides = ["F", "Cl", "Br", "I"]
         sqpl = ["He", "Ne", "Ar", "Ni", "Kr", "Pd", "Xe", "Pt", "Au", "Rn"]
-
-        for node, data in self.graph.nodes_iter2(data=True):
+        # (element, valency) -> atoms to be typed from UFF_TYPE_INDEX
+        signatures = {}
+
+        # the types only depend on the neighbours, they are determined for
+        # one atom of each environment and copied to the others.
+        for members in self.graph.environment_classes(attributes=('element', 'hybridization',
+                                                                  'force_field_type')):
+            node = members[0]
+            data = self.graph.node[node]
             if data['force_field_type'] is None:
                 if data['element'] in organics:
                     if data['hybridization'] == "sp3":
@@ -2523,36 +2581,34 @@ class UFF(ForceField):
                 elif data['element'] == "Li":
                     data['force_field_type'] = data['element']
                 else:
-                    ffs = list(UFF_DATA.keys())
                     valency = self.graph.degree(node)
                     # temp fix for some real geometrical analysis
                     if (valency == 4) and (data['element'] not in sqpl):
                         valency = 3
-                    for j in ffs:
-                        if data['element'] == j[:2].strip("_"):
-                            try:
-                                if valency == int(j[2]):
-                                    data['force_field_type'] = j
-                            except IndexError:
-                                # no valency for this atom
-                                data['force_field_type'] = j
+                    signatures.setdefault((data['element'], valency), []).extend(members)
+                for n in members[1:]:
+                    self.graph.node[n]['force_field_type'] = data['force_field_type']
+
+        # all atoms sharing an element/valency signature get the same type,
+        # see TypeResolutionIndex for the priority rules.
+        for sig, fftype in UFF_TYPE_INDEX.resolve(signatures.keys()).items():
+            if fftype is None:
+                continue
+            for node in signatures[sig]:
+                self.graph.node[node]['force_field_type'] = fftype
 
+        for node, data in self.graph.nodes_iter2(data=True):
             if data['force_field_type'] is None:
-                assigned = False
-                # find the first entry that corresponds to this element and print a warning
-                for j in list(UFF_DATA.keys()):
-                    if data['element'] == j[:2].strip("_"):
-                        data['force_field_type'] = j
-                        neigh = self.graph.degree(node)
-                        print("WARNING: Atom %i element "%data['index'] +
-                                "%s has %i neighbors, "%(data['element'], neigh)+
-                                "but was assigned %s as a force field type!"%(j))
-                        assigned = True
-
-                if not assigned:
-                    print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                            " with element: '%s'"%(data['element']))
-                    sys.exit()
+                # find the last entry that corresponds to this element and print a warning
+                j = UFF_TYPE_INDEX.fallback(data['element'])
+                if j is None:
+                    raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                            " with element: '%s'"%(data['element']))
+                data['force_field_type'] = j
+                neigh = self.graph.degree(node)
+                print("WARNING: Atom %i element "%data['index'] +
+                        "%s has %i neighbors, "%(data['element'], neigh)+
+                        "but was assigned %s as a force field type!"%(j))
 
 class Dreiding(ForceField):
 
@@ -2570,6 +2626,55 @@ class Dreiding(ForceField):
             self.detect_ff_terms()
             self.compute_force_field_terms()
 
+    def compute_atomic_pair_terms(self):
+        """Evaluate the L-J parameters of all atoms at once from DREIDING_TABLE,
+        pair_terms then reads them from self.pair_parameters.
+
+        """
+        nodes = list(self.graph.nodes())
+        labels = [self.graph.node[n]['force_field_type'] for n in nodes]
+        eps, sig = lj_pair_parameters(DREIDING_TABLE, labels, 'D0', 'R0')
+        self.pair_parameters = dict(zip(nodes, zip(eps.tolist(), sig.tolist())))
+        ForceField.compute_atomic_pair_terms(self)
+
+    def compute_bond_terms(self):
+        """Evaluate the bond parameters of all edges at once from
+        DREIDING_TABLE, bond_term then reads them from self.bond_parameters.
+
+        """
+        edges, labels1, labels2, orders = [], [], [], []
+        for n1, n2, data in self.graph.edges_iter2(data=True):
+            edges.append((n1, n2))
+            labels1.append(self.graph.node[n1]['force_field_type'])
+            labels2.append(self.graph.node[n2]['force_field_type'])
+            orders.append(data['order'])
+        K, D, Re = dreiding_bond_parameters(DREIDING_TABLE, labels1, labels2, orders)
+        self.bond_parameters = dict(zip(edges, zip(K.tolist(), D.tolist(), Re.tolist())))
+        ForceField.compute_bond_terms(self)
+
+    def compute_angle_terms(self):
+        """Evaluate theta0 and the harmonic cosine force constant of all
+        angles at once from DREIDING_TABLE, angle_term then reads them
+        from self.angle_parameters.
+
+        """
+        triples = self.angle_triples()
+        measured = {}
+        if self.keep_metal_geometry:
+            measured = self.measure_angles([(a, b, c) for (a, b, c) in triples
+                                            if self.graph.node[b]['atomic_number'] in METALS])
+        theta0 = []
+        for a, b, c in triples:
+            try:
+                theta0.append(measured[(a, b, c)])
+            except KeyError:
+                theta0.append(DREIDING_TABLE[self.graph.node[b]['force_field_type']]['theta'])
+        theta0 = np.asarray(theta0, dtype=np.float64)
+        with np.errstate(divide='ignore'):
+            K = cosine_squared_constants(theta0)
+        self.angle_parameters = dict(zip(triples, zip(theta0.tolist(), K.tolist())))
+        ForceField.compute_angle_terms(self)
+
     def bond_term(self, edge):
         """The DREIDING Force Field contains two possible bond terms, harmonic and Morse.
         The authors recommend using harmonic as a default, and Morse potentials for more
@@ -2588,13 +2693,8 @@ class Dreiding(ForceField):
         n1, n2, data = edge
 
         n1_data, n2_data = self.graph.node[n1], self.graph.node[n2]
-        fflabel1, fflabel2 = n1_data['force_field_type'], n2_data['force_field_type']
-        R1 = DREIDING_DATA[fflabel1][0]
-        R2 = DREIDING_DATA[fflabel2][0]
         order = data['order']
-        K = order*700.
-        D = order*70.
-        Re = R1 + R2 - 0.01
+        K, D, Re = self.bond_parameters[(n1, n2)]
 
         if (self.keep_metal_geometry) and (n1_data['atomic_number'] in METALS
             or n2_data['atomic_number'] in METALS):
@@ -2625,9 +2725,8 @@ class Dreiding(ForceField):
             data['potential'].R0 = Re
 
         else:
-            print("ERROR: Cannot recognize bond potential for Dreiding: %s"%self.bondtype)
-            print("Please chose between 'morse' or 'harmonic'")
-            sys.exit()
+            raise OptionsError("ERROR: Cannot recognize bond potential for Dreiding: %s\n"%self.bondtype+
+                               "Please chose between 'morse' or 'harmonic'")
         return 1
 
     def angle_term(self, angle):
@@ -2648,15 +2747,14 @@ class Dreiding(ForceField):
         """
         a, b, c, data = angle
         K = 100.0
-        a_data, b_data, c_data = self.graph.node[a], self.graph.node[b], self.graph.node[c]
-        btype = b_data['force_field_type']
-        theta0 = DREIDING_DATA[btype][1]
+        b_data = self.graph.node[b]
+        # theta0 is the measured angle if the central atom is a metal and
+        # keep_metal_geometry is requested (see compute_angle_terms)
+        theta0, Kcos = self.angle_parameters[(a, b, c)]
 
         if (self.keep_metal_geometry) and (b_data['atomic_number'] in METALS):
-            theta0 = self.graph.compute_angle_between(a, b, c)
             data['potential'] = AnglePotential.CosineSquared()
-            K = 0.5*K/(np.sin(theta0*DEG2RAD))**2
-            data['potential'].K = K
+            data['potential'].K = Kcos
             data['potential'].theta0 = theta0
             return 1
 
@@ -2683,8 +2781,7 @@ class Dreiding(ForceField):
         else:
             #data['potential'] = AnglePotential.Harmonic()
             data['potential'] = AnglePotential.CosineSquared()
-            K = 0.5*K/(np.sin(theta0*DEG2RAD))**2
-            data['potential'].K = K
+            data['potential'].K = Kcos
             data['potential'].theta0 = theta0
         return 1
 
@@ -2889,9 +2986,7 @@ class Dreiding(ForceField):
         This will eventually be user-defined
 
         """
-        eps = DREIDING_DATA[data['force_field_type']][3]
-        R = DREIDING_DATA[data['force_field_type']][2]
-        sig = R*(2**(-1./6.))
+        eps, sig = self.pair_parameters[node]
 
         if nbpot == "LJ":
             if(charges):
@@ -2905,6 +3000,7 @@ class Dreiding(ForceField):
             #data['pair_potential'].sig14 = sig
 
         else:
+            R = DREIDING_DATA[data['force_field_type']][2]
             S = DREIDING_DATA[data['force_field_type']][5]
 
             A = eps*(6./(S - 6.))*np.exp(S)
@@ -3086,7 +3182,12 @@ class Dreiding(ForceField):
         organics = ["C", "N", "O", "S"]
         halides = ["F", "Cl", "Br", "I"]
         electro_neg_atoms = ["N", "O", "F"]
-        for node, data in self.graph.nodes_iter2(data=True):
+        # the types only depend on the neighbours, they are determined for
+        # one atom of each environment and copied to the others.
+        for members in self.graph.environment_classes(attributes=('element', 'hybridization',
+                                                                  'force_field_type')):
+            node = members[0]
+            data = self.graph.node[node]
             if data['force_field_type'] is None or self.h_bonding:
                 if data['element'] in organics:
                     if data['hybridization'] == "sp3":
@@ -3103,10 +3204,11 @@ class Dreiding(ForceField):
                 elif data['element'] == "H":
                     data['force_field_type'] = "H_"
                     if self.h_bonding:
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] in electro_neg_atoms:
-                                self.graph.node[n]['h_bond_donor'] = True
-                                data['force_field_type'] = "H__HB"
+                        for h in members:
+                            for n in self.graph.neighbors(h):
+                                if self.graph.node[n]['element'] in electro_neg_atoms:
+                                    self.graph.node[n]['h_bond_donor'] = True
+                                    data['force_field_type'] = "H__HB"
 
                 elif data['element'] in halides:
                     data['force_field_type'] = data['element']
@@ -3120,13 +3222,13 @@ class Dreiding(ForceField):
                         if data['element'] == j[:2].strip("_"):
                             data['force_field_type'] = j
             elif data['force_field_type'] not in DREIDING_DATA.keys():
-                print('Error: %s is not a force field type in DREIDING.'%(data['force_field_type']))
-                sys.exit()
+                raise ForceFieldError('Error: %s is not a force field type in DREIDING.'%(data['force_field_type']))
 
             if data['force_field_type'] is None:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
+            for n in members[1:]:
+                self.graph.node[n]['force_field_type'] = data['force_field_type']
 
 class UFF4MOF(ForceField):
     """Parameterize the periodic material with the UFF4MOF parameters.
@@ -3143,35 +3245,76 @@ class UFF4MOF(ForceField):
             self.detect_ff_terms()
             self.compute_force_field_terms()
 
+    def compute_atomic_pair_terms(self):
+        """Evaluate the L-J parameters of all atoms at once from UFF4MOF_TABLE,
+        pair_terms then reads them from self.pair_parameters.
+
+        """
+        nodes = list(self.graph.nodes())
+        labels = [self.graph.node[n]['force_field_type'] for n in nodes]
+        eps, sig = lj_pair_parameters(UFF4MOF_TABLE, labels, 'D1', 'x1')
+        self.pair_parameters = dict(zip(nodes, zip(eps.tolist(), sig.tolist())))
+        ForceField.compute_atomic_pair_terms(self)
+
+    def compute_bond_terms(self):
+        """Evaluate the harmonic bond parameters of all edges at once from
+        UFF4MOF_TABLE, bond_term then reads them from self.bond_parameters.
+
+        """
+        edges, labels1, labels2, orders = [], [], [], []
+        for n1, n2, data in self.graph.edges_iter2(data=True):
+            edges.append((n1, n2))
+            labels1.append(self.graph.node[n1]['force_field_type'])
+            labels2.append(self.graph.node[n2]['force_field_type'])
+            orders.append(data['order'])
+        r0, K = uff_bond_parameters(UFF4MOF_TABLE, labels1, labels2, orders)
+        self.bond_parameters = dict(zip(edges, zip(r0.tolist(), K.tolist())))
+        ForceField.compute_bond_terms(self)
+
+    def compute_angle_terms(self):
+        """Evaluate theta0, the force constants and the cosine expansion
+        coefficients of all angles at once from UFF4MOF_TABLE, angle_term
+        then reads them from self.angle_parameters.
+
+        """
+        triples = self.angle_triples()
+        measured = {}
+        if self.keep_metal_geometry:
+            measured = self.measure_angles([(a, b, c) for (a, b, c) in triples
+                                            if self.graph.node[b]['atomic_number'] in METALS])
+        labels_a, labels_c, theta0, r_ab, r_bc = [], [], [], [], []
+        for a, b, c in triples:
+            b_data = self.graph.node[b]
+            labels_a.append(self.graph.node[a]['force_field_type'])
+            labels_c.append(self.graph.node[c]['force_field_type'])
+            try:
+                theta0.append(measured[(a, b, c)])
+            except KeyError:
+                theta0.append(UFF4MOF_TABLE[b_data['force_field_type']]['theta0'])
+            r_ab.append(self.graph[a][b]['potential'].R0)
+            r_bc.append(self.graph[b][c]['potential'].R0)
+        ka, c0, c1, c2 = uff_angle_parameters(UFF4MOF_TABLE, labels_a, labels_c, theta0, r_ab, r_bc)
+        self.angle_parameters = dict(zip(triples, zip(np.asarray(theta0, dtype=np.float64).tolist(),
+                                                      ka.tolist(), c0.tolist(), c1.tolist(), c2.tolist())))
+        ForceField.compute_angle_terms(self)
+
     def pair_terms(self, node, data, cutoff, charges=True):
         """Add L-J term to atom"""
         if(charges):
             data['pair_potential'] = PairPotential.LjCutCoulLong()
         else:
             data['pair_potential'] = PairPotential.LjCut()
-        data['pair_potential'].eps = UFF4MOF_DATA[data['force_field_type']][3]
-        data['pair_potential'].sig = UFF4MOF_DATA[data['force_field_type']][2]*(2**(-1./6.))
+        eps, sig = self.pair_parameters[node]
+        data['pair_potential'].eps = eps
+        data['pair_potential'].sig = sig
         data['pair_potential'].cutoff = cutoff
         return 1
 
     def bond_term(self, edge):
-        """Harmonic assumed"""
+        """Harmonic assumed, parameters from UFF4MOF_TABLE"""
         n1, n2, data = edge
         n1_data, n2_data = self.graph.node[n1], self.graph.node[n2]
-        fflabel1, fflabel2 = n1_data['force_field_type'], n2_data['force_field_type']
-        r_1 = UFF4MOF_DATA[fflabel1][0]
-        r_2 = UFF4MOF_DATA[fflabel2][0]
-        chi_1 = UFF4MOF_DATA[fflabel1][8]
-        chi_2 = UFF4MOF_DATA[fflabel2][8]
-
-        rbo = -0.1332*(r_1 + r_2)*math.log(data['order'])
-        ren = r_1*r_2*(((math.sqrt(chi_1) - math.sqrt(chi_2))**2))/(chi_1*r_1 + chi_2*r_2)
-        r0 = (r_1 + r_2 + rbo - ren)
-        # The values for K in the UFF paper were set such that in the final
-        # harmonic function, they would be divided by '2' to satisfy the
-        # form K/2(R-Req)**2
-        # in Lammps, the value for K is already assumed to be divided by '2'
-        K = 664.12*(UFF4MOF_DATA[fflabel1][5]*UFF4MOF_DATA[fflabel2][5])/(r0**3) / 2.
+        r0, K = self.bond_parameters[(n1, n2)]
         if (self.keep_metal_geometry) and (n1_data['atomic_number'] in METALS
             or n2_data['atomic_number'] in METALS):
             r0 = data['length']
@@ -3214,39 +3357,17 @@ class UFF4MOF(ForceField):
         a, b, c, data = angle
         angle_type = self.uff_angle_type(b)
 
-        a_data = self.graph.node[a]
         b_data = self.graph.node[b]
-        c_data = self.graph.node[c]
-        ab_bond = self.graph[a][b]
-        bc_bond = self.graph[b][c]
-
-        auff, buff, cuff = a_data['force_field_type'], b_data['force_field_type'], c_data['force_field_type']
 
-        theta0 = UFF4MOF_DATA[buff][1]
+        # theta0 is the measured angle if the central atom is a metal and
+        # keep_metal_geometry is requested (see compute_angle_terms)
+        theta0, ka, c0, c1, c2 = self.angle_parameters[(a, b, c)]
         # just check if the central node is a metal, then apply a rigid angle term.
         # NB: Functional form may change dynamics, but at this point we will not
         # concern ourselves if the force constants are big.
         if (self.keep_metal_geometry) and (b_data['atomic_number'] in METALS):
-            theta0 = self.graph.compute_angle_between(a, b, c)
             angle_type = "None"
 
-        cosT0 = math.cos(theta0*DEG2RAD)
-        sinT0 = math.sin(theta0*DEG2RAD)
-
-        c2 = 1.0 / (4.0*sinT0*sinT0)
-        c1 = -4.0 * c2 * cosT0
-        c0 = c2 * (2.0*cosT0*cosT0 + 1.0)
-
-        za = UFF4MOF_DATA[auff][5]
-        zc = UFF4MOF_DATA[cuff][5]
-
-        r_ab = ab_bond['potential'].R0
-        r_bc = bc_bond['potential'].R0
-        r_ac = math.sqrt(r_ab*r_ab + r_bc*r_bc - 2.*r_ab*r_bc*cosT0)
-
-        beta = 664.12/r_ab/r_bc
-        ka = beta*(za*zc /(r_ac**5.))*r_ab*r_bc
-        ka *= (3.*r_ab*r_bc*(1. - cosT0*cosT0) - r_ac*r_ac*cosT0)
         #if ("special_flag" in b_data.keys()) and b_data["special_flag"] == "Cu_pdw":
         #    angle_type = "None"
         #    print(self.graph.compute_angle_between(a, b, c))
@@ -3324,8 +3445,21 @@ class UFF4MOF(ForceField):
         elif coord_type == "8":
             return 'cubic-antiprism'
         else:
-            print("ERROR: Cannot find coordination type for %s"%name)
-            sys.exit()
+            raise ForceFieldError("ERROR: Cannot find coordination type for %s"%name)
+
+    def compute_dihedral_terms(self):
+        """Measure the dihedral angles about metal atoms in one pass if the
+        metal geometry is kept, dihedral_term reads them from
+        self.measured_dihedrals.
+
+        """
+        self.measured_dihedrals = {}
+        if self.keep_metal_geometry:
+            self.measured_dihedrals = self.measure_dihedrals(
+                    [(a, b, c, d) for (a, b, c, d) in self.dihedral_quads()
+                     if self.graph.node[b]['atomic_number'] in METALS or
+                     self.graph.node[c]['atomic_number'] in METALS])
+        ForceField.compute_dihedral_terms(self)
 
     def dihedral_term(self, dihedral):
         """Use a small cosine Fourier expansion
@@ -3425,7 +3559,7 @@ class UFF4MOF(ForceField):
             c_data['atomic_number'] in METALS):
             # must use different potential with minimum at the computed dihedral
             # angle.
-            nphi0 = n*self.graph.compute_dihedral_between(a, b, c, d)
+            nphi0 = n*self.measured_dihedrals[(a, b, c, d)]
             data['potential'] = DihedralPotential.Charmm()
             data['potential'].K = 0.5
             data['potential'].d = 180 + nphi0
@@ -3512,193 +3646,221 @@ class UFF4MOF(ForceField):
         # for each atom determine the ff type if it is None
         organics = ["C", "N", "O", "S"]
         halides = ["F", "Cl", "Br", "I"]
-        for node, data in self.graph.nodes_iter2(data=True):
-            special = 'special_flag' in data
-            if data['force_field_type'] is None:
-                if special:
-                    # Zn4O case TODO(pboyd): generalize these cases...
-                    if data['special_flag'] == "O_z_Zn4O":
-                        data['force_field_type'] = "O_3_f"
-                    elif data['special_flag'] == "Zn4O":
-                        data['force_field_type'] = "Zn3f2"
-                        # change the bond orders to 0.5 as per the paper
-                        for n in self.graph.neighbors(node):
-                            self.graph[node][n]['order'] = 0.5
-                            # woops! this is correct only for the M3O type SBUs
-                            #if self.graph.node[n]['special_flag'] == "O_z_Zn4O":
-                            #    self.graph[node][n]['order'] = 1.0
-                            #else:
-                            #    self.graph[node][n]['order'] = 0.5
-                    elif data['special_flag'] == "C_Zn4O":
-                        data['force_field_type'] = "C_R"
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "O":
-                                self.graph[node][n]['order'] = 1.5
-                            elif self.graph.node[n]['element'] == "C":
-                                self.graph[node][n]['order'] = 1
-                    elif data['special_flag'] == "O_c_Zn4O":
-                        data['force_field_type'] = 'O_2'
-
-                    # Copper Paddlewheel TODO(pboyd): generalize these cases...
-                    elif data['special_flag'] == "O1_Cu_pdw" or data['special_flag'] == "O2_Cu_pdw":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "Cu_pdw":
-                        data['force_field_type'] = 'Cu4+2'
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "Cu":
-                                self.graph[node][n]['order'] = 0.25
-                            else:
+        # (element, degree, square planar) -> metal atoms to be typed
+        signatures = {}
+        # tetrahedral or square planar, determined for all 4-coordinated metals at once
+        tetra_or_sqpl = [node for node, data in self.graph.nodes_iter2(data=True)
+                         if data['force_field_type'] is None and data['element'] in metals
+                         and self.graph.degree(node) == 4]
+        square_planar = dict(zip(tetra_or_sqpl, self.graph.coplanar_nodes(tetra_or_sqpl)))
+        # the types only depend on the neighbours, they are determined for
+        # one atom of each environment and copied to the others. SBU atoms
+        # and metals also change the orders of their bonds, so these are
+        # all typed.
+        for members in self.graph.environment_classes(attributes=('element', 'hybridization',
+                                                                  'force_field_type', 'special_flag')):
+            data = self.graph.node[members[0]]
+            if 'special_flag' in data or data['element'] in metals:
+                typed = members
+            else:
+                typed = members[:1]
+            for node in typed:
+                data = self.graph.node[node]
+                special = 'special_flag' in data
+                neigh_elem = set([self.graph.node[i]['element'] for i in self.graph.neighbors(node)])
+                if data['force_field_type'] is None:
+                    if special:
+                        # Zn4O case TODO(pboyd): generalize these cases...
+                        if data['special_flag'] == "O_z_Zn4O":
+                            data['force_field_type'] = "O_3_f"
+                        elif data['special_flag'] == "Zn4O":
+                            data['force_field_type'] = "Zn3f2"
+                            # change the bond orders to 0.5 as per the paper
+                            for n in self.graph.neighbors(node):
                                 self.graph[node][n]['order'] = 0.5
-                    elif data['special_flag'] == "C_Cu_pdw":
-                        data['force_field_type'] = 'C_R'
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "O":
-                                self.graph[node][n]['order'] = 1.5
-                            elif self.graph.node[n]['element'] == "C":
-                                self.graph[node][n]['order'] = 1
-
-                    # Zn Paddlewheel TODO(pboyd): generalize these cases...
-                    elif data['special_flag'] == "O1_Zn_pdw" or data['special_flag'] == "O2_Zn_pdw":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "Zn_pdw":
-                        data['force_field_type'] = 'Zn4+2'
+                                # woops! this is correct only for the M3O type SBUs
+                                #if self.graph.node[n]['special_flag'] == "O_z_Zn4O":
+                                #    self.graph[node][n]['order'] = 1.0
+                                #else:
+                                #    self.graph[node][n]['order'] = 0.5
+                        elif data['special_flag'] == "C_Zn4O":
+                            data['force_field_type'] = "C_R"
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "O":
+                                    self.graph[node][n]['order'] = 1.5
+                                elif self.graph.node[n]['element'] == "C":
+                                    self.graph[node][n]['order'] = 1
+                        elif data['special_flag'] == "O_c_Zn4O":
+                            data['force_field_type'] = 'O_2'
+
+                        # Copper Paddlewheel TODO(pboyd): generalize these cases...
+                        elif data['special_flag'] == "O1_Cu_pdw" or data['special_flag'] == "O2_Cu_pdw":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "Cu_pdw":
+                            data['force_field_type'] = 'Cu4+2'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "Cu":
+                                    self.graph[node][n]['order'] = 0.25
+                                else:
+                                    self.graph[node][n]['order'] = 0.5
+                        elif data['special_flag'] == "C_Cu_pdw":
+                            data['force_field_type'] = 'C_R'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "O":
+                                    self.graph[node][n]['order'] = 1.5
+                                elif self.graph.node[n]['element'] == "C":
+                                    self.graph[node][n]['order'] = 1
+
+                        # Zn Paddlewheel TODO(pboyd): generalize these cases...
+                        elif data['special_flag'] == "O1_Zn_pdw" or data['special_flag'] == "O2_Zn_pdw":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "Zn_pdw":
+                            data['force_field_type'] = 'Zn4+2'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "Zn":
+                                    self.graph[node][n]['order'] = 0.25
+                                else:
+                                    self.graph[node][n]['order'] = 0.5
+                        elif data['special_flag'] == "C_Zn_pdw":
+                            data['force_field_type'] = 'C_R'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "O":
+                                    self.graph[node][n]['order'] = 1.5
+                                elif self.graph.node[n]['element'] == "C":
+                                    self.graph[node][n]['order'] = 1
+
+                        # Al Pillar TODO(pboyd): generalize these cases...
+                        elif data['special_flag'] == "O_c_Al_pillar":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "O_z_Al_pillar":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "H_Al_pillar":
+                            data['force_field_type'] = 'H_'
+                        elif data['special_flag'] == "Al_pillar":
+                            data['force_field_type'] = 'Al6+3'
+                        elif data['special_flag'] == "C_Al_pillar":
+                            data['force_field_type'] = 'C_R'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "O":
+                                    self.graph[node][n]['order'] = 1.5
+                                elif self.graph.node[n]['element'] == "C":
+                                    self.graph[node][n]['order'] = 1
+
+                        # V Pillar TODO(pboyd): generalize these cases...
+                        elif data['special_flag'] == "O_c_V_pillar":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "O_z_V_pillar":
+                            data['force_field_type'] = 'O_2'
+                        elif data['special_flag'] == "V_pillar":
+                            data['force_field_type'] = 'V6+3'
+                        elif data['special_flag'] == "C_V_pillar":
+                            data['force_field_type'] = 'C_R'
+                            for n in self.graph.neighbors(node):
+                                if self.graph.node[n]['element'] == "O":
+                                    self.graph[node][n]['order'] = 1.5
+                                elif self.graph.node[n]['element'] == "C":
+                                    self.graph[node][n]['order'] = 1
+
+                    elif data['element'] in organics:
+                        if data['hybridization'] == "sp3":
+                            data['force_field_type'] = "%s_3"%data['element']
+
+                        elif data['hybridization'] == "aromatic":
+                            data['force_field_type'] = "%s_R"%data['element']
+                        elif data['hybridization'] == "sp2":
+                            data['force_field_type'] = "%s_2"%data['element']
+                        elif data['hybridization'] == "sp":
+                            data['force_field_type'] = "%s_1"%data['element']
+                    if data['element'] == "O" and self.graph.degree(node) == 2:
+                        if neigh_elem <= metals:
+                            data['force_field_type'] = "O_2"
+                        if neigh_elem <= set(["Si", "Al"]):
+                            data['force_field_type'] = "O_3_z"
+                        if neigh_elem <= metals | set(["C"]):
+                            data['force_field_type'] = "O_2"
+                    elif data['element'] == "O" and self.graph.degree(node) == 3:
+                        if (neigh_elem <= metals):
+                            data['force_field_type'] = "O_2_z"
+                            # temp fix for UiO-series MOFs
+                            if neigh_elem == set(["Zr"]):
+                                data['force_field_type'] = "O_3_f"
+                        else:
+                            data['force_field_type'] = "O_2"
+                    elif data['element'] == "O" and self.graph.degree(node) == 4:
+                        if (neigh_elem <= metals | set(["H"])):
+                            data['force_field_type'] = "O_3_f"
+
+                    elif data['element'] == "H":
+                        data['force_field_type'] = "H_"
+                    elif data['element'] in halides:
+                        data['force_field_type'] = data['element']
+                        if data['element'] == "F":
+                            data['force_field_type'] += "_"
+                        elif data['element'] == "I":
+                            data['force_field_type'] += "_"
+                    elif data['element'] in metals:
+                        degree = self.graph.degree(node)
+                        planar = square_planar.get(node, False)
+                        signatures.setdefault((data['element'], degree, planar), []).append(node)
                         for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "Zn":
+                            if self.graph.node[n]['element'] in metals:
                                 self.graph[node][n]['order'] = 0.25
-                            else:
+                            elif self.graph.node[n]['element'] == "O":
                                 self.graph[node][n]['order'] = 0.5
-                    elif data['special_flag'] == "C_Zn_pdw":
-                        data['force_field_type'] = 'C_R'
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "O":
-                                self.graph[node][n]['order'] = 1.5
-                            elif self.graph.node[n]['element'] == "C":
-                                self.graph[node][n]['order'] = 1
-
-                    # Al Pillar TODO(pboyd): generalize these cases...
-                    elif data['special_flag'] == "O_c_Al_pillar":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "O_z_Al_pillar":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "H_Al_pillar":
-                        data['force_field_type'] = 'H_'
-                    elif data['special_flag'] == "Al_pillar":
-                        data['force_field_type'] = 'Al6+3'
-                    elif data['special_flag'] == "C_Al_pillar":
-                        data['force_field_type'] = 'C_R'
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "O":
-                                self.graph[node][n]['order'] = 1.5
-                            elif self.graph.node[n]['element'] == "C":
-                                self.graph[node][n]['order'] = 1
-
-                    # V Pillar TODO(pboyd): generalize these cases...
-                    elif data['special_flag'] == "O_c_V_pillar":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "O_z_V_pillar":
-                        data['force_field_type'] = 'O_2'
-                    elif data['special_flag'] == "V_pillar":
-                        data['force_field_type'] = 'V6+3'
-                    elif data['special_flag'] == "C_V_pillar":
-                        data['force_field_type'] = 'C_R'
-                        for n in self.graph.neighbors(node):
-                            if self.graph.node[n]['element'] == "O":
-                                self.graph[node][n]['order'] = 1.5
-                            elif self.graph.node[n]['element'] == "C":
-                                self.graph[node][n]['order'] = 1
-
-                elif data['element'] in organics:
-                    neigh_elem = set([self.graph.node[i]['element'] for i in self.graph.neighbors(node)])
-                    if data['hybridization'] == "sp3":
-                        data['force_field_type'] = "%s_3"%data['element']
-
-                    elif data['hybridization'] == "aromatic":
-                        data['force_field_type'] = "%s_R"%data['element']
-                    elif data['hybridization'] == "sp2":
-                        data['force_field_type'] = "%s_2"%data['element']
-                    elif data['hybridization'] == "sp":
-                        data['force_field_type'] = "%s_1"%data['element']
-                if data['element'] == "O" and self.graph.degree(node) == 2:
-                    if neigh_elem <= metals:
-                        data['force_field_type'] = "O_2"
-                    if neigh_elem <= set(["Si", "Al"]):
-                        data['force_field_type'] = "O_3_z"
-                    if neigh_elem <= metals | set(["C"]):
-                        data['force_field_type'] = "O_2"
-                elif data['element'] == "O" and self.graph.degree(node) == 3:
-                    if (neigh_elem <= metals):
-                        data['force_field_type'] = "O_2_z"
-                        # temp fix for UiO-series MOFs
-                        if neigh_elem == set(["Zr"]):
-                            data['force_field_type'] = "O_3_f"
-                    else:
-                        data['force_field_type'] = "O_2"
-                elif data['element'] == "O" and self.graph.degree(node) == 4:
-                    if (neigh_elem <= metals | set(["H"])):
-                        data['force_field_type'] = "O_3_f"
+                            # else: bond order stays = 1
+            for n in members[len(typed):]:
+                self.graph.node[n]['force_field_type'] = data['force_field_type']
+
+        # all metals sharing an element/coordination signature get the same type
+        for (element, degree, planar), nodes in signatures.items():
+            fftype = self.metal_type(element, degree, planar)
+            # couldn't find the force field type! these are picked up below.
+            if fftype not in UFF4MOF_TABLE:
+                continue
+            for node in nodes:
+                self.graph.node[node]['force_field_type'] = fftype
 
-                elif data['element'] == "H":
-                    data['force_field_type'] = "H_"
-                elif data['element'] in halides:
-                    data['force_field_type'] = data['element']
-                    if data['element'] == "F":
-                        data['force_field_type'] += "_"
-                    elif data['element'] == "I":
-                        data['force_field_type'] += "_"
-                elif data['element'] in metals:
-                    if len(data['element']) == 1:
-                        fftype = data['element'] + "_"
-                    else:
-                        fftype = data['element']
-
-                    # get coordination number and angles between atoms
-                    if(self.graph.degree(node) == 2):
-                        fftype += "1f1"
-                    elif(self.graph.degree(node) == 3):
-                        fftype += "2f2"
-                    elif(self.graph.degree(node) == 4):
-                        # tetrahedral or square planar
-                        if self.graph.coplanar(node):
-                            fftype += "4f2"
-                        # Could implement a tetrahedrality index here, but that would be overkill.
-                        else:
-                            fftype += "3f2"
-                    elif(self.graph.degree(node) == 5):
-                        # assume paddlewheels........
-                        fftype += "4+2"
-                    elif(self.graph.degree(node) == 6):
-                        fftype += "6f3"
-                    elif(self.graph.degree(node) == 8):
-                        fftype += "8f4"
-                    try:
-                        UFF4MOF_DATA[fftype]
-                        data['force_field_type'] = fftype
-                    # couldn't find the force field type!
-                    except KeyError:
-                        try:
-                            fftype = fftype.replace("f", "+")
-                            UFF4MOF_DATA[fftype]
-                        except KeyError:
-                            pass
-                    for n in self.graph.neighbors(node):
-                        if self.graph.node[n]['element'] in metals:
-                            self.graph[node][n]['order'] = 0.25
-                        elif self.graph.node[n]['element'] == "O":
-                            self.graph[node][n]['order'] = 0.5
-                        # else: bond order stays = 1
-
-                # WARNING, the following else statement will do unknown things to the system.
-                if data['force_field_type'] is None:
-                    ffs = list(UFF4MOF_DATA.keys())
-                    for j in ffs:
-                        if data['element'] == j[:2].strip("_"):
-                            print("WARNING: Could not find an appropriate UFF4MOF type for %s. Assigning %s"%(
-                                  data['element'], j))
-                            data['force_field_type'] = j
+        for node, data in self.graph.nodes_iter2(data=True):
+            # WARNING, the following will do unknown things to the system.
             if data['force_field_type'] is None:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                j = UFF4MOF_TYPE_INDEX.fallback(data['element'])
+                if j is None:
+                    raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                            " with element: '%s'"%(data['element']))
+                print("WARNING: Could not find an appropriate UFF4MOF type for %s. Assigning %s"%(
+                      data['element'], j))
+                data['force_field_type'] = j
+
+    def metal_type(self, element, degree, planar=False):
+        """Build the UFF4MOF label of a metal from its coordination number,
+        eg. Zn with four square planar neighbours -> 'Zn4f2'.
+        The label is not guaranteed to exist in UFF4MOF_DATA.
+
+        """
+        if len(element) == 1:
+            fftype = element + "_"
+        else:
+            fftype = element
+
+        # get coordination number and angles between atoms
+        if(degree == 2):
+            fftype += "1f1"
+        elif(degree == 3):
+            fftype += "2f2"
+        elif(degree == 4):
+            if planar:
+                fftype += "4f2"
+            # Could implement a tetrahedrality index here, but that would be overkill.
+            else:
+                fftype += "3f2"
+        elif(degree == 5):
+            # assume paddlewheels........
+            fftype += "4+2"
+        elif(degree == 6):
+            fftype += "6f3"
+        elif(degree == 8):
+            fftype += "8f4"
+        return fftype
 
 
 class Dubbeldam(ForceField):
@@ -3734,8 +3896,7 @@ class Dubbeldam(ForceField):
         if string not in Dub_bonds.keys():
             string = "_".join([type2, type1])
         if string not in Dub_bonds.keys():
-            print("ERROR: Could not find the bond parameters for the bond between %s"%string)
-            sys.exit()
+            raise ForceFieldError("ERROR: Could not find the bond parameters for the bond between %s"%string)
 
         data['potential'] = BondPotential.Harmonic()
         data['potential'].K = Dub_bonds[string][0]*kBtokcal/2.
@@ -3761,8 +3922,7 @@ class Dubbeldam(ForceField):
         if string not in Dub_angles.keys():
             string = "_".join([ctype, btype, atype])
         if string not in Dub_angles.keys():
-            print("ERROR: Could not find the angle parameters for the atom types %s"%string)
-            sys.exit()
+            raise ForceFieldError("ERROR: Could not find the angle parameters for the atom types %s"%string)
 
         data['potential'] = AnglePotential.Harmonic()
         # check to make sure to divide by DEG2RAD**2
@@ -3798,8 +3958,7 @@ class Dubbeldam(ForceField):
         if string not in Dub_dihedrals.keys():
             string = "_".join([dtype, ctype, btype, atype])
         if string not in Dub_dihedrals.keys():
-            print("ERROR: Could not find the torsion parameters for the atom types %s"%string)
-            sys.exit()
+            raise ForceFieldError("ERROR: Could not find the torsion parameters for the atom types %s"%string)
         w = 0.0
         data['potential'] = DihedralPotential.Charmm()
         data['potential'].K = Dub_dihedrals[string][0]*kBtokcal
@@ -3851,8 +4010,7 @@ class Dubbeldam(ForceField):
         if string not in Dub_impropers.keys():
             string = "_".join([dtype, btype, ctype, atype])
         if string not in Dub_impropers.keys():
-            print("ERROR: Could not find the improper torsion parameters for the atom types %s"%string)
-            sys.exit()
+            raise ForceFieldError("ERROR: Could not find the improper torsion parameters for the atom types %s"%string)
         data['potential'] = ImproperPotential.Cvff()
 
         # I have 3 impropers, he only has 1. Divide by 3 to get average?
@@ -3888,10 +4046,9 @@ class Dubbeldam(ForceField):
         for node, data in self.graph.nodes_iter2(data=True):
             special = 'special_flag' in data
             if not special:
-                print("ERROR: Some atoms were not detected as part of an SBU." +
-                        " This is a requirement for successful parameterization of the "+
-                        "Dubbeldam forcefield for the IRMOFs.")
-                sys.exit()
+                raise ForceFieldError("ERROR: Some atoms were not detected as part of an SBU." +
+                                        " This is a requirement for successful parameterization of the "+
+                                        "Dubbeldam forcefield for the IRMOFs.")
             if data['special_flag'] == "O_z_Zn4O":
                 data['force_field_type'] = "Oa"
 
@@ -3912,9 +4069,8 @@ class Dubbeldam(ForceField):
                 data['force_field_type'] = data['special_flag']
 
             if data['force_field_type'] is None:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
 
 
 class SPC_E(ForceField):
@@ -4026,9 +4182,8 @@ class SPC_E(ForceField):
             elif data['element'] == "H":
                 fftype = "HW"
             else:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
             data['force_field_type'] = fftype
             data['mass'] = SPC_E_atoms[fftype][0]
             data['charge'] = SPC_E_atoms[fftype][3]
@@ -4139,9 +4294,8 @@ class TIP3P(ForceField):
             elif data['element'] == "H":
                 fftype = "HW"
             else:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
             data['force_field_type'] = fftype
             data['mass'] = TIP3P_atoms[fftype][0]
             data['charge'] = TIP3P_atoms[fftype][3]
@@ -4190,6 +4344,17 @@ class TIP4P(ForceField, TIP4P_Water):
             data['potential'].R0 = self.Rdum
         return 1
 
+    def compute_angle_terms(self):
+        """The angles involving the massless site(s) X keep the input
+        geometry, measure them in one pass before assigning the terms.
+
+        """
+        self.measured_angles = self.measure_angles(
+                [(a, b, c) for (a, b, c) in self.angle_triples()
+                 if "X" in (self.graph.node[a]['force_field_type'],
+                            self.graph.node[c]['force_field_type'])])
+        ForceField.compute_angle_terms(self)
+
     def angle_term(self, angle):
         """Harmonic angle term.
 
@@ -4222,7 +4387,7 @@ class TIP4P(ForceField, TIP4P_Water):
         if atype == "HW" and ctype == "HW":
             data['potential'].theta0 = self.HOH
         elif (set([atype,ctype]) == set(["X", "HW"])) and (not self.lammps_implicit):
-            data['potential'].theta0 = self.graph.compute_angle_between(a,b,c)
+            data['potential'].theta0 = self.measured_angles[(a, b, c)]
 
         return 1
 
@@ -4274,9 +4439,8 @@ class TIP4P(ForceField, TIP4P_Water):
             elif data['element'] == "X":
                 fftype = "X"
             else:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
             data['force_field_type'] = fftype
             data['mass'] = TIP4P_atoms[fftype][0]
             data['charge'] = TIP4P_atoms[fftype][3]
@@ -4321,6 +4485,17 @@ class TIP5P(ForceField):
         data['potential'].special_flag = "rigid"
         return 1
 
+    def compute_angle_terms(self):
+        """The angles involving the massless site(s) X keep the input
+        geometry, measure them in one pass before assigning the terms.
+
+        """
+        self.measured_angles = self.measure_angles(
+                [(a, b, c) for (a, b, c) in self.angle_triples()
+                 if "X" in (self.graph.node[a]['force_field_type'],
+                            self.graph.node[c]['force_field_type'])])
+        ForceField.compute_angle_terms(self)
+
     def angle_term(self, angle):
         """Harmonic angle term.
 
@@ -4345,7 +4520,7 @@ class TIP5P(ForceField):
         if atype == "X" and ctype == "X":
             data['potential'].theta0 = 109.47
         elif set([atype,ctype]) == set(["X", "HW"]):
-            data['potential'].theta0 = self.graph.compute_angle_between(a,b,c)
+            data['potential'].theta0 = self.measured_angles[(a, b, c)]
         else:
             data['potential'].theta0 = 104.52 # HW - OW - HW
 
@@ -4397,9 +4572,8 @@ class TIP5P(ForceField):
             elif data['element'] == "X":
                 fftype = "X"
             else:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
             data['force_field_type'] = fftype
             data['mass'] = TIP5P_atoms[fftype][0]
             data['charge'] = TIP5P_atoms[fftype][3]
@@ -4505,9 +4679,8 @@ class EPM2_CO2(ForceField):
             elif data['element'] == "C":
                 fftype = "Cx"
             else:
-                print("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
-                        " with element: '%s'"%(data['element']))
-                sys.exit()
+                raise ForceFieldError("ERROR: could not find the proper force field type for atom %i"%(data['index'])+
+                                        " with element: '%s'"%(data['element']))
             data['force_field_type'] = fftype
             data['mass'] = EPM2_atoms[fftype][0]
             data['charge'] = EPM2_atoms[fftype][3]
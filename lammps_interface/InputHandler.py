@@ -25,14 +25,25 @@ rev_no, commit = git_revision_hash()
 __version_info__ = (0, 0, rev_no, "%s"%commit)
 __version__ = "%i.%i.%i.%s"%__version_info__
 
+# options which are only read when writing the lammps input file, changing
+# them does not change the data file.
+INPUT_FILE_OPTIONS = ('accelerator', 'auto_timestep', 'bulk_moduli', 'deposit', 'dump_dcd',
+                      'dump_lammpstrj', 'dump_xyz', 'iter_count', 'max_dev', 'minimize',
+                      'neqstp', 'nprodstp', 'npt', 'nvt', 'pressure', 'random_vel', 'ranks',
+                      'respa', 'restart', 'temp', 'thermal_scaling')
+
 
 class Options(object):
 
-    def __init__(self):
+    def __init__(self, args=None):
+        """args is a list of command line arguments, if None they
+        are read from sys.argv.
+
+        """
         #print("Lammps_interface version: %s"%__version__)
-        self.run_command_line_options()
+        self.run_command_line_options(args)
 
-    def run_command_line_options(self):
+    def run_command_line_options(self, args=None):
         parser = ArgumentParser(description="LAMMPS interface :D", prog="lammps_interface")
         parser.add_argument("-V", "--version",
                             action="version",
@@ -73,7 +84,11 @@ class Options(object):
                                           "options are 'BTW_FF', 'Dreiding', 'UFF', "+
                                           "'UFF4MOF', and 'Dubbeldam'."+
                                           " The default is set to the Universal "+
-                                          "Force Field [UFF].")
+                                          "Force Field [UFF]. A comma separated list "+
+                                          "of force fields (eg. UFF,UFF4MOF,Dreiding) "+
+                                          "computes the structure topology once and writes "+
+                                          "the files of each force field to its own "+
+                                          "sub directory.")
         force_field_group.add_argument("--molecule-ff", action="store",
                                        dest="mol_ff",
                                        default=None,
@@ -111,6 +126,20 @@ class Options(object):
                                           "Useful for structure minimizations. Currently only "+
                                           "applies to UFF and Dreiding Force Fields. Default is "+
                                           "off.")
+        force_field_group.add_argument("--molecule-h-bonding", action="store",
+                                       dest="molecule_h_bonding",
+                                       choices=["ask", "yes", "no"],
+                                       default="ask",
+                                       help="Add hydrogen donor potentials to molecules "+
+                                          "described with the Dreiding force field. "+
+                                          "Default is to ask for each molecule type.")
+        force_field_group.add_argument("--table-cache", action="store",
+                                       dest="table_cache",
+                                       default=None,
+                                       help="Directory of the cache of tabulated pair "+
+                                          "potentials (MOF_FF), or 'none' to compute "+
+                                          "them every time. Default is $LAMMPS_INTERFACE_CACHE "+
+                                          "or ~/.cache/lammps_interface/tables.")
 
         simulation_group = parser.add_argument_group("Simulation options")
         simulation_group.add_argument("--minimize", action="store_true",
@@ -163,12 +192,120 @@ class Options(object):
                                       " This is useful when dealing with flexible materials " +
                                       "where you know that structural collapse will result in " +
                                       "the box decreasing past 2*rcut")
+        simulation_group.add_argument("--replicate-molecules", action="store",
+                                      dest="replicate_molecules",
+                                      choices=["ask", "yes", "no"],
+                                      default="ask",
+                                      help="Replicate the molecules found in the unit cell "+
+                                      "when a supercell is built. Default is to ask for each "+
+                                      "molecule type.")
         simulation_group.add_argument("-O","--orthogonalize", action="store_true",
                                       default=False,
                                       dest="orthogonalize",
                                       help="Makes a supercell of the simulation box with more-or-less "+
                                            "orthogonal supercell vectors. This is an approximation, but is "+
                                            "useful for certain calculations. Default is FALSE.")
+        simulation_group.add_argument("--orthogonal-tolerance", action="store",
+                                      type=float, default=1.0,
+                                      dest="orthogonal_tolerance",
+                                      help="Largest deviation from 90 degrees of the supercell "+
+                                           "angles accepted by --orthogonalize. Default is 1.0")
+        simulation_group.add_argument("--smallest-supercell", action="store_true",
+                                      default=False,
+                                      dest="smallest_supercell",
+                                      help="Build the supercell with the fewest atoms that "+
+                                           "supports the non-bonded cutoff, from integer combinations "+
+                                           "of the unit cell vectors rather than replicas along each "+
+                                           "of them. Smaller boxes run faster, especially for "+
+                                           "triclinic cells. Default is FALSE.")
+        simulation_group.add_argument("--lammps-replicate", action="store_true",
+                                      default=False,
+                                      dest="lammps_replicate",
+                                      help="Write the unit cell with image flags to the data file "+
+                                           "and build the supercell with the LAMMPS 'replicate' "+
+                                           "command, so the data file does not grow with the "+
+                                           "supercell. Periodic frameworks need the bond/periodic "+
+                                           "keyword of recent LAMMPS versions. Default is FALSE.")
+        simulation_group.add_argument("--kspace-style", action="store",
+                                      default="auto",
+                                      choices=["auto", "ewald", "pppm", "pppm/disp", "msm"],
+                                      dest="kspace_style",
+                                      help="Solver for the long range electrostatics of charged "+
+                                           "systems. 'auto' chooses ewald or pppm from the number of "+
+                                           "atoms, the box and the accuracy. pppm/disp also makes "+
+                                           "the dispersion long range, msm uses coul/msm pair styles. "+
+                                           "Default is auto.")
+        simulation_group.add_argument("--kspace-accuracy", action="store",
+                                      type=float, default=1e-6,
+                                      dest="kspace_accuracy",
+                                      help="Target relative accuracy of the kspace forces. "+
+                                           "Default is 1e-6.")
+        simulation_group.add_argument("--sort-atoms", action="store",
+                                      default="none",
+                                      choices=["none", "hilbert", "morton"],
+                                      dest="sort_atoms",
+                                      help="Number the atoms of the data file along a space "+
+                                           "filling curve through the box, so that atoms close in "+
+                                           "space are close in memory from the first step. Guest "+
+                                           "molecules are numbered after the framework. Default is none.")
+        simulation_group.add_argument("--ranks", action="store",
+                                      type=int, default=None,
+                                      dest="ranks",
+                                      help="Number of MPI ranks the simulation will run on. "+
+                                           "The processor grid and the balance commands which "+
+                                           "even out the atoms per rank over the pores are "+
+                                           "written to the input file.")
+        simulation_group.add_argument("--accelerator", action="store",
+                                      default=None,
+                                      choices=["omp", "opt", "intel"],
+                                      dest="accelerator",
+                                      help="Use the styles of a LAMMPS accelerator package "+
+                                           "(OPENMP, OPT or INTEL) where they exist. The styles "+
+                                           "without an accelerated variant are reported.")
+        simulation_group.add_argument("--rigid-framework",
+                                      action="store_true",
+                                      default=False,
+                                      dest="rigid_framework",
+                                      help="Keep the framework fixed for adsorption MD: its bonds, "+
+                                           "angles, dihedrals and impropers are left out of the "+
+                                           "data file, framework-framework pairs are excluded "+
+                                           "and only the guest molecules are integrated.")
+        simulation_group.add_argument("--rigid-sbus",
+                                      action="store_true",
+                                      default=False,
+                                      dest="rigid_sbus",
+                                      help="Integrate each inorganic SBU and organic cluster "+
+                                           "(benzene, biphenyl, ..) found in the framework as a "+
+                                           "rigid body with fix rigid/small. The bonded terms "+
+                                           "within the bodies are deleted and their pairs "+
+                                           "excluded, the terms joining them keep the framework "+
+                                           "flexible.")
+        simulation_group.add_argument("--shake-hydrogens", action="store",
+                                      default="none",
+                                      choices=["none", "bonds", "angles"],
+                                      dest="shake_hydrogens",
+                                      help="Constrain the bonds to hydrogen atoms with fix shake, "+
+                                           "and with 'angles' also the H-X-H angles of atoms "+
+                                           "bonded to two hydrogens. Atoms with more than three "+
+                                           "hydrogens are left flexible. The timestep is then "+
+                                           "chosen as with --auto-timestep. Default is none.")
+        simulation_group.add_argument("--auto-timestep",
+                                      action="store_true",
+                                      default=False,
+                                      dest="auto_timestep",
+                                      help="Choose the timestep from the vibrational periods "+
+                                           "of the bonds and angles, with about 10 steps over "+
+                                           "the fastest period and at most 2 fs. Bonds and "+
+                                           "angles constrained by SHAKE are left out.")
+        simulation_group.add_argument("--respa",
+                                      action="store_true",
+                                      default=False,
+                                      dest="respa",
+                                      help="Integrate with run_style respa, the bonds on the "+
+                                           "inner level, the angles, dihedrals and impropers, "+
+                                           "the pair forces and the kspace forces on levels "+
+                                           "with longer timesteps chosen from the vibrational "+
+                                           "periods.")
         simulation_group.add_argument("--randomize-velocities",
                                       action="store_true",
                                       default=False,
@@ -311,12 +448,85 @@ class Options(object):
                                                    "cells that were needed to produce the simulation "+
                                                    "supercell.")
 
+        sweep_group = parser.add_argument_group("Sweep options")
+        sweep_group.add_argument("--sweep",
+                                 action="append",
+                                 default=[],
+                                 metavar="NAME=V1,V2,..",
+                                 dest="sweep",
+                                 help="Write one input file for each of the comma "+
+                                      "separated values of the option NAME, eg. "+
+                                      "--sweep temperature=250,300,350. NAME is the long "+
+                                      "option name or its attribute name, and yes/no are "+
+                                      "used for flags. Can be given several times, in which "+
+                                      "case all combinations are written. Options that do "+
+                                      "not change the data file share a single data file.")
+
+        profiling_group = parser.add_argument_group("Profiling options")
+        profiling_group.add_argument("--profile",
+                                     action="store",
+                                     type=str,
+                                     default=None,
+                                     dest="profile",
+                                     help="Write the wall time, cpu time and memory use "+
+                                          "of each stage of the program to this json file.")
+        profiling_group.add_argument("--profile-trace",
+                                     action="store",
+                                     type=str,
+                                     default=None,
+                                     dest="profile_trace",
+                                     help="Write the stages of the program to this file "+
+                                          "in the chrome trace-event format.")
+        profiling_group.add_argument("--profile-memory",
+                                     action="store_true",
+                                     default=False,
+                                     dest="profile_memory",
+                                     help="Track the memory allocated in each stage with "+
+                                          "tracemalloc, and count the objects tracked by the "+
+                                          "garbage collector. This slows down the program considerably.")
+
         parser.add_argument(metavar="CIF", dest="cif_file",
                             help="path to cif file to interpret")
 
-        args = vars(parser.parse_args())
+        args = vars(parser.parse_args(args))
+        args['sweep'] = self._parse_sweep(parser, args['sweep'])
         self._set_attr(args)
 
+    def _parse_sweep(self, parser, sweeps):
+        """Convert the --sweep arguments to a list of
+        (attribute name, [(label, value), ..]) with the values converted
+        as they would be on the command line.
+
+        """
+        actions = {}
+        for action in parser._actions:
+            actions[action.dest] = action
+            for opt in action.option_strings:
+                actions[opt.lstrip("-")] = action
+        grid = []
+        for sweep in sweeps:
+            name, _, values = sweep.partition("=")
+            action = actions.get(name.strip())
+            if not values or action is None or not action.option_strings or \
+                    action.dest in ('sweep', 'help', 'version'):
+                parser.error("cannot sweep over '%s'"%(sweep))
+            points = []
+            for label in [v.strip() for v in values.split(",") if v.strip()]:
+                if action.nargs == 0:
+                    if label.lower() not in ("yes", "no", "true", "false"):
+                        parser.error("%s is a flag, use yes or no in '%s'"%(name, sweep))
+                    value = label.lower() in ("yes", "true")
+                else:
+                    try:
+                        value = action.type(label) if action.type else label
+                    except ValueError:
+                        parser.error("invalid value %s in '%s'"%(label, sweep))
+                    if action.choices and value not in action.choices:
+                        parser.error("invalid value %s in '%s'"%(label, sweep))
+                points.append((label, value))
+            grid.append((action.dest, points))
+        return grid
+
     def _set_attr(self, args):
         for key, value in args.items():
             setattr(self, key, value)
@@ -0,0 +1,67 @@
+"""
+Styles with variants in the LAMMPS CPU accelerator packages.
+
+The input file turns an accelerator on with its 'package' and 'suffix'
+commands; LAMMPS then uses the accelerated variant of each style where
+it exists and the plain style otherwise. The table below lists the
+variants of the styles this program writes, so that the styles which
+fall back to the unaccelerated code can be reported.
+
+    omp     OPENMP package, threads set by OMP_NUM_THREADS
+    opt     OPT package, no package command
+    intel   INTEL package, on the CPU
+"""
+
+ACCELERATORS = ('omp', 'opt', 'intel')
+
+PACKAGE_COMMANDS = {'omp': "omp 0",
+                    'opt': None,
+                    'intel': "intel 0"}
+
+CATEGORIES = ('pair', 'bond', 'angle', 'dihedral', 'improper', 'kspace')
+
+VARIANTS = {
+    'omp': {
+        'pair': {"lj/cut", "lj/cut/coul/long", "lj/cut/coul/msm", "lj/cut/tip4p/long",
+                 "lj/charmm/coul/long", "lj/charmm/coul/msm", "lj/long/coul/long",
+                 "buck", "buck/coul/long", "buck/coul/msm", "buck/long/coul/long",
+                 "hbond/dreiding/lj", "hbond/dreiding/morse", "morse", "table"},
+        'bond': {"class2", "fene", "fene/expand", "harmonic", "harmonic/shift",
+                 "harmonic/shift/cut", "morse", "nonlinear", "quartic", "table"},
+        'angle': {"charmm", "class2", "cosine", "cosine/delta", "cosine/periodic",
+                  "cosine/shift", "cosine/shift/exp", "cosine/squared", "dipole",
+                  "fourier", "fourier/simple", "harmonic", "quartic", "sdk", "table"},
+        'dihedral': {"charmm", "class2", "cosine/shift/exp", "fourier", "harmonic",
+                     "helix", "multi/harmonic", "nharmonic", "opls", "quadratic", "table"},
+        'improper': {"class2", "cossq", "cvff", "fourier", "harmonic", "ring", "umbrella"},
+        'kspace': {"ewald", "msm", "pppm", "pppm/disp", "pppm/tip4p"},
+    },
+    'opt': {
+        'pair': {"lj/cut", "lj/cut/coul/long", "lj/cut/tip4p/long",
+                 "lj/charmm/coul/long", "morse"},
+    },
+    'intel': {
+        'pair': {"lj/cut", "lj/cut/coul/long", "lj/charmm/coul/long", "lj/long/coul/long",
+                 "buck", "buck/coul/long"},
+        'bond': {"fene", "harmonic"},
+        'angle': {"charmm", "harmonic"},
+        'dihedral': {"charmm", "fourier", "harmonic", "opls"},
+        'improper': {"cvff", "harmonic"},
+        'kspace': {"pppm", "pppm/disp"},
+    },
+}
+
+
+def unaccelerated(accelerator, styles):
+    """The styles without a variant for accelerator.
+
+    styles is a dictionary category -> style names, as the categories
+    in CATEGORIES. returns a sorted list of (category, style)
+    """
+    variants = VARIANTS[accelerator]
+    missing = []
+    for category in CATEGORIES:
+        for name in sorted(styles.get(category, ())):
+            if name not in variants.get(category, ()):
+                missing.append((category, name))
+    return missing
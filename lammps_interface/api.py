@@ -0,0 +1,87 @@
+"""
+Library interface, producing the lammps files in memory.
+
+    from lammps_interface import api
+    files = api.render("IRMOF-1.cif", force_field="UFF4MOF", minimize=True)
+    data = files["data.IRMOF-1"]
+
+Errors are raised as subclasses of errors.LammpsInterfaceError. The
+lammps files are not written to disk, but the tabulated potentials of
+MOF_FF are cached in ~/.cache/lammps_interface/tables unless another
+directory, or "none", is given as table_cache.
+"""
+import io
+
+from .InputHandler import Options
+from .lammps_main import LammpsSimulation, check_force_fields
+from .structure_data import from_CIF, clean
+from .errors import OptionsError
+
+# answers to the interactive prompts when running without a terminal.
+NON_INTERACTIVE = {'molecule_h_bonding': 'no',
+                   'replicate_molecules': 'yes'}
+
+
+def options(cif_file="structure", **kwargs):
+    """Return an Options object with the command line defaults,
+    overridden by kwargs. The keywords are the attribute names of the
+    options, eg. force_field="UFF4MOF", fix_metal=True, cutoff=10.0
+
+    """
+    opts = Options([cif_file])
+    for key, value in NON_INTERACTIVE.items():
+        setattr(opts, key, value)
+    for key, value in kwargs.items():
+        if not hasattr(opts, key):
+            raise OptionsError("Unrecognized option: %s"%(key))
+        setattr(opts, key, value)
+    check_force_fields(opts)
+    return opts
+
+
+def build_simulation(cif, opts=None, name=None, profiler=None, **kwargs):
+    """Read the structure, assign the force field and build the
+    supercell. cif can be a path or a file-like object, and the stages
+    are recorded in profiler (a profiling.Profiler) if given.
+
+    returns the LammpsSimulation
+    """
+    if name is None:
+        if hasattr(cif, 'readlines'):
+            name = clean(getattr(cif, 'name', None) or "structure")
+        else:
+            name = clean(cif)
+    if opts is None:
+        opts = options(name, **kwargs)
+    else:
+        opts.cif_file = name
+        for key, value in kwargs.items():
+            setattr(opts, key, value)
+
+    sim = LammpsSimulation(opts)
+    if profiler is not None:
+        sim.profiler = profiler
+    with sim.profiler.stage("from_CIF"):
+        cell, graph = from_CIF(cif, name=name)
+    sim.set_cell(cell)
+    sim.set_graph(graph)
+    sim.split_graph()
+    sim.assign_force_fields()
+    sim.compute_simulation_size()
+    sim.merge_graphs()
+    return sim
+
+
+def render(cif, opts=None, name=None, profiler=None, **kwargs):
+    """Return the lammps files for a structure as a dictionary of
+    file name -> file content.
+
+    """
+    sim = build_simulation(cif, opts=opts, name=name, profiler=profiler, **kwargs)
+    return sim.render_lammps_files()
+
+
+def render_streams(cif, opts=None, name=None, profiler=None, **kwargs):
+    """Same as render, with the file contents as file-like objects."""
+    return {key: io.StringIO(value) for key, value in
+            render(cif, opts=opts, name=name, profiler=profiler, **kwargs).items()}
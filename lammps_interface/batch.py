@@ -0,0 +1,451 @@
+#!/usr/bin/env python
+"""
+Batch processing of many structures.
+
+    python -m lammps_interface.batch structures/ -o runs -j 8 --timeout 600 -- -ff UFF4MOF --minimize
+
+Each structure is run in its own process, in its own sub directory of
+the output directory, so that an error (or a call to sys.exit) in one
+structure does not stop the others. A summary of all the runs is
+written to <output-dir>/summary.json
+
+With --pipeline, reading, computing and writing overlap: reader threads
+parse the upcoming cif files, a pool of processes assigns the force
+fields and renders the lammps files, and writer threads write them to
+disk. Bounded queues between the stages stop the readers from getting
+too far ahead of the pool, and the pool from getting ahead of the
+writers. There are no timeouts or memory limits in this mode.
+"""
+from argparse import ArgumentParser
+from multiprocessing import Process
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import traceback
+
+try:
+    import queue
+except ImportError:
+    # python 2
+    import Queue as queue
+
+from .structure_data import clean
+
+try:
+    import resource
+except ImportError:
+    # not available on windows, memory caps are ignored
+    resource = None
+
+# answers to the interactive prompts, these can be overridden by
+# passing --molecule-h-bonding or --replicate-molecules to the runs.
+BATCH_POLICY = ['--molecule-h-bonding', 'no', '--replicate-molecules', 'yes']
+
+
+def find_structures(inputs):
+    """Return a list of cif files from a list of directories, glob
+    patterns, cif files or manifests (text files with one cif per line,
+    or a json list of cif files).
+
+    """
+    cifs = []
+    for item in inputs:
+        if os.path.isdir(item):
+            cifs += sorted(glob.glob(os.path.join(item, "*.cif")))
+        elif any(i in item for i in "*?["):
+            cifs += sorted(glob.glob(item))
+        elif item.lower().endswith(".cif"):
+            cifs.append(item)
+        else:
+            base = os.path.dirname(os.path.abspath(item))
+            with open(item, 'r') as f:
+                if item.lower().endswith(".json"):
+                    lines = json.load(f)
+                else:
+                    lines = [l.strip() for l in f if l.strip() and not l.strip().startswith("#")]
+            cifs += [os.path.join(base, l) for l in lines]
+    return [os.path.abspath(c) for c in cifs]
+
+
+def run_structure(cif_file, args):
+    """Run lammps_interface on a single cif file in the current working
+    directory.
+
+    returns a dictionary with the number of atoms, the supercell, the
+    timings of each step and the profile of the run, which are only
+    recorded with --profile or --profile-trace.
+    """
+    # imported here so that the parent process, which only needs clean
+    # from structure_data, doesn't load the force fields
+    from .InputHandler import Options
+    from .lammps_main import LammpsSimulation
+    from .structure_data import from_CIF
+    from .profiling import Profiler, NULL_PROFILER
+
+    options = Options(list(args) + [cif_file])
+    profiler = NULL_PROFILER
+    if options.profile or options.profile_trace:
+        profiler = Profiler(trace_memory=options.profile_memory,
+                            count_objects=options.profile_memory)
+    sim = LammpsSimulation(options)
+    sim.profiler = profiler
+    with profiler.stage("from_CIF"):
+        cell, graph = from_CIF(options.cif_file)
+    sim.set_cell(cell)
+    sim.set_graph(graph)
+    sim.split_graph()
+    sim.assign_force_fields()
+    sim.compute_simulation_size()
+    sim.merge_graphs()
+    sim.write_lammps_files()
+    if options.profile:
+        profiler.write_json(options.profile)
+    if options.profile_trace:
+        profiler.write_trace(options.profile_trace)
+
+    return {'natoms': sim.graph.number_of_nodes(),
+            'supercell': [int(i) for i in sim.supercell],
+            'force_field': options.force_field,
+            'timings': profiler.totals(),
+            'profile': profiler.report()}
+
+
+def _worker(cif_file, wd, args, memory):
+    """Entry point of the child process, the result is written to
+    result.json in the working directory.
+
+    """
+    os.chdir(wd)
+    log = open("log", 'w')
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(log.fileno(), 1)
+    os.dup2(log.fileno(), 2)
+    # no one is around to answer a prompt.
+    sys.stdin = open(os.devnull, 'r')
+    if memory and resource is not None:
+        nbytes = int(memory*1024*1024)
+        resource.setrlimit(resource.RLIMIT_AS, (nbytes, nbytes))
+
+    result = {'status': 'ok', 'error': None}
+    try:
+        result.update(run_structure(cif_file, args))
+    except MemoryError:
+        result['status'] = 'memory'
+        result['error'] = "memory limit of %.0f MB exceeded"%(memory)
+    except SystemExit as e:
+        result['status'] = 'failed'
+        result['error'] = "exited with %s"%(e.code)
+    except BaseException as e:
+        result['status'] = 'failed'
+        result['error'] = "%s: %s"%(e.__class__.__name__, e)
+        traceback.print_exc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with open("result.json", 'w') as f:
+        json.dump(result, f)
+
+
+def _directory_name(cif_file, used):
+    name = clean(cif_file)
+    dirname, count = name, 1
+    while dirname in used:
+        count += 1
+        dirname = "%s_%i"%(name, count)
+    used.add(dirname)
+    return dirname
+
+
+def _collect(record, process, wd):
+    try:
+        with open(os.path.join(wd, "result.json"), 'r') as f:
+            record.update(json.load(f))
+    except (IOError, OSError, ValueError):
+        record['status'] = 'crashed'
+        record['error'] = "process ended with exit code %s"%(process.exitcode)
+
+
+def run_batch(cif_files, output_dir, args=(), jobs=1, timeout=None, memory=None):
+    """Process cif files with up to 'jobs' concurrent processes.
+
+    timeout is the wall time in seconds allowed for each structure, and
+    memory the address space limit in MB of each process. Output of each
+    structure is written to its own sub directory of output_dir.
+
+    returns the list of summary records, which is also written to
+    output_dir/summary.json
+    """
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    args = BATCH_POLICY + list(args)
+    used = set()
+    records = []
+    for cif in cif_files:
+        name = _directory_name(cif, used)
+        wd = os.path.join(output_dir, name)
+        if not os.path.isdir(wd):
+            os.makedirs(wd)
+        records.append({'name': name, 'cif_file': cif, 'directory': wd,
+                        'status': None, 'error': None})
+    pending = records[::-1]
+
+    running = []
+    while pending or running:
+        while pending and len(running) < jobs:
+            record = pending.pop()
+            process = Process(target=_worker, args=(record['cif_file'], record['directory'],
+                                                    args, memory))
+            process.start()
+            running.append((record, process, time.time()))
+
+        still_running = []
+        for record, process, start in running:
+            elapsed = time.time() - start
+            if not process.is_alive():
+                process.join()
+                _collect(record, process, record['directory'])
+            elif timeout is not None and elapsed > timeout:
+                process.terminate()
+                process.join()
+                record['status'] = 'timeout'
+                record['error'] = "exceeded %.1f seconds"%(timeout)
+            else:
+                still_running.append((record, process, start))
+                continue
+            record['wall_time'] = elapsed
+            print("%-10s %s (%.1f s)"%(record['status'], record['name'], elapsed))
+        running = still_running
+        if running:
+            time.sleep(0.05)
+
+    with open(os.path.join(output_dir, "summary.json"), 'w') as f:
+        json.dump(records, f, indent=2)
+    return records
+
+
+def _render_structure(cell, graph, cif_file, args):
+    """Entry point of the pipeline processes, runs lammps_interface on a
+    structure read by a reader thread.
+
+    returns the rendered files and the result record.
+    """
+    from .InputHandler import Options
+    from .lammps_main import LammpsSimulation
+    from .structure_data import write_RASPA_CIF, write_RASPA_sim_files
+    from .profiling import Profiler, NULL_PROFILER
+
+    stdout = sys.stdout
+    sys.stdout = log = io.StringIO()
+    files = {}
+    result = {'status': 'ok', 'error': None}
+    try:
+        options = Options(list(args) + [cif_file])
+        profiler = NULL_PROFILER
+        if options.profile or options.profile_trace:
+            profiler = Profiler(trace_memory=options.profile_memory,
+                                count_objects=options.profile_memory)
+        sim = LammpsSimulation(options)
+        sim.profiler = profiler
+        sim.set_cell(cell)
+        sim.set_graph(graph)
+        sim.split_graph()
+        sim.assign_force_fields()
+        sim.compute_simulation_size()
+        sim.merge_graphs()
+        files = sim.render_lammps_files()
+        if options.output_raspa:
+            # the RASPA files are written to the working directory
+            cwd, tmpdir = os.getcwd(), tempfile.mkdtemp()
+            try:
+                os.chdir(tmpdir)
+                write_RASPA_CIF(graph, cell, 1)
+                write_RASPA_sim_files(sim, 1)
+                for name in os.listdir(tmpdir):
+                    with open(name, 'r') as f:
+                        files[name] = f.read()
+            finally:
+                os.chdir(cwd)
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        result.update({'natoms': sim.graph.number_of_nodes(),
+                       'supercell': [int(i) for i in sim.supercell],
+                       'force_field': options.force_field,
+                       'timings': profiler.totals(),
+                       'profile': profiler.report()})
+    except SystemExit as e:
+        result['status'] = 'failed'
+        result['error'] = "exited with %s"%(e.code)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = "%s: %s"%(e.__class__.__name__, e)
+        traceback.print_exc(file=log)
+    finally:
+        sys.stdout = stdout
+    files['log'] = log.getvalue()
+    return files, result
+
+
+def run_pipeline(cif_files, output_dir, args=(), jobs=1, readers=2, writers=2, queue_size=None):
+    """Process cif files with 'readers' threads parsing the cif files,
+    'jobs' processes assigning the force fields and 'writers' threads
+    writing the files. queue_size is the number of structures allowed
+    to wait between two stages, by default 2*jobs.
+
+    returns the list of summary records, which is also written to
+    output_dir/summary.json
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    from .structure_data import from_CIF
+
+    output_dir = os.path.abspath(output_dir)
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    if queue_size is None:
+        queue_size = 2*jobs
+    args = BATCH_POLICY + list(args)
+    used = set()
+    records = []
+    todo = queue.Queue()
+    for cif in cif_files:
+        name = _directory_name(cif, used)
+        record = {'name': name, 'cif_file': cif, 'directory': os.path.join(output_dir, name),
+                  'status': None, 'error': None}
+        records.append(record)
+        todo.put(record)
+    parsed = queue.Queue(maxsize=queue_size)
+    rendered = queue.Queue(maxsize=queue_size)
+    # at most queue_size structures wait in the pool besides the running ones.
+    slots = threading.Semaphore(jobs + queue_size)
+
+    def read():
+        while True:
+            try:
+                record = todo.get_nowait()
+            except queue.Empty:
+                return
+            record['start'] = time.time()
+            try:
+                parsed.put((record, from_CIF(record['cif_file'])))
+            except Exception as e:
+                record['status'] = 'failed'
+                record['error'] = "%s: %s"%(e.__class__.__name__, e)
+                rendered.put((record, {}))
+
+    def write():
+        while True:
+            item = rendered.get()
+            if item is None:
+                return
+            record, files = item
+            if not os.path.isdir(record['directory']):
+                os.makedirs(record['directory'])
+            for name, content in files.items():
+                with open(os.path.join(record['directory'], name), 'w') as f:
+                    f.write(content)
+            record['wall_time'] = time.time() - record.pop('start')
+            result = {k: v for k, v in record.items() if k not in ('name', 'cif_file', 'directory')}
+            with open(os.path.join(record['directory'], "result.json"), 'w') as f:
+                json.dump(result, f)
+            print("%-10s %s (%.1f s)"%(record['status'], record['name'], record['wall_time']))
+
+    def rendered_callback(record):
+        def callback(future):
+            slots.release()
+            try:
+                files, result = future.result()
+            except Exception as e:
+                # eg. the process was killed
+                files, result = {}, {'status': 'crashed',
+                                     'error': "%s: %s"%(e.__class__.__name__, e)}
+            record.update(result)
+            rendered.put((record, files))
+        return callback
+
+    reader_threads = [threading.Thread(target=read) for i in range(readers)]
+    writer_threads = [threading.Thread(target=write) for i in range(writers)]
+    for thread in reader_threads + writer_threads:
+        thread.daemon = True
+        thread.start()
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            try:
+                record, (cell, graph) = parsed.get(timeout=0.1)
+            except queue.Empty:
+                if not any(t.is_alive() for t in reader_threads) and parsed.empty():
+                    break
+                continue
+            slots.acquire()
+            future = pool.submit(_render_structure, cell, graph, record['cif_file'], args)
+            future.add_done_callback(rendered_callback(record))
+    for thread in writer_threads:
+        rendered.put(None)
+    for thread in writer_threads:
+        thread.join()
+
+    with open(os.path.join(output_dir, "summary.json"), 'w') as f:
+        json.dump(records, f, indent=2)
+    return records
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Run lammps_interface on many structures",
+                            prog="lammps_interface.batch")
+    parser.add_argument("inputs", nargs="+",
+                        help="directories, glob patterns, cif files or manifest "+
+                             "files (one cif path per line, or a json list).")
+    parser.add_argument("-o", "--output-dir", dest="output_dir",
+                        default="batch_output",
+                        help="Directory in which a sub directory is created for "+
+                             "each structure. Default is batch_output.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of structures to process at the same time. Default is 1.")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="Wall time in seconds allowed for each structure.")
+    parser.add_argument("--memory", type=float, default=None,
+                        help="Memory limit in MB for each structure. Options "+
+                             "for lammps_interface are given after a '--'.")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="Read, compute and write different structures at the "+
+                             "same time with reader threads, JOBS processes and "+
+                             "writer threads. --timeout and --memory are ignored.")
+    parser.add_argument("--readers", type=int, default=2,
+                        help="Number of threads reading cif files with --pipeline. Default is 2.")
+    parser.add_argument("--writers", type=int, default=2,
+                        help="Number of threads writing files with --pipeline. Default is 2.")
+    parser.add_argument("--queue-size", type=int, default=None, dest="queue_size",
+                        help="Number of structures waiting between the stages of "+
+                             "--pipeline. Default is 2*JOBS.")
+    if argv is None:
+        argv = sys.argv[1:]
+    # everything after '--' is passed on to lammps_interface
+    lammps_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, lammps_args = argv[:split], argv[split+1:]
+    args = parser.parse_args(argv)
+
+    cifs = find_structures(args.inputs)
+    if not cifs:
+        print("No structures found!")
+        sys.exit(1)
+    if args.pipeline:
+        records = run_pipeline(cifs, args.output_dir, lammps_args, jobs=args.jobs,
+                               readers=args.readers, writers=args.writers,
+                               queue_size=args.queue_size)
+    else:
+        records = run_batch(cifs, args.output_dir, lammps_args, jobs=args.jobs,
+                            timeout=args.timeout, memory=args.memory)
+    nok = len([r for r in records if r['status'] == 'ok'])
+    print("%i of %i structures completed. Summary written to %s"%(
+          nok, len(records), os.path.join(os.path.abspath(args.output_dir), "summary.json")))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+Spatial decomposition of the box over MPI ranks.
+
+LAMMPS splits the box into a grid of equal sub domains (in fractional
+coordinates for triclinic boxes), which for porous frameworks leaves
+the ranks covering the pores with few atoms. For a number of ranks,
+every processor grid is scored on the atoms per rank it would give,
+with the uniform grid and after 'balance shift', which moves the cuts
+along each dimension so that the slabs hold equal numbers of atoms.
+When no grid can be balanced this way, recursive coordinate bisection
+(rcb, comm_style tiled) is suggested for orthogonal boxes.
+
+The imbalance is the largest number of atoms on a rank over the mean,
+the quantity LAMMPS balances on.
+"""
+import numpy as np
+
+# imbalance threshold given to the balance commands
+THRESHOLD = 1.1
+# grids within this fraction of the best imbalance are ranked on their
+# surface, the amount of communication.
+TOLERANCE = 0.02
+DIMENSIONS = "xyz"
+
+
+def processor_grids(nranks):
+    """All (px, py, pz) with px*py*pz = nranks."""
+    grids = []
+    for px in range(1, nranks+1):
+        if nranks % px:
+            continue
+        for py in range(1, nranks//px + 1):
+            if (nranks//px) % py:
+                continue
+            grids.append((px, py, nranks//px//py))
+    return grids
+
+
+def _counts(frac, edges):
+    counts, _ = np.histogramdd(frac, bins=edges)
+    return counts
+
+
+def uniform_edges(grid):
+    return [np.linspace(0., 1., p+1) for p in grid]
+
+
+def shift_edges(frac, grid):
+    """Cuts along each dimension at the quantiles of the atom density,
+    as 'balance shift' would place them.
+
+    """
+    edges = []
+    for i, p in enumerate(grid):
+        cuts = np.percentile(frac[:, i], np.linspace(0., 100., p+1))
+        cuts[0], cuts[-1] = 0., 1.
+        # atoms sharing a coordinate could give empty slabs
+        edges.append(np.maximum.accumulate(cuts) + np.arange(p+1)*1e-9)
+    return edges
+
+
+def imbalance(counts):
+    counts = np.asarray(counts, dtype=np.float64)
+    return counts.max()/counts.mean()
+
+
+def rcb_counts(frac, widths, nranks):
+    """Atoms per rank of a recursive coordinate bisection, cutting the
+    longest side of each sub domain so that the two halves hold atoms
+    in proportion to their ranks.
+
+    """
+    counts = []
+    stack = [(frac, np.zeros(3), np.ones(3), nranks)]
+    while stack:
+        points, lo, hi, n = stack.pop()
+        if n == 1:
+            counts.append(len(points))
+            continue
+        dim = int(np.argmax((hi - lo)*widths))
+        nlow = n//2
+        order = np.argsort(points[:, dim], kind='mergesort')
+        split = int(round(len(points)*float(nlow)/n))
+        if 0 < split < len(points):
+            cut = 0.5*(points[order[split-1], dim] + points[order[split], dim])
+        else:
+            cut = 0.5*(lo[dim] + hi[dim])
+        upper, lower = hi.copy(), lo.copy()
+        upper[dim], lower[dim] = cut, cut
+        stack.append((points[order[:split]], lo, upper, nlow))
+        stack.append((points[order[split:]], lower, hi, n - nlow))
+    return counts
+
+
+class Decomposition(object):
+    """The suggested processor grid and balancing for a number of ranks,
+    with the predicted imbalance of each option.
+
+    """
+    def __init__(self, nranks, grid, uniform, shifted, rcb=None):
+        self.nranks = nranks
+        self.grid = grid
+        self.uniform = uniform
+        self.shifted = shifted
+        self.rcb = rcb
+        if self.uniform <= THRESHOLD:
+            self.style = None
+        elif rcb is not None and shifted > THRESHOLD and rcb < shifted:
+            self.style = 'rcb'
+        else:
+            self.style = 'shift'
+
+    @property
+    def predicted(self):
+        return {None: self.uniform, 'shift': self.shifted, 'rcb': self.rcb}[self.style]
+
+    def balance_args(self):
+        """Arguments of the balance command (and of fix balance, after
+        its nevery), None if the uniform grid is balanced enough.
+
+        """
+        if self.style == 'rcb':
+            return "%.1f rcb"%(THRESHOLD)
+        if self.style == 'shift':
+            dims = "".join([d for d, p in zip(DIMENSIONS, self.grid) if p > 1])
+            return "%.1f shift %s 20 1.0"%(THRESHOLD, dims)
+        return None
+
+    def __repr__(self):
+        return "%i ranks: %i x %i x %i grid, imbalance %.2f uniform, %.2f shift%s"%(
+            (self.nranks,) + tuple(self.grid) + (self.uniform, self.shifted,
+            ", %.2f rcb"%(self.rcb) if self.rcb is not None else ""))
+
+
+def suggest_decomposition(frac, cell, nranks):
+    """Processor grid and balancing for the atoms with fractional
+    coordinates frac in the box with vectors in the rows of cell.
+
+    returns a Decomposition
+    """
+    frac = np.asarray(frac, dtype=np.float64) % 1.0
+    cell = np.asarray(cell, dtype=np.float64)
+    volume = abs(np.linalg.det(cell))
+    widths = np.array([volume/np.linalg.norm(np.cross(cell[(i+1)%3], cell[(i+2)%3]))
+                       for i in range(3)])
+    scores = []
+    for grid in processor_grids(nranks):
+        sub = widths/np.array(grid)
+        surface = sub[0]*sub[1] + sub[1]*sub[2] + sub[0]*sub[2]
+        uniform = imbalance(_counts(frac, uniform_edges(grid)))
+        shifted = imbalance(_counts(frac, shift_edges(frac, grid)))
+        scores.append((shifted, uniform, surface, grid))
+    best = min([s[0] for s in scores])
+    shifted, uniform, surface, grid = min([s for s in scores if s[0] <= best*(1. + TOLERANCE)],
+                                          key=lambda s: (s[2], s[0]))
+    rcb = None
+    # comm_style tiled does not support triclinic boxes
+    if np.allclose(cell - np.diag(np.diag(cell)), 0.):
+        rcb = imbalance(rcb_counts(frac, widths, nranks))
+    return Decomposition(nranks, grid, uniform, shifted, rcb)
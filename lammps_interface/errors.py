@@ -0,0 +1,25 @@
+"""
+Exceptions raised by lammps_interface.
+
+The command line interface prints the message and exits, when used as a
+library these can be caught to handle a failed structure.
+"""
+
+
+class LammpsInterfaceError(Exception):
+    """Base class of the errors raised by lammps_interface."""
+
+
+class OptionsError(LammpsInterfaceError):
+    """An option has an invalid or unrecognized value."""
+
+
+class StructureError(LammpsInterfaceError):
+    """The structure could not be read or interpreted."""
+
+
+class ForceFieldError(LammpsInterfaceError):
+    """The requested force field cannot describe the structure,
+    eg. missing atom types or parameters.
+
+    """
@@ -0,0 +1,204 @@
+"""
+Choice of the long range coulomb solver and of its parameters.
+
+The real space splitting parameter, the number of k vectors of the
+Ewald sum and the PPPM mesh are estimated with the same error formulas
+LAMMPS uses (ewald.cpp and pppm.cpp, real units), for a target relative
+accuracy of the forces. With the 'auto' style the solver with the
+fewest operations per step is chosen:
+
+    ewald   natoms * number of k vectors
+    pppm    charge assignment and force interpolation on order^3 points
+            per atom, and four FFTs of the mesh
+
+so Ewald is kept for small boxes and PPPM is used as the system grows.
+"""
+import math
+import numpy as np
+
+from .errors import OptionsError
+
+# conversion of q^2/r to kcal/mol (LAMMPS real units)
+QQR2E = 332.06371
+# the default pppm interpolation order in LAMMPS
+ORDER = 5
+# coefficients of the ik-differentiated pppm error for ORDER (acons in pppm.cpp)
+ACONS = (1./23232., 7601./13628160., 143./69120., 517231./106536960.,
+         106640677./11737571328.)
+
+STYLES = ('auto', 'ewald', 'pppm', 'pppm/disp', 'msm')
+
+# pair styles which have to change with the solver
+MSM_PAIR_STYLES = {"lj/cut/coul/long": "lj/cut/coul/msm",
+                   "lj/charmm/coul/long": "lj/charmm/coul/msm",
+                   "buck/coul/long": "buck/coul/msm"}
+DISPERSION_PAIR_STYLES = {"lj/cut/coul/long": "lj/long/coul/long",
+                          "buck/coul/long": "buck/long/coul/long"}
+# the keyword of tabulated pair styles telling lammps which solver they go with
+TABLE_KEYWORDS = {"ewald": "ewald", "pppm": "pppm", "pppm/tip4p": "pppm",
+                  "pppm/disp": "pppm", "msm": "msm"}
+
+
+class KspaceSettings(object):
+    """The chosen solver, its accuracy and the estimated grid, which is
+    the number of k vectors for ewald and the mesh for pppm.
+
+    """
+    def __init__(self, style, accuracy, g_ewald=None, grid=None):
+        self.style = style
+        self.accuracy = accuracy
+        self.g_ewald = g_ewald
+        self.grid = grid
+
+    def kspace_style(self):
+        return "%s %g"%(self.style, self.accuracy)
+
+    def kspace_modify(self):
+        """Arguments of the kspace_modify commands for these settings."""
+        lines = []
+        if self.grid is None:
+            return lines
+        if self.style == "ewald":
+            lines.append("kmax/ewald %i %i %i"%tuple(self.grid))
+        else:
+            lines.append("mesh %i %i %i order %i"%(tuple(self.grid) + (ORDER,)))
+        if self.style == "pppm/disp":
+            # recommended in the lammps documentation, the defaults
+            # are far more accurate than needed for dispersion.
+            lines.append("force/disp/real 0.0001 force/disp/kspace 0.002")
+        return lines
+
+    def __repr__(self):
+        return "%s g_ewald=%s grid=%s"%(self.kspace_style(), self.g_ewald, self.grid)
+
+
+def perpendicular_widths(cell):
+    """Distances between opposite faces of the box with vectors in the
+    rows of cell.
+
+    """
+    cell = np.asarray(cell, dtype=np.float64)
+    volume = abs(np.linalg.det(cell))
+    return np.array([volume/np.linalg.norm(np.cross(cell[(i+1)%3], cell[(i+2)%3]))
+                     for i in range(3)])
+
+
+def estimate_g_ewald(accuracy, natoms, q2, cutoff, volume):
+    """Splitting parameter for which the real space error at the cutoff
+    is 'accuracy' (absolute, kcal/mol/A).
+
+    """
+    g_ewald = accuracy*math.sqrt(natoms*cutoff*volume)/(2.0*q2)
+    if g_ewald >= 1.0:
+        return (1.35 - 0.15*math.log(accuracy))/cutoff
+    return math.sqrt(-math.log(g_ewald))/cutoff
+
+
+def _ewald_rms(km, prd, natoms, q2, g_ewald):
+    return 2.0*q2*g_ewald/prd*math.sqrt(1.0/(math.pi*km*natoms)) * \
+           math.exp(-math.pi**2*km**2/(g_ewald**2*prd**2))
+
+
+def ewald_kmax(accuracy, natoms, q2, g_ewald, widths):
+    """Number of k vectors along each direction of the Ewald sum."""
+    kmax = []
+    for prd in widths:
+        km = 1
+        while _ewald_rms(km, prd, natoms, q2, g_ewald) > accuracy:
+            km += 1
+        kmax.append(km)
+    return kmax
+
+
+def _factorable(n):
+    """Smallest mesh size >= n made of the factors 2, 3 and 5."""
+    while True:
+        m = n
+        for f in (2, 3, 5):
+            while m % f == 0:
+                m //= f
+        if m == 1:
+            return n
+        n += 1
+
+
+def _pppm_error(h, prd, natoms, q2, g_ewald):
+    s = sum([ACONS[m]*(h*g_ewald)**(2*m) for m in range(ORDER)])
+    return q2*(h*g_ewald)**ORDER*math.sqrt(g_ewald*prd*math.sqrt(2.0*math.pi)*s/natoms)/prd**2
+
+
+def pppm_mesh(accuracy, natoms, q2, g_ewald, widths):
+    """Mesh points along each direction, refined from a spacing of
+    4/g_ewald until the k-space error is below 'accuracy'.
+
+    """
+    h = 4.0/g_ewald
+    while True:
+        mesh = [_factorable(int(prd/h) + 1) for prd in widths]
+        error = math.sqrt(sum([_pppm_error(prd/n, prd, natoms, q2, g_ewald)**2
+                               for prd, n in zip(widths, mesh)])/3.0)
+        if error <= accuracy:
+            return mesh
+        h *= 0.95
+
+
+def ewald_cost(natoms, kmax):
+    # k vectors in half of the ellipsoid, as in ewald.cpp
+    return natoms*2.0*math.pi/3.0*np.prod(kmax)
+
+
+def pppm_cost(natoms, mesh):
+    points = float(np.prod(mesh))
+    return 2.0*natoms*ORDER**3 + 4.0*points*math.log(points, 2)
+
+
+def choose_kspace(natoms, qsqsum, cell, cutoff, accuracy=1e-6, style='auto', tip4p=False):
+    """Choose the solver and estimate its grid for natoms with a sum of
+    squared charges qsqsum in the box with vectors in the rows of cell.
+    accuracy is relative to the force between two unit charges 1 A
+    apart. TIP4P water models need pppm/tip4p.
+
+    returns a KspaceSettings
+    """
+    if style not in STYLES:
+        raise OptionsError("Unknown kspace style %s, choose from %s"%(style, ", ".join(STYLES)))
+    if tip4p and style not in ('auto', 'pppm'):
+        raise OptionsError("TIP4P water models can only be used with the pppm kspace style.")
+    if style == 'msm':
+        # multilevel summation has no grid estimate of this kind,
+        # lammps picks the number of levels.
+        return KspaceSettings(style, accuracy)
+
+    widths = perpendicular_widths(cell)
+    volume = abs(np.linalg.det(np.asarray(cell, dtype=np.float64)))
+    q2 = qsqsum*QQR2E
+    absolute = accuracy*QQR2E
+    g_ewald = estimate_g_ewald(absolute, natoms, q2, cutoff, volume)
+    mesh = pppm_mesh(absolute, natoms, q2, g_ewald, widths)
+    if style == 'auto':
+        kmax = ewald_kmax(absolute, natoms, q2, g_ewald, widths)
+        if not tip4p and ewald_cost(natoms, kmax) < pppm_cost(natoms, mesh):
+            return KspaceSettings('ewald', accuracy, g_ewald, kmax)
+        style = 'pppm'
+    elif style == 'ewald':
+        return KspaceSettings(style, accuracy, g_ewald,
+                              ewald_kmax(absolute, natoms, q2, g_ewald, widths))
+    if tip4p:
+        style = 'pppm/tip4p'
+    return KspaceSettings(style, accuracy, g_ewald, mesh)
+
+
+def set_pair_styles(potentials, style):
+    """Rename the long range pair potentials and tabulated potentials
+    for the solver 'style': coul/msm for msm and long range dispersion
+    for pppm/disp.
+
+    """
+    for pot in potentials:
+        if pot.name == "table":
+            pot.keyword = TABLE_KEYWORDS[style]
+        elif style == 'msm' and pot.name in MSM_PAIR_STYLES:
+            pot.name = MSM_PAIR_STYLES[pot.name]
+        elif style == 'pppm/disp' and pot.name in DISPERSION_PAIR_STYLES:
+            pot.name = DISPERSION_PAIR_STYLES[pot.name]
+            pot.flags = "long long"
@@ -16,9 +16,18 @@ from .structure_data import write_RASPA_CIF, write_RASPA_sim_files, MDMC_config
 from .CIFIO import CIF
 from .ccdc import CCDC_BOND_ORDERS
 from datetime import datetime
-from .InputHandler import Options
-from copy import deepcopy
+from .InputHandler import Options, INPUT_FILE_OPTIONS
+from copy import copy, deepcopy
+from .pair_table import PairTable
+from .errors import LammpsInterfaceError, OptionsError, StructureError, ForceFieldError
+from .profiling import Profiler, NULL_PROFILER, profiled
 from . import Molecules
+from . import kspace
+from . import ordering
+from . import decomposition
+from . import accelerators
+from . import stiffness
+from .table_cache import table_cache
 
 
 if sys.version_info < (3, 0):
@@ -27,7 +36,9 @@ if sys.version_info < (3, 0):
 
 class LammpsSimulation(object):
     def __init__(self, options):
+        check_force_fields(options)
         self.name = clean(options.cif_file)
+        self.data_name = self.name # the data file read by the input file
         self.special_commands = []
         self.options = options
         self.molecules = []
@@ -45,14 +56,26 @@ class LammpsSimulation(object):
         self.improper_ff_type = {}
         self.unique_pair_types = {}
         self.pair_in_data = True
+        self.pair_table = None
         self.separate_molecule_types = True
         self.framework = True # Flag if a framework exists in the simulation.
         self.supercell = (1, 1, 1) # keep track of supercell size
+        self.replicate = None # supercell built by lammps instead
+        self.image_flags = {}
+        self.periodic_bonds = False
         self.type_molecules = {}
         self.no_molecule_pair = True  # ensure that h-bonding will not occur between molecules of the same type
         self.fix_shake = {}
         self.fix_rigid = {}
+        self.auxiliary_files = {}
+        self.profiler = NULL_PROFILER
         self.kspace_style = False
+        self.kspace = None
+        self.timestep = 1.0 # fs
+        self.rigid_bodies = [] # atoms of each rigid SBU or linker
+        self.respa = None
+        self.table_cache = table_cache(options.table_cache)
+        self.fix_counter = 0
 
     def set_MDMC_config(self, MDMC_config):
         self.MDMC_config = MDMC_config
@@ -81,9 +104,8 @@ class LammpsSimulation(object):
         moltemplate = ("Molecules" in "%s"%g.__class__)
         mainstructr = ("structure_data" in "%s"%g.__class__)
         if (moltemplate and mainstructr):
-            print("ERROR: there is some confusion about class assignment with "+
+            raise LammpsInterfaceError("ERROR: there is some confusion about class assignment with "+
                   "MolecularGraphs.  You should probably contact one of the developers.")
-            sys.exit()
 
         for node, data in g.nodes_iter2(data=True):
             if self.separate_molecule_types and molecule_nodes and mainstructr:
@@ -126,7 +148,8 @@ class LammpsSimulation(object):
         """Computes the number of unique bonds in the structure"""
         count = len(self.unique_bond_types)
         for n1, n2, data in g.edges_iter2(data=True):
-            btype = "%s"%data['potential']
+            # constrained bonds get their own type
+            btype = ("%s"%data['potential'], getattr(data['potential'], 'special_flag', ""))
 
             try:
                 type = self.bond_ff_type[btype]
@@ -153,7 +176,7 @@ class LammpsSimulation(object):
                 ang_data = data['angles']
 
                 for (a, c), val in ang_data.items():
-                    atype = "%s"%val['potential']
+                    atype = ("%s"%val['potential'], getattr(val['potential'], 'special_flag', ""))
                     try:
                         type = self.angle_ff_type[atype]
 
@@ -181,7 +204,7 @@ class LammpsSimulation(object):
             try:
                 dihed_data = data['dihedrals']
                 for (a, d), val in dihed_data.items():
-                    dtype = "%s"%val['potential']
+                    dtype = ("%s"%val['potential'], getattr(val['potential'], 'special_flag', ""))
                     try:
                         type = dihedral_type[dtype]
                     except KeyError:
@@ -205,7 +228,7 @@ class LammpsSimulation(object):
                 imp_data = data['impropers']
                 for (a, c, d), val in imp_data.items():
                     if val['potential'] is not None:
-                        itype = "%s"%val['potential']
+                        itype = ("%s"%val['potential'], getattr(val['potential'], 'special_flag', ""))
                         try:
                             type = self.improper_ff_type[itype]
                         except KeyError:
@@ -225,6 +248,7 @@ class LammpsSimulation(object):
                 # no improper terms associated with this atom
                 pass
 
+    @profiled
     def unique_pair_terms(self):
         pot_names = []
         nodes_list = sorted(self.unique_atom_types.keys())
@@ -240,6 +264,15 @@ class LammpsSimulation(object):
         table_str = ""
         if len(list(set(pot_names))) > 1 or (any(['buck' in i for i in list(set(pot_names))])):
             self.pair_in_data = False
+            potentials, labels = {}, {}
+            for i in nodes_list:
+                n, i_data = self.unique_atom_types[i]
+                potentials[i] = i_data['pair_potential']
+                try:
+                    labels[i] = self.graph.node[n]['force_field_type']
+                except KeyError:
+                    labels[i] = i_data['force_field_type']
+            self.pair_table = PairTable(nodes_list, potentials, labels)
             for (i, j) in itertools.combinations_with_replacement(nodes_list, 2):
                 (n1, i_data), (n2, j_data) = self.unique_atom_types[i], self.unique_atom_types[j]
                 mol1 = self.type_molecules[i]
@@ -247,46 +280,24 @@ class LammpsSimulation(object):
                 # test to see if h-bonding to occur between molecules
                 pairwise_test = ((mol1 != mol2 and self.no_molecule_pair) or (not self.no_molecule_pair))
                 if i_data['tabulated_potential'] and j_data['tabulated_potential']:
-                    table_pot = deepcopy(i_data)
-                    table_str += table_pot['table_function'](i_data,j_data, table_pot)
+                    table_pot = {'table_potential': copy(i_data['table_potential'])}
+                    table_str += i_data['table_function'](i_data,j_data, table_pot)
                     table_pot['table_potential'].filename = "table." + self.name
-                    self.unique_pair_types[(i, j, 'table')] = table_pot
+                    self.pair_table.add_entry((i, j, 'table'), i_data['pair_potential'],
+                                              table_potential=table_pot['table_potential'])
 
                 if (i_data['h_bond_donor'] and j_data['element'] in electro_neg_atoms and pairwise_test and not j_data['h_bond_donor']):
-                    hdata = deepcopy(i_data)
-                    hdata['h_bond_potential'] = hdata['h_bond_function'](n2, self.graph, flipped=False)
-                    hdata['tabulated_potential'] = False
-                    self.unique_pair_types[(i,j,'hb')] = hdata
+                    self.pair_table.add_entry((i, j, 'hb'), i_data['pair_potential'],
+                                              h_bond_potential=i_data['h_bond_function'](n2, self.graph, flipped=False))
                 if (j_data['h_bond_donor'] and i_data['element'] in electro_neg_atoms and pairwise_test and not i_data['h_bond_donor']):
-                    hdata = deepcopy(j_data)
-                    hdata['tabulated_potential'] = False
-                    hdata['h_bond_potential'] = hdata['h_bond_function'](n1, self.graph, flipped=True)
-                    self.unique_pair_types[(i,j,'hb')] = hdata
-                # mix Lorentz-Berthelot rules
-                pair_data = deepcopy(i_data)
-                if 'buck' in i_data['pair_potential'].name and 'buck' in j_data['pair_potential'].name:
-                    eps1 = i_data['pair_potential'].eps
-                    eps2 = j_data['pair_potential'].eps
-                    sig1 = i_data['pair_potential'].sig
-                    sig2 = j_data['pair_potential'].sig
-                    eps = np.sqrt(eps1*eps2)
-                    Rv = (sig1 + sig2)
-                    Rho = Rv/12.0
-                    A = 1.84e5 * eps
-                    C=2.25*(Rv)**6*eps
-
-                    pair_data['pair_potential'].A = A
-                    pair_data['pair_potential'].rho = Rho
-                    pair_data['pair_potential'].C = C
-                    pair_data['tabulated_potential'] = False
+                    self.pair_table.add_entry((i, j, 'hb'), j_data['pair_potential'],
+                                              h_bond_potential=j_data['h_bond_function'](n1, self.graph, flipped=True))
+                # mix Lorentz-Berthelot rules, or the buck rules.
+                pair_pot = self.pair_table.mixed(i, j)
+                if pair_pot is not None:
                     # assuming i_data has the same pair_potential name as j_data
-                    self.unique_pair_types[(i,j, i_data['pair_potential'].name)] = pair_data
-                elif 'lj' in i_data['pair_potential'].name and 'lj' in j_data['pair_potential'].name:
-
-                    pair_data['pair_potential'].eps = np.sqrt(i_data['pair_potential'].eps*j_data['pair_potential'].eps)
-                    pair_data['pair_potential'].sig = (i_data['pair_potential'].sig + j_data['pair_potential'].sig)/2.
-                    pair_data['tabulated_potential'] = False
-                    self.unique_pair_types[(i,j, i_data['pair_potential'].name)] = pair_data
+                    self.pair_table.add_entry((i, j, i_data['pair_potential'].name), pair_pot)
+            self.unique_pair_types = self.pair_table.entries
 
         # can be mixed by lammps
         else:
@@ -296,16 +307,15 @@ class LammpsSimulation(object):
                 self.unique_pair_types[b] = data
 
         if (table_str):
-            f = open('table.'+self.name, 'w')
-            f.writelines(table_str)
-            f.close()
+            self.auxiliary_files['table.'+self.name] = table_str
         return
 
+    @profiled
     def define_styles(self):
         # should be more robust, some of the styles require multiple parameters specified on these lines
         charges = not np.allclose(0.0, [float(self.graph.node[i]['charge']) for i in list(self.graph.nodes)], atol=0.00001)
         if(charges):
-            self.kspace_style = "ewald %f"%(0.000001)
+            self.define_kspace()
         bonds = set([j['potential'].name for n1, n2, j in list(self.unique_bond_types.values())])
         if len(list(bonds)) > 1:
             self.bond_style = "hybrid %s"%" ".join(list(bonds))
@@ -365,21 +375,69 @@ class LammpsSimulation(object):
             for p in list(self.unique_pair_types.values()):
                 p['pair_potential'].reduced = True
 
+    def define_kspace(self):
+        """Choose the kspace solver for the final box and make the long
+        range pair styles consistent with it.
+
+        """
+        charges = np.array([float(self.graph.node[i]['charge']) for i in self.graph.nodes()])
+        natoms, qsqsum, cell = len(charges), np.sum(charges**2), np.array(self.cell.cell)
+        if self.replicate is not None:
+            natoms *= int(np.prod(self.replicate))
+            qsqsum *= np.prod(self.replicate)
+            cell = cell*np.array(self.replicate)[:, None]
+        potentials = []
+        for data in self.unique_pair_types.values():
+            potentials.append(data['pair_potential'])
+            if data.get('tabulated_potential'):
+                potentials.append(data['table_potential'])
+        tip4p = any(['tip4p' in p.name for p in potentials])
+        self.kspace = kspace.choose_kspace(natoms, qsqsum, cell,
+                                           self.options.cutoff,
+                                           accuracy=self.options.kspace_accuracy,
+                                           style=self.options.kspace_style, tip4p=tip4p)
+        kspace.set_pair_styles(potentials, self.kspace.style)
+        self.kspace_style = self.kspace.kspace_style()
+        print("Using kspace_style %s"%(self.kspace_style))
+
+    @profiled
     def set_graph(self, graph):
         self.graph = graph
+        self.graph.profiler = self.profiler
 
         try:
-            if(not self.options.force_field == "UFF") and (not self.options.force_field == "Dreiding") and \
-                    (not self.options.force_field == "UFF4MOF"):
-                self.graph.find_metal_sbus = True # true for BTW_FF and Dubbeldam
-            if (self.options.force_field == "Dubbeldam"):
-                self.graph.find_organic_sbus = True
-
+            self.request_sbu_detection()
             self.graph.compute_topology_information(self.cell, self.options.tol, self.options.neighbour_size)
         except AttributeError:
             # no cell set yet
             pass
 
+    def request_sbu_detection(self):
+        """Flag the graph for the SBU detection needed by the force field."""
+        if(not self.options.force_field == "UFF") and (not self.options.force_field == "Dreiding") and \
+                (not self.options.force_field == "UFF4MOF"):
+            self.graph.find_metal_sbus = True # true for BTW_FF and Dubbeldam
+        if (self.options.force_field == "Dubbeldam"):
+            self.graph.find_organic_sbus = True
+
+    @profiled
+    def set_overlay_graph(self, graph):
+        """Use a graph whose topology has already been computed, typically
+        an overlay of a graph shared between several force fields (see
+        MolecularGraph.overlay). Only the SBU detection requested by this
+        force field is performed. The cell must be set first.
+
+        """
+        self.graph = graph
+        self.graph.profiler = self.profiler
+        self.graph.cell = self.cell
+        self.request_sbu_detection()
+        if (self.graph.find_metal_sbus):
+            self.graph.detect_clusters(self.options.neighbour_size, self.options.tol)
+        if (self.graph.find_organic_sbus):
+            self.graph.detect_clusters(self.options.neighbour_size, self.options.tol, type="Organic")
+
+    @profiled
     def set_cell(self, cell):
         self.cell = cell
         try:
@@ -388,6 +446,7 @@ class LammpsSimulation(object):
             # no graph set yet
             pass
 
+    @profiled
     def split_graph(self):
 
         self.compute_molecules()
@@ -435,11 +494,20 @@ class LammpsSimulation(object):
             type += 1
             self.molecule_types[type] = [j]
 
+    def framework_force_field(self, graph):
+        """Assign the force field of the framework to graph.
+
+        returns the ForceField object
+        """
+        attr = {'graph':graph, 'cutoff':self.options.cutoff, 'h_bonding':self.options.h_bonding,
+                'keep_metal_geometry':self.options.fix_metal, 'bondtype':self.options.dreid_bond_type,
+                'table_cache':self.table_cache}
+        return getattr(ForceFields, self.options.force_field)(**attr)
+
+    @profiled
     def assign_force_fields(self):
 
-        attr = {'graph':self.graph, 'cutoff':self.options.cutoff, 'h_bonding':self.options.h_bonding,
-                'keep_metal_geometry':self.options.fix_metal, 'bondtype':self.options.dreid_bond_type}
-        param = getattr(ForceFields, self.options.force_field)(**attr)
+        param = self.framework_force_field(self.graph)
 
         self.special_commands += param.special_commands()
 
@@ -466,14 +534,15 @@ class LammpsSimulation(object):
                       "set --molecule-ff=[some force field] on the command line.")
             h_bonding = False
             if (ff == "Dreiding"):
-                hbonding = input("Would you like this molecule type to have hydrogen donor potentials? [y/n]: ")
+                hbonding = self.options.molecule_h_bonding
+                if hbonding == 'ask':
+                    hbonding = input("Would you like this molecule type to have hydrogen donor potentials? [y/n]: ")
                 if hbonding.lower() in ['y', 'yes']:
                     h_bonding = True
                 elif hbonding.lower() in ['n', 'no']:
                     h_bonding = False
                 else:
-                    print("Unrecognized command: %s"%hbonding)
-                    sys.exit()
+                    raise OptionsError("Unrecognized command: %s"%hbonding)
             for m in self.molecule_types[mtype]:
                 # Water check
                 # currently only works if the cif file contains water particles without dummy atoms.
@@ -487,9 +556,86 @@ class LammpsSimulation(object):
                     self.add_co2_model(ngraph, ff)
                 p = getattr(ForceFields, mff)(graph=self.subgraphs[m],
                                          cutoff=self.options.cutoff,
-                                         h_bonding=h_bonding)
+                                         h_bonding=h_bonding,
+                                         table_cache=self.table_cache)
                 self.special_commands += p.special_commands()
 
+    def variant(self):
+        """Return a copy of the simulation whose framework can be edited
+        with remove_atoms, add_fragment and substitute_group. Variants
+        are made after assign_force_fields, and continue from
+        compute_simulation_size.
+
+        """
+        # the distance matrix is replaced, never modified, by the edits.
+        memo = {id(self.profiler): self.profiler}
+        if self.graph.distance_matrix is not None:
+            memo[id(self.graph.distance_matrix)] = self.graph.distance_matrix
+        return deepcopy(self, memo)
+
+    def check_editable(self):
+        if self.graph.find_metal_sbus or self.graph.find_organic_sbus:
+            raise ForceFieldError("Structures cannot be edited with the %s force field, "%(self.options.force_field)+
+                                  "which depends on the detection of SBUs.")
+
+    def remove_atoms(self, nodes):
+        """Remove framework atoms, see MolecularGraph.remove_atoms"""
+        self.check_editable()
+        self.reassign_force_field(self.graph.remove_atoms(nodes))
+
+    def add_fragment(self, elements, coordinates, charges=None):
+        """Add atoms to the framework, see MolecularGraph.add_fragment"""
+        self.check_editable()
+        self.reassign_force_field(self.graph.add_fragment(elements, coordinates, charges))
+
+    def substitute_group(self, nodes, elements, coordinates, charges=None):
+        """Replace framework atoms, see MolecularGraph.substitute_group"""
+        self.check_editable()
+        self.reassign_force_field(self.graph.substitute_group(nodes, elements, coordinates, charges))
+
+    @profiled
+    def reassign_force_field(self, region):
+        """Assign the force field again to the atoms near region, the
+        atoms whose topology was recomputed after an edit. The force
+        field is applied to a local graph of the neighbouring atoms, and
+        the atom types and terms centred on the atoms within one bond of
+        region are copied back to the framework.
+
+        """
+        graph = self.graph
+        edited = graph.neighbourhood(region, 1)
+        # enough atoms around the edited ones for their typing.
+        local = graph.local_graph(graph.neighbourhood(edited, 3))
+        for n, data in local.nodes_iter2(data=True):
+            if n in edited:
+                # typed again from the new topology
+                data['force_field_type'] = None
+            else:
+                data.pop('angles', None)
+                data.pop('impropers', None)
+        for n1, n2, data in local.edges_iter2(data=True):
+            if n1 not in edited and n2 not in edited:
+                data.pop('dihedrals', None)
+        param = self.framework_force_field(local)
+
+        # the pair style depends on the charges of the whole framework
+        charges = not np.allclose(0.0, [float(graph.node[i]['charge']) for i in graph.nodes()], atol=0.00001)
+        local_charges = not np.allclose(0.0, [float(local.node[i]['charge']) for i in local.nodes()], atol=0.00001)
+        for n in edited:
+            if charges != local_charges:
+                param.pair_terms(n, local.node[n], self.options.cutoff, charges=charges)
+            graph.node[n].clear()
+            graph.node[n].update(local.node[n])
+        for n1, n2, data in graph.edges_touching(edited):
+            if local.has_edge(n1, n2):
+                data.clear()
+                data.update(local[n1][n2])
+            else:
+                # no bond term in this force field
+                graph.sorted_edge_dict.pop((n1, n2), None)
+                graph.sorted_edge_dict.pop((n2, n1), None)
+                graph.remove_edge(n1, n2)
+
     def assign_molecule_ids(self, graph):
         for node in graph.nodes():
             graph.node[node]['molid'] = graph.molecule_id
@@ -539,22 +685,19 @@ class LammpsSimulation(object):
         # include atomic species that don't exist yet..
         self.template_molecule = molecule
         template_file = "%s.molecule"%molecule.__class__.__name__
-        file = open(template_file, 'w')
-        file.writelines(molecule.str(atom_types=self.atom_ff_type))
-        file.close()
+        self.auxiliary_files[template_file] = molecule.str(atom_types=self.atom_ff_type)
         print('Molecule template file written as %s'%template_file)
 
     def add_co2_model(self, ngraph, ff):
         size = ngraph.number_of_nodes()
         if size < 3 or size > 3:
-            print("Error: cannot assign %s "%(ff) +
+            raise StructureError("Error: cannot assign %s "%(ff) +
                   "to molecule of size %i, with "%(size)+
-                  "atoms (%s)"%(", ".join([ngraph.node[kk]['element'] for
-                                           kk in ngraph.nodes()])))
-            print("If this is a CO2 molecule with pre-existing "+
-                    "dummy atoms for a particular force field, "+
-                    "please remove them and re-run this code.")
-            sys.exit()
+                  "atoms (%s)\n"%(", ".join([ngraph.node[kk]['element'] for
+                                           kk in ngraph.nodes()]))+
+                  "If this is a CO2 molecule with pre-existing "+
+                  "dummy atoms for a particular force field, "+
+                  "please remove them and re-run this code.")
         for node in ngraph.nodes():
             if ngraph.node[node]['element'] == "C":
                 catom = ngraph.node[node]
@@ -601,14 +744,13 @@ class LammpsSimulation(object):
     def add_water_model(self, ngraph, ff):
         size = ngraph.number_of_nodes()
         if size < 3 or size > 3:
-            print("Error: cannot assign %s "%(ff) +
+            raise StructureError("Error: cannot assign %s "%(ff) +
                   "to molecule of size %i, with "%(size)+
-                  "atoms (%s)"%(", ".join([ngraph.node[kk]['element'] for
-                                           kk in ngraph.nodes()])))
-            print("If this is a water molecule with pre-existing "+
-                    "dummy atoms for a particular force field, "+
-                    "please remove them and re-run this code.")
-            sys.exit()
+                  "atoms (%s)\n"%(", ".join([ngraph.node[kk]['element'] for
+                                           kk in ngraph.nodes()]))+
+                  "If this is a water molecule with pre-existing "+
+                  "dummy atoms for a particular force field, "+
+                  "please remove them and re-run this code.")
         for node in ngraph.nodes():
             if ngraph.node[node]['element'] == "O":
                 oid = node
@@ -679,8 +821,11 @@ class LammpsSimulation(object):
                 graph = self.subgraphs[m]
                 graph.original_size += 1
 
+    @profiled
     def compute_simulation_size(self):
 
+        if self.options.rigid_sbus:
+            self.detect_rigid_bodies()
         if self.options.orthogonalize:
             if not (np.allclose(self.cell.alpha, 90., atol=1) and np.allclose(self.cell.beta, 90., atol=1) and\
                     np.allclose(self.cell.gamma, 90., atol=1)):
@@ -688,8 +833,28 @@ class LammpsSimulation(object):
                 print("WARNING: Orthogonalization of simulation cell requested. This can "+
                       "make simulation sizes incredibly large. I hope you know, what you "+
                       "are doing!")
-                transformation_matrix = self.cell.orthogonal_transformation()
-                self.graph.redefine_lattice(transformation_matrix, self.cell)
+                max_multiple = max(20, int(np.prod(self.cell.minimum_supercell(self.options.cutoff))))
+                transformation_matrix = self.cell.minimum_supercell_matrix(self.options.cutoff,
+                                            angle_tolerance=self.options.orthogonal_tolerance,
+                                            max_multiple=max_multiple)
+                if transformation_matrix is None:
+                    print("WARNING: no supercell of at most %i unit cells has angles within "%(max_multiple)+
+                          "%.1f degrees of 90, using an approximate orthogonal cell."%(
+                          self.options.orthogonal_tolerance))
+                    transformation_matrix = self.cell.orthogonal_transformation()
+                    self.graph.redefine_lattice(transformation_matrix, self.cell)
+                else:
+                    self.redefine_supercell(transformation_matrix)
+        elif self.options.smallest_supercell and self.options.replication is None:
+            transformation_matrix = self.cell.minimum_supercell_matrix(self.options.cutoff)
+            # only worth it with fewer atoms than the replicas along the cell vectors
+            if transformation_matrix is not None and \
+                    round(np.linalg.det(transformation_matrix)) < np.prod(self.cell.minimum_supercell(self.options.cutoff)):
+                if self.subgraphs:
+                    print("WARNING: the molecules are not replicated in a redefined "+
+                          "cell, replicating along the unit cell vectors instead.")
+                else:
+                    self.redefine_supercell(transformation_matrix)
         supercell = self.cell.minimum_supercell(self.options.cutoff)
         if np.any(np.array(supercell) > 1):
             print("WARNING: unit cell is not large enough to"
@@ -699,11 +864,20 @@ class LammpsSimulation(object):
             supercell = tuple(map(int, re.split('x| |, |,',self.options.replication)))
             if(len(supercell) != 3):
                 if(supercell[0] < 1 or supercell[1] < 1 or supercell[2] < 1):
-                    print("Incorrect supercell requested: %s\n"%(supercell))
-                    print("Use <ixjxk> format")
-                    print("Exiting...")
-                    sys.exit()
+                    raise OptionsError("Incorrect supercell requested: %s\n"%(supercell)+
+                                       "Use <ixjxk> format")
         self.supercell=supercell
+        if np.any(np.array(supercell) > 1) and self.options.lammps_replicate:
+            if self.subgraphs:
+                print("WARNING: the molecules cannot be replicated by LAMMPS, "+
+                      "building the supercell here instead.")
+            elif self.options.rigid_sbus:
+                print("WARNING: the rigid bodies need image flags across the supercell, "+
+                      "building the supercell here instead.")
+            else:
+                print("The %i x %i x %i supercell will be built by LAMMPS. "%(supercell))
+                self.replicate = supercell
+                return
         if np.any(np.array(supercell) > 1):
             print("Re-sizing to a %i x %i x %i supercell. "%(supercell))
 
@@ -716,49 +890,479 @@ class LammpsSimulation(object):
             for mtype in list(self.molecule_types.keys()):
                 # prompt for replication of this molecule in the supercell.
                 rep = self.subgraphs[self.molecule_types[mtype][0]]
-                response = input("Would you like to replicate molceule %i with atoms (%s) in the supercell? [y/n]: "%
-                        (mtype, ", ".join([rep.node[j]['element'] for j in rep.nodes()])))
+                response = self.options.replicate_molecules
+                if response == 'ask':
+                    response = input("Would you like to replicate molceule %i with atoms (%s) in the supercell? [y/n]: "%
+                            (mtype, ", ".join([rep.node[j]['element'] for j in rep.nodes()])))
                 if response in ['y', 'Y', 'yes']:
                     for m in self.molecule_types[mtype]:
                         self.subgraphs[m].build_supercell(supercell, self.cell, track_molecule=True, molecule_len=molcount)
             self.cell.update_supercell(supercell)
 
+    def redefine_supercell(self, transformation_matrix):
+        """Replace the framework by the supercell with the cell vectors
+        transformation_matrix . cell, see Cell.minimum_supercell_matrix
+
+        """
+        print("Supercell of %i unit cells with vectors %s in units of the unit cell."%(
+              int(round(np.linalg.det(transformation_matrix))), transformation_matrix.tolist()))
+        self.graph.redefine_lattice(transformation_matrix, self.cell, max_volume_change=None)
+
+    @profiled
     def merge_graphs(self):
         for mgraph in self.subgraphs:
             self.graph += mgraph
         for node in self.graph.nodes():
             data=self.graph.node[node]
-        if sorted(self.graph.nodes()) != [i+1 for i in range(len(self.graph.nodes()))]:
+        if self.options.sort_atoms != 'none':
+            print("Numbering the atoms along a %s curve."%(self.options.sort_atoms))
+            reorder_dic = self.curve_labels(self.options.sort_atoms)
+        elif sorted(self.graph.nodes()) != [i+1 for i in range(len(self.graph.nodes()))]:
             print("Re-labelling atom indices.")
             reorder_dic = {i:j+1 for (i, j) in zip(sorted(self.graph.nodes()), range(len(self.graph.nodes())))}
-            self.graph.reorder_labels(reorder_dic)
-            for mgraph in self.subgraphs:
-                mgraph.reorder_labels(reorder_dic)
+        else:
+            return
+        self.graph.reorder_labels(reorder_dic)
+        for mgraph in self.subgraphs:
+            mgraph.reorder_labels(reorder_dic)
 
-    def write_lammps_files(self, wd=None):
-        self.unique_atoms(self.graph)
-        self.unique_bonds(self.graph)
-        self.unique_angles(self.graph)
-        self.unique_dihedrals(self.graph)
-        self.unique_impropers(self.graph)
+    def generated_styles(self):
+        """Names of the styles written to the input file, the sub styles
+        of hybrid styles included.
+
+        returns a dictionary category -> set of style names
+        """
+        styles = {'pair': set(), 'bond': set(), 'angle': set(),
+                  'dihedral': set(), 'improper': set(), 'kspace': set()}
+        for data in self.unique_pair_types.values():
+            styles['pair'].add(data['pair_potential'].name)
+            if data.get('h_bond_potential') is not None:
+                styles['pair'].add(data['h_bond_potential'].name)
+            if data.get('tabulated_potential'):
+                styles['pair'].add(data['table_potential'].name)
+        for n1, n2, b in self.unique_bond_types.values():
+            styles['bond'].add(b['potential'].name)
+        for a, b, c, ang in self.unique_angle_types.values():
+            styles['angle'].add(ang['potential'].name)
+        for a, b, c, d, di in self.unique_dihedral_types.values():
+            styles['dihedral'].add(di['potential'].name)
+        for a, b, c, d, i in self.unique_improper_types.values():
+            styles['improper'].add(i['potential'].name)
+        if self.kspace is not None:
+            styles['kspace'].add(self.kspace.style)
+        return styles
+
+    def check_rigid_options(self):
+        """Raise an OptionsError if a rigid framework or rigid SBUs are
+        requested with options which change the box. These options only
+        enter the input file, so this is checked again for each input
+        file of a sweep.
+
+        """
+        changes_box = [flag for flag, value in (("--minimize", self.options.minimize),
+                                                ("--npt", self.options.npt),
+                                                ("--bulk-moduli", self.options.bulk_moduli),
+                                                ("--thermal-scaling", self.options.thermal_scaling))
+                       if value]
+        if self.options.rigid_framework and changes_box:
+            raise OptionsError("A rigid framework cannot follow the box changes of %s."%(
+                               ", ".join(changes_box)))
+        if self.options.rigid_sbus:
+            if self.options.rigid_framework:
+                changes_box.append("--rigid-framework")
+            if changes_box:
+                raise OptionsError("Rigid SBUs cannot be combined with %s."%(", ".join(changes_box)))
+
+    def drop_framework_terms(self):
+        """Remove the bonds, angles, dihedrals and impropers of the
+        framework atoms, which are not integrated with a rigid framework.
+
+        """
+        self.check_rigid_options()
+        if not self.subgraphs and not self.options.insert_molecule:
+            print("WARNING: no guest molecules found, nothing will move with a rigid framework.")
+        g = self.graph
+        guests = set()
+        for sub in self.subgraphs:
+            guests.update(sub.nodes())
+        for n, data in g.nodes_iter2(data=True):
+            if n not in guests:
+                data.pop('angles', None)
+                data.pop('impropers', None)
+        edges = [(n1, n2) for n1, n2 in g.edges() if n1 not in guests and n2 not in guests]
+        for n1, n2 in edges:
+            g.sorted_edge_dict.pop((n1, n2), None)
+            g.sorted_edge_dict.pop((n2, n1), None)
+            g.remove_edge(n1, n2)
+        print("Rigid framework: removed %i framework bonds and their angles, dihedrals "%(len(edges))+
+              "and impropers.")
+
+    def detect_rigid_bodies(self):
+        """Find the inorganic SBUs and organic clusters of the framework
+        (see MolecularGraph.detect_clusters) and mark their atoms with the
+        index of their rigid body. Clusters overlapping one found before
+        are skipped. The flags and SBUs found for the force field are
+        kept.
+
+        """
+        self.check_rigid_options()
+        g = self.graph
+        flags = {n: data['special_flag'] for n, data in g.nodes_iter2(data=True) if 'special_flag' in data}
+        found = (g.inorganic_sbus, g.organic_sbus)
+        g.inorganic_sbus, g.organic_sbus = {}, {}
+        g.detect_clusters(self.options.neighbour_size, self.options.tol, skip_found=True)
+        g.detect_clusters(self.options.neighbour_size, self.options.tol, type="Organic", skip_found=True)
+        clusters = [(name, nodes) for sbus in (g.inorganic_sbus, g.organic_sbus)
+                    for name in sorted(sbus.keys()) for nodes in sbus[name]]
+        g.inorganic_sbus, g.organic_sbus = found
+        for n, data in g.nodes_iter2(data=True):
+            data.pop('special_flag', None)
+            if n in flags:
+                data['special_flag'] = flags[n]
+
+        body = 0
+        self.rigid_body_sizes = {}
+        counts = {}
+        for name, nodes in clusters:
+            if any(['rigid_body' in g.node[n] for n in nodes]):
+                continue
+            body += 1
+            for n in nodes:
+                g.node[n]['rigid_body'] = body
+            self.rigid_body_sizes[body] = len(nodes)
+            counts[name] = counts.get(name, 0) + 1
+        if not body:
+            print("WARNING: no SBUs or organic clusters found, the framework stays fully flexible.")
+            return
+        print("Rigid bodies in the unit cell: %s"%(", ".join(["%i %s"%(counts[name], name)
+                                                             for name in sorted(counts.keys())])))
+
+    def assign_rigid_bodies(self):
+        """Give each copy of a rigid body in the simulation box its own
+        molecule id, and flag the bonds, angles, dihedrals and impropers
+        within a body as rigid, so that they get their own types and can
+        be deleted in the input file.
+
+        """
+        g = self.graph
+        seen = set()
+        broken = 0
+        for n in sorted(g.nodes()):
+            body = g.node[n].get('rigid_body')
+            if body is None or n in seen:
+                continue
+            instance = [n]
+            seen.add(n)
+            queue = [n]
+            while queue:
+                i = queue.pop()
+                for j in g.neighbors(i):
+                    if j not in seen and g.node[j].get('rigid_body') == body:
+                        seen.add(j)
+                        instance.append(j)
+                        queue.append(j)
+            # bodies bonded to their own periodic images can't be rigid
+            if len(instance) != self.rigid_body_sizes[body] or \
+                    g.image_flags(nodes=instance)[1]:
+                broken += 1
+                continue
+            self.rigid_bodies.append(sorted(instance))
+        if broken:
+            print("WARNING: %i clusters spanning the periodic boundaries are kept flexible."%(broken))
+
+        molid = max([data['molid'] for n, data in g.nodes_iter2(data=True)])
+        member = {}
+        for idx, body in enumerate(self.rigid_bodies):
+            molid += 1
+            for n in body:
+                g.node[n]['molid'] = molid
+                member[n] = idx
+        def rigid(*nodes):
+            return nodes[0] in member and all([member.get(n) == member[nodes[0]] for n in nodes])
+        for n1, n2, data in g.edges_iter2(data=True):
+            if rigid(n1, n2) and data.get('potential') is not None:
+                data['potential'].special_flag = 'rigid'
+            for (a, d), val in data.get('dihedrals', {}).items():
+                if rigid(a, n1, n2, d) and val.get('potential') is not None:
+                    val['potential'].special_flag = 'rigid'
+        for b, data in g.nodes_iter2(data=True):
+            for (a, c), val in data.get('angles', {}).items():
+                if rigid(a, b, c) and val.get('potential') is not None:
+                    val['potential'].special_flag = 'rigid'
+            for (a, c, d), val in data.get('impropers', {}).items():
+                if rigid(a, b, c, d) and val.get('potential') is not None:
+                    val['potential'].special_flag = 'rigid'
+        print("%i rigid bodies with %i atoms."%(len(self.rigid_bodies), len(member)))
+
+    def rigid_types(self):
+        """Bond, angle, dihedral and improper types within the rigid
+        bodies, as (style, type) for delete_bonds.
+
+        """
+        types = []
+        for style, unique in (("bond", self.unique_bond_types),
+                              ("angle", self.unique_angle_types),
+                              ("dihedral", self.unique_dihedral_types),
+                              ("improper", self.unique_improper_types)):
+            for key in sorted(unique.keys()):
+                nodes, data = unique[key][:-1], unique[key][-1]
+                if getattr(data['potential'], 'special_flag', None) == 'rigid' and \
+                        'rigid_body' in self.graph.node[nodes[0]]:
+                    types.append((style, key))
+        return types
+
+    def constrain_hydrogens(self, angles=False):
+        """Flag the bonds to hydrogen, and the H-X-H angles if asked for,
+        as SHAKE constraints. LAMMPS constrains clusters of a central atom
+        and at most three atoms bonded only to it, so hydrogens bonded to
+        more than one atom and atoms bonded to more than three hydrogens
+        are left flexible. Rigid molecules are skipped.
+
+        """
+        g = self.graph
+        rigid = set([sub.molecule_id for sub in self.subgraphs if sub.rigid])
+        partners = {}
+        for n1, n2, data in g.edges_iter2(data=True):
+            if data.get('potential') is None or g.node[n1].get('molid') in rigid:
+                continue
+            # atoms of rigid bodies can't be in SHAKE clusters
+            if 'rigid_body' in g.node[n1] or 'rigid_body' in g.node[n2]:
+                continue
+            for h, x in ((n1, n2), (n2, n1)):
+                if g.node[h]['element'] == "H":
+                    partners.setdefault(h, []).append(x)
+        clusters = {}
+        bridging = 0
+        for h, x in sorted(partners.items()):
+            if len(x) > 1 or len(partners.get(x[0], [h])) > 1:
+                bridging += 1
+                continue
+            x = x[0]
+            # H2, the lower label is the central atom
+            if x in partners and x > h:
+                continue
+            clusters.setdefault(x, []).append(h)
+        large = [x for x, hs in clusters.items() if len(hs) > 3]
+        for x in large:
+            del clusters[x]
+        nbonds, nangles = 0, 0
+        for x, hs in clusters.items():
+            for h in hs:
+                g[x][h]['potential'].special_flag = 'shake'
+                nbonds += 1
+            if angles and len(hs) == 2:
+                ang = g.node[x].get('angles', {})
+                key = (hs[0], hs[1]) if (hs[0], hs[1]) in ang else (hs[1], hs[0])
+                if key in ang and ang[key].get('potential') is not None:
+                    ang[key]['potential'].special_flag = 'shake'
+                    nangles += 1
+        print("Constraining %i bonds to hydrogen and %i H-X-H angles with SHAKE."%(nbonds, nangles))
+        if bridging:
+            print("WARNING: %i hydrogen atoms bonded to more than one atom are not constrained."%(bridging))
+        if large:
+            print("WARNING: %i atoms bonded to more than three hydrogen atoms are not "%(len(large))+
+                  "constrained, SHAKE clusters can hold at most four atoms.")
+
+    def fastest_modes(self):
+        """The fastest bond stretch and angle bend, see stiffness.py.
+        Bonds and angles constrained by SHAKE and the terms of rigid
+        molecules and bodies are left out.
+
+        returns ((period, label) or None, (period, label) or None)
+        """
+        g = self.graph
+        rigid = set([sub.molecule_id for sub in self.subgraphs if sub.rigid])
+        bond, angle = None, None
+        seen = set()
+        for n1, n2, data in g.edges_iter2(data=True):
+            pot = data.get('potential')
+            if pot is None or getattr(pot, 'special_flag', None) in ('shake', 'rigid'):
+                continue
+            if g.node[n1].get('molid') in rigid:
+                continue
+            key = (data['ff_type_index'], g.node[n1]['mass'], g.node[n2]['mass'])
+            if key in seen:
+                continue
+            seen.add(key)
+            k = stiffness.bond_curvature(pot)
+            if k is None:
+                continue
+            period = stiffness.bond_period(k, g.node[n1]['mass'], g.node[n2]['mass'])
+            if period is not None and (bond is None or period < bond[0]):
+                bond = (period, "bond %s-%s"%(g.node[n1]['force_field_type'],
+                                              g.node[n2]['force_field_type']))
+        seen = set()
+        for b, data in g.nodes_iter2(data=True):
+            for (a, c), val in data.get('angles', {}).items():
+                pot = val.get('potential')
+                if pot is None or getattr(pot, 'special_flag', None) in ('shake', 'rigid'):
+                    continue
+                if data.get('molid') in rigid:
+                    continue
+                key = (val['ff_type_index'], g.node[a]['mass'], data['mass'], g.node[c]['mass'])
+                if key in seen:
+                    continue
+                seen.add(key)
+                coord = data['cartesian_coordinates']
+                r1 = np.linalg.norm(g.min_img(g.node[a]['cartesian_coordinates'] - coord))
+                r2 = np.linalg.norm(g.min_img(g.node[c]['cartesian_coordinates'] - coord))
+                theta = math.radians(g.compute_angle_between(a, b, c))
+                k = stiffness.angle_curvature(pot, theta)
+                if k is None:
+                    continue
+                period = stiffness.angle_period(k, g.node[a]['mass'], data['mass'],
+                                                g.node[c]['mass'], r1, r2, theta)
+                if period is not None and (angle is None or period < angle[0]):
+                    angle = (period, "angle %s-%s-%s"%(g.node[a]['force_field_type'],
+                                                       data['force_field_type'],
+                                                       g.node[c]['force_field_type']))
+        return bond, angle
+
+    def choose_timestep(self, respa=False):
+        """Set the timestep from the fastest bonded modes, and the levels
+        of run_style respa if asked for.
+
+        """
+        self.respa = None
+        bond, angle = self.fastest_modes()
+        for mode in (bond, angle):
+            if mode is not None:
+                print("Fastest mode: %s, period %.1f fs"%(mode[1], mode[0]))
+        bond_dt = stiffness.safe_timestep(bond[0]) if bond is not None else None
+        angle_dt = stiffness.safe_timestep(angle[0]) if angle is not None else None
+        if not respa:
+            self.timestep = min([dt for dt in (bond_dt, angle_dt, stiffness.MAX_TIMESTEP)
+                                 if dt is not None])
+            return
+        if bond_dt is None:
+            print("WARNING: no bond modes to put on the inner rRESPA level, "+
+                  "run_style respa is not used.")
+            self.timestep = min([dt for dt in (angle_dt, stiffness.MAX_TIMESTEP)
+                                 if dt is not None])
+            return
+        present = [cat for cat, types in (('bond', self.unique_bond_types),
+                                          ('angle', self.unique_angle_types),
+                                          ('dihedral', self.unique_dihedral_types),
+                                          ('improper', self.unique_improper_types),
+                                          ('pair', self.unique_pair_types)) if types]
+        if self.kspace_style:
+            present.append('kspace')
+        groups = [(bond_dt, ['bond']),
+                  (angle_dt, ['angle', 'dihedral', 'improper']),
+                  (stiffness.PAIR_TIMESTEP, ['pair']),
+                  (stiffness.KSPACE_TIMESTEP, ['kspace'])]
+        groups = [(dt, [k for k in keys if k in present]) for dt, keys in groups]
+        self.timestep, factors, levels = stiffness.respa_levels(groups)
+        if not factors:
+            print("WARNING: all forces fall on one rRESPA level, "+
+                  "run_style respa is not used.")
+            return
+        self.respa = "%i %s %s"%(len(factors) + 1,
+                                 " ".join(["%i"%n for n in factors]),
+                                 " ".join(["%s %i"%(k, levels[k]) for k in present]))
+
+    def suggest_decomposition(self, nranks):
+        """Processor grid and balancing of the final box over nranks,
+        see decomposition.py
+
+        """
+        coords = np.array([self.graph.node[n]['cartesian_coordinates'] for n in self.graph.nodes()])
+        frac = np.dot(coords, self.cell.inverse.T) % 1.0
+        cell = np.array(self.cell.cell)
+        if self.replicate is not None:
+            rep = np.array(self.replicate)
+            images = np.array(list(itertools.product(*[range(i) for i in rep])))
+            frac = ((frac[None, :, :] + images[:, None, :])/rep).reshape(-1, 3)
+            cell = cell*rep[:, None]
+        return decomposition.suggest_decomposition(frac, cell, nranks)
+
+    def curve_labels(self, curve):
+        """New atom labels following a space filling curve through the
+        fractional coordinates of the box. The framework atoms come
+        first, then each guest molecule as a contiguous block, ordered
+        by type and by the position of its first atom on the curve.
+
+        returns a dictionary old label -> new label
+        """
+        nodes = np.array(sorted(self.graph.nodes()))
+        coords = np.array([self.graph.node[n]['cartesian_coordinates'] for n in nodes])
+        frac = np.dot(coords, self.cell.inverse.T)
+        position = np.empty(len(nodes), dtype=np.int64)
+        position[ordering.curve_order(frac, curve)] = np.arange(len(nodes))
+        position = dict(zip(nodes.tolist(), position.tolist()))
+
+        molecules = []
+        for mtype in sorted(self.molecule_types.keys()):
+            images = []
+            for j in self.molecule_types[mtype]:
+                images += [sorted(m) for m in self.subgraphs[j].molecule_images] or \
+                          [sorted(self.subgraphs[j].nodes())]
+            molecules += sorted(images, key=lambda m: position[m[0]])
+        guests = set([n for m in molecules for n in m])
+        framework = [n for n in nodes.tolist() if n not in guests]
+        order = sorted(framework, key=lambda n: position[n]) + [n for m in molecules for n in m]
+        return {n: i+1 for i, n in enumerate(order)}
+
+    @profiled
+    def compute_unique_terms(self):
+        """Find the unique force field terms and lammps styles, needed
+        before constructing the data and input files.
+
+        """
+        with self.profiler.stage("unique_terms"):
+            if self.options.rigid_framework:
+                self.drop_framework_terms()
+            if self.options.rigid_sbus:
+                self.assign_rigid_bodies()
+            if self.options.shake_hydrogens != "none":
+                self.constrain_hydrogens(angles=(self.options.shake_hydrogens == "angles"))
+            self.unique_atoms(self.graph)
+            self.unique_bonds(self.graph)
+            self.unique_angles(self.graph)
+            self.unique_dihedrals(self.graph)
+            self.unique_impropers(self.graph)
         if self.options.insert_molecule:
             self.molecule_template(self.options.insert_molecule)
         self.unique_pair_terms()
         self.define_styles()
+        if self.replicate is not None:
+            self.image_flags, self.periodic_bonds = self.graph.image_flags()
+        elif self.rigid_bodies:
+            # fix rigid/small unwraps the bodies with the image flags
+            self.image_flags = {n: (0, 0, 0) for n in self.graph.nodes()}
+            for body in self.rigid_bodies:
+                self.image_flags.update(self.graph.image_flags(nodes=body)[0])
+
+    @profiled
+    def render_lammps_files(self):
+        """Compute the unique force field terms and return the content
+        of the lammps files, a dictionary of file name -> string with
+        the data file, input file and any auxiliary files (tables,
+        molecule templates..) requested.
 
+        """
+        self.auxiliary_files = {}
+        self.compute_unique_terms()
+
+        files = {}
+        files["data.%s" % self.data_name] = self.construct_data_file()
+        files["in.%s" % self.name] = self.construct_input_file()
+        files.update(self.auxiliary_files)
+        return files
+
+    @profiled
+    def write_lammps_files(self, wd=None):
+        files = self.render_lammps_files()
         if wd is None:
             wd = os.getcwd()
 
-        data_str = self.construct_data_file()
-        with open(os.path.join(wd, "data.%s" % self.name), 'w') as datafile:
-            datafile.writelines(data_str)
-
-        inp_str = self.construct_input_file()
-        with open(os.path.join(wd, "in.%s" % self.name), 'w') as inpfile:
-            inpfile.writelines(inp_str)
+        for name, content in files.items():
+            with open(os.path.join(wd, name), 'w') as f:
+                f.writelines(content)
 
         print("Files created! -> %s" % wd)
 
+    @profiled
     def construct_data_file(self):
 
         t = datetime.today()
@@ -1116,13 +1720,16 @@ class LammpsSimulation(object):
             string += "\nAtoms\n\n"
             for node in sorted_nodes:
                 atom = self.graph.node[node]
-                string += "%8i %8i %8i %11.5f %10.5f %10.5f %10.5f\n"%(node,
-                                                                       atom['molid'],
-                                                                       atom['ff_type_index'],
-                                                                       atom['charge'],
-                                                                       atom['cartesian_coordinates'][0],
-                                                                       atom['cartesian_coordinates'][1],
-                                                                       atom['cartesian_coordinates'][2])
+                string += "%8i %8i %8i %11.5f %10.5f %10.5f %10.5f"%(node,
+                                                                     atom['molid'],
+                                                                     atom['ff_type_index'],
+                                                                     atom['charge'],
+                                                                     atom['cartesian_coordinates'][0],
+                                                                     atom['cartesian_coordinates'][1],
+                                                                     atom['cartesian_coordinates'][2])
+                if self.image_flags:
+                    string += " %3i %3i %3i"%self.image_flags[node]
+                string += "\n"
 
         #************[bonds]************
         if(len(self.unique_bond_types.keys()) > 0):
@@ -1187,9 +1794,34 @@ class LammpsSimulation(object):
                     pass
 
         return string
-    def fixcount(self, count=[]):
-        count.append(1)
-        return (len(count))
+    def fixcount(self):
+        self.fix_counter += 1
+        return self.fix_counter
+
+    @profiled
+    def npt_fixes(self, id, temp, pressure, framework_group, keywords=""):
+        """The fixes of an npt run at temp and pressure (values or lammps
+        variables), the first with the fix id 'id'. The rigid bodies take
+        the barostat and the other atoms follow with nvt, and a rigid
+        framework is not integrated.
+
+        returns (input string, list of fix ids)
+        """
+        fixes = [id]
+        if self.rigid_bodies:
+            # the barostat of the bodies dilates the other atoms as well
+            npt_str = "%-15s %s\n"%("fix", "%i bodies rigid/npt/small molecule temp %s %s ${tdamp} aniso %s %s ${pdamp}"%(
+                                     id, temp, temp, pressure, pressure))
+            if framework_group or self.subgraphs:
+                id = self.fixcount()
+                fixes.append(id)
+                npt_str += "%-15s %-8s %s\n"%("group", "nonbody", "subtract all bodies")
+                npt_str += "%-15s %s\n"%("fix", "%i nonbody nvt temp %s %s ${tdamp}"%(id, temp, temp))
+            return npt_str, fixes
+        group = "mobile" if self.options.rigid_framework and self.framework else "all"
+        npt_str = "%-15s %s\n"%("fix", "%i %s npt temp %s %s ${tdamp} tri %s %s ${pdamp}%s"%(
+                                 id, group, temp, temp, pressure, pressure, keywords))
+        return npt_str, fixes
 
     def construct_input_file(self):
         """Input file construction based on user-defined inputs.
@@ -1198,12 +1830,29 @@ class LammpsSimulation(object):
         up into logical sub-sections.
 
         """
+        self.check_rigid_options()
         inp_str = ""
+        self.fix_counter = 0
+        # chosen again for each input file, the options may differ
+        # between the input files of a sweep.
+        self.timestep = 1.0
+        self.respa = None
 
         inp_str += "%-15s %s\n"%("log","log.%s append"%(self.name))
         inp_str += "%-15s %s\n"%("units","real")
         inp_str += "%-15s %s\n"%("atom_style","full")
         inp_str += "%-15s %s\n"%("boundary","p p p")
+        if self.options.accelerator is not None:
+            package = accelerators.PACKAGE_COMMANDS[self.options.accelerator]
+            if package is not None:
+                inp_str += "%-15s %s\n"%("package", package)
+            inp_str += "%-15s %s\n"%("suffix", self.options.accelerator)
+            missing = accelerators.unaccelerated(self.options.accelerator, self.generated_styles())
+            if missing:
+                styles = ", ".join(["%s %s"%(category, name) for category, name in missing])
+                print("WARNING: no %s variant of %s, these styles are not accelerated."%(
+                      self.options.accelerator, styles))
+                inp_str += "# not accelerated: %s\n"%(styles)
         inp_str += "\n"
         if(len(self.unique_pair_types.keys()) > 0):
             inp_str += "%-15s %s\n"%("pair_style", self.pair_style)
@@ -1217,37 +1866,31 @@ class LammpsSimulation(object):
             inp_str += "%-15s %s\n"%("improper_style", self.improper_style)
         if(self.kspace_style):
             inp_str += "%-15s %s\n"%("kspace_style", self.kspace_style)
+            for line in self.kspace.kspace_modify():
+                inp_str += "%-15s %s\n"%("kspace_modify", line)
         inp_str += "\n"
 
         # general catch-all for extra force field commands needed.
         inp_str += "\n".join(list(set(self.special_commands)))
         inp_str += "\n"
+        decomp = None
+        if self.options.ranks is not None and self.options.ranks > 1:
+            decomp = self.suggest_decomposition(self.options.ranks)
+            print("Decomposition for %r"%(decomp))
+            inp_str += "%-15s %i %i %i\n"%(("processors",) + tuple(decomp.grid))
         inp_str += "%-15s %s\n"%("box tilt","large")
-        inp_str += "%-15s %s\n"%("read_data","data.%s"%(self.name))
+        inp_str += "%-15s %s\n"%("read_data","data.%s"%(self.data_name))
+        if self.replicate is not None:
+            # bonds through the periodic boundaries of a framework can't be
+            # unwrapped by image flags, lammps finds their partners instead.
+            inp_str += "%-15s %i %i %i%s\n"%(("replicate",) + tuple(self.replicate) +
+                                              ((" bond/periodic" if self.periodic_bonds else ""),))
 
         if(not self.pair_in_data):
             inp_str += "#### Pair Coefficients ####\n"
-            for pair,data in sorted(self.unique_pair_types.items()):
-                n1, n2 = self.unique_atom_types[pair[0]][0], self.unique_atom_types[pair[1]][0]
-
-                try:
-                    if pair[2] == 'hb':
-                        inp_str += "%-15s %-4i %-4i %s # %s %s\n"%("pair_coeff",
-                            pair[0], pair[1], data['h_bond_potential'],
-                            self.graph.node[n1]['force_field_type'],
-                            self.graph.node[n2]['force_field_type'])
-                    elif pair[2] == 'table':
-                        inp_str += "%-15s %-4i %-4i %s # %s %s\n"%("pair_coeff",
-                            pair[0], pair[1], data['table_potential'],
-                            self.graph.node[n1]['force_field_type'],
-                            self.graph.node[n2]['force_field_type'])
-                    else:
-                        inp_str += "%-15s %-4i %-4i %s # %s %s\n"%("pair_coeff",
-                            pair[0], pair[1], data['pair_potential'],
-                            self.graph.node[n1]['force_field_type'],
-                            self.graph.node[n2]['force_field_type'])
-                except IndexError:
-                    pass
+            for i, j, pot, label1, label2 in self.pair_table.pair_coeff():
+                inp_str += "%-15s %-4i %-4i %s # %s %s\n"%("pair_coeff",
+                    i, j, pot, label1, label2)
             inp_str += "#### END Pair Coefficients ####\n\n"
 
         inp_str += "\n#### Atom Groupings ####\n"
@@ -1323,7 +1966,11 @@ class LammpsSimulation(object):
 
             if(not framework_atoms):
                 self.framework = False
-        if(self.framework):
+        if(self.framework and self.replicate is not None):
+            # the images made by replicate get new atom ids, the structure
+            # has no molecules so the framework is every atom read so far.
+            inp_str += "%-15s %-8s %s\n"%("group", "fram", "union all")
+        elif(self.framework):
             inp_str += "%-15s %-8s %s  "%("group", "fram", "id")
             for x in self.groups(framework_atoms):
                 x = list(x)
@@ -1332,6 +1979,22 @@ class LammpsSimulation(object):
                 else:
                     inp_str += " %i"%(x[0])
             inp_str += "\n"
+        # the framework atoms integrated atom by atom
+        framework_group = "fram"
+        if self.rigid_bodies:
+            body_atoms = sorted([n for body in self.rigid_bodies for n in body])
+            inp_str += "%-15s %-8s %s  "%("group", "bodies", "id")
+            for x in self.groups(body_atoms):
+                x = list(x)
+                if(len(x)>1):
+                    inp_str += " %i:%i"%(x[0], x[-1])
+                else:
+                    inp_str += " %i"%(x[0])
+            inp_str += "\n"
+            framework_group = None
+            if len(body_atoms) < len(framework_atoms):
+                framework_group = "flex"
+                inp_str += "%-15s %-8s %s\n"%("group", "flex", "subtract fram bodies")
         inp_str += "#### END Atom Groupings ####\n\n"
 
         if self.options.dump_dcd:
@@ -1351,12 +2014,29 @@ class LammpsSimulation(object):
             # in the meantime we need to map atom id to element that will allow us to
             # post-process the lammpstrj file and create a cif out of each
             # snapshot stored in the trajectory
-            f = open("lammpstrj_to_element.txt", "w")
-            for key in sorted(self.unique_atom_types.keys()):
-                f.write("%s\n"%(self.unique_atom_types[key][1]['element']))
-            f.close()
+            self.auxiliary_files["lammpstrj_to_element.txt"] = "".join(["%s\n"%(self.unique_atom_types[key][1]['element'])
+                                                                   for key in sorted(self.unique_atom_types.keys())])
+
+        # balance initializes the system, so it is written after the pair
+        # coefficients and the rest of the setup, before the first run.
+        balance_str = ""
+        if decomp is not None:
+            balance_str += "# predicted atoms per rank, max/mean: %.2f uniform grid, %.2f after balance shift"%(
+                           decomp.uniform, decomp.shifted)
+            if decomp.rcb is not None:
+                balance_str += ", %.2f after balance rcb"%(decomp.rcb)
+            balance_str += "\n"
+            if decomp.style == 'rcb':
+                balance_str += "%-15s %s\n"%("comm_style", "tiled")
+            if decomp.style is not None:
+                balance_str += "%-15s %s\n"%("balance", decomp.balance_args())
+                if self.subgraphs:
+                    # the guest molecules move through the pores
+                    balance_str += "%-15s %s\n"%("fix", "balance all balance 1000 %s"%(decomp.balance_args()))
 
         if (self.options.minimize):
+            inp_str += balance_str
+            balance_str = ""
             box_min = "aniso"
             min_style = "cg"
             min_eval = 1e-6   # HKUST-1 will not minimize past 1e-11
@@ -1406,6 +2086,21 @@ class LammpsSimulation(object):
         if self.options.insert_molecule:
             inp_str += "%-15s %s %s.molecule\n"%("molecule", self.options.insert_molecule, self.options.insert_molecule)
 
+        if self.options.rigid_framework and self.framework:
+            # the framework is not integrated, only the pairs with guests
+            # are computed.
+            inp_str += "%-15s %s\n"%("neigh_modify", "exclude group fram fram")
+            inp_str += "%-15s %-8s %s\n"%("group", "mobile", "subtract all fram")
+            inp_str += "%-15s %s\n"%("compute", "mobile_temp mobile temp")
+            inp_str += "%-15s %s\n"%("thermo_modify", "temp mobile_temp")
+
+        if self.rigid_bodies:
+            inp_str += "%-15s %s\n"%("neigh_modify", "exclude molecule/intra bodies")
+            # the special bonds are kept for the pairs between bodies and
+            # the flexible atoms.
+            for style, type in self.rigid_types():
+                inp_str += "%-15s %s\n"%("delete_bonds", "bodies %s %i remove"%(style, type))
+
         for mol in sorted(self.molecule_types.keys()):
             rep = self.subgraphs[self.molecule_types[mol][0]]
             if rep.rigid:
@@ -1419,16 +2114,27 @@ class LammpsSimulation(object):
             iterations = 20
             print_every = 0  # maybe set to non-zero, but output files could become huge.
             shk_fix = self.fixcount()
-            shake_str = "b "+" ".join(["%i"%i for i in self.fix_shake['bonds']]) + \
-                        " a " + " ".join(["%i"%i for i in self.fix_shake['angles']])
+            shake_str = " ".join(["%s %s"%(key, " ".join(["%i"%i for i in self.fix_shake[terms]]))
+                                  for key, terms in (("b", 'bonds'), ("a", 'angles'))
+                                  if terms in self.fix_shake])
                        # fix  id group tolerance iterations print_every [bonds + angles]
             inp_str += "%-15s %i %s %s %f %i %i %s\n"%('fix', shk_fix, 'all', 'shake', shake_tol, iterations, print_every, shake_str)
 
+        if self.options.auto_timestep or self.options.respa or self.options.shake_hydrogens != "none":
+            self.choose_timestep(respa=self.options.respa)
+            inp_str += "%-15s %.2f\n"%("timestep", self.timestep)
+            if self.respa is not None:
+                inp_str += "%-15s %s\n"%("run_style", "respa %s"%(self.respa))
+
+        inp_str += balance_str
+
         if (self.options.random_vel):
             inp_str += "%-15s %s\n"%("velocity", "all create %.2f %i"%(self.options.temp, np.random.randint(1,3000000)))
+            if self.options.rigid_framework and self.framework:
+                inp_str += "%-15s %s\n"%("velocity", "fram set 0.0 0.0 0.0")
 
         if (self.options.nvt):
-            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(1.0))
+            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(self.timestep))
             inp_str += "%-15s %-10s %s\n"%("variable", "tdamp", "equal 100*${dt}")
             molecule_fixes = []
             mollist = sorted(list(self.molecule_types.keys()))
@@ -1479,18 +2185,26 @@ class LammpsSimulation(object):
                     id = self.fixcount()
                     molecule_fixes.append(id)
                     inp_str += "%-15s %s\n"%("fix", "%i %i nve"%(id,molid))
-            if self.framework:
+            if self.rigid_bodies:
+                id = self.fixcount()
+                molecule_fixes.append(id)
+                inp_str += "%-15s %s\n"%("fix", "%i bodies rigid/small molecule langevin %.2f %.2f ${tdamp} %i"%(id,
+                                                                                        self.options.temp,
+                                                                                        self.options.temp,
+                                                                                        np.random.randint(1,3000000)
+                                                                                        ))
+            if self.framework and not self.options.rigid_framework and framework_group:
                 id = self.fixcount()
                 molecule_fixes.append(id)
                 inp_str += "%-15s %s\n"%("fix", "%i %s langevin %.2f %.2f ${tdamp} %i"%(id,
-                                                                                        "fram",
+                                                                                        framework_group,
                                                                                         self.options.temp,
                                                                                         self.options.temp,
                                                                                         np.random.randint(1,3000000)
                                                                                         ))
                 id = self.fixcount()
                 molecule_fixes.append(id)
-                inp_str += "%-15s %s\n"%("fix", "%i fram nve"%id)
+                inp_str += "%-15s %s\n"%("fix", "%i %s nve"%(id, framework_group))
 
             # deposit within nvt equilibrium phase.  TODO(pboyd): This entire input file formation Needs to be re-thought.
             if self.options.deposit:
@@ -1561,11 +2275,18 @@ class LammpsSimulation(object):
                                                                                    self.options.temp,
                                                                                    self.options.temp
                                                                                    ))
-            if self.framework:
+            if self.rigid_bodies:
+                id = self.fixcount()
+                molecule_fixes.append(id)
+                inp_str += "%-15s %s\n"%("fix", "%i bodies rigid/nvt/small molecule temp %.2f %.2f ${tdamp}"%(id,
+                                                                                   self.options.temp,
+                                                                                   self.options.temp
+                                                                                   ))
+            if self.framework and not self.options.rigid_framework and framework_group:
                 id = self.fixcount()
                 molecule_fixes.append(id)
                 inp_str += "%-15s %s\n"%("fix", "%i %s nvt temp %.2f %.2f ${tdamp}"%(id,
-                                                                                   "fram",
+                                                                                   framework_group,
                                                                                    self.options.temp,
                                                                                    self.options.temp
                                                                                    ))
@@ -1580,18 +2301,20 @@ class LammpsSimulation(object):
         #TODO(pboyd): add molecule commands to npt simulations.. this needs to be separated!
         if (self.options.npt):
             id = self.fixcount()
-            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(1.0))
+            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(self.timestep))
             inp_str += "%-15s %-10s %s\n"%("variable", "pdamp", "equal 1000*${dt}")
             inp_str += "%-15s %-10s %s\n"%("variable", "tdamp", "equal 100*${dt}")
 
-            inp_str += "%-15s %s\n"%("fix", "%i all npt temp %.2f %.2f ${tdamp} tri %.2f %.2f ${pdamp}"%(id, self.options.temp, self.options.temp,
-                                                                                                        self.options.pressure, self.options.pressure))
+            npt_str, npt_fixes = self.npt_fixes(id, "%.2f"%(self.options.temp), "%.2f"%(self.options.pressure),
+                                                framework_group)
+            inp_str += npt_str
             inp_str += "%-15s %i\n"%("thermo", 0)
             inp_str += "%-15s %i\n"%("run", self.options.neqstp)
             inp_str += "%-15s %i\n"%("thermo", 1)
             inp_str += "%-15s %i\n"%("run", self.options.nprodstp)
 
-            inp_str += "%-15s %i\n"%("unfix", id)
+            for id in npt_fixes:
+                inp_str += "%-15s %i\n"%("unfix", id)
 
         if(self.options.bulk_moduli):
             min_style=True
@@ -1606,7 +2329,7 @@ class LammpsSimulation(object):
 
             if thermo_style:
                 inp_str += "\n%-15s %-10s %s\n"%("variable", "simTemp", "equal %.4f"%(self.options.temp))
-                inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(1.0))
+                inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(self.timestep))
                 inp_str += "%-15s %-10s %s\n"%("variable", "tdamp", "equal 100*${dt}")
             elif min_style:
                 inp_str += "%-15s %s\n"%("min_style","fire")
@@ -1679,7 +2402,7 @@ class LammpsSimulation(object):
             #inp_str += "%-15s %-10s %s\n"%("variable", "myVol", "equal vol")
             #inp_str += "%-15s %-10s %s\n"%("variable", "t", "equal temp")
             # timestep in femtoseconds
-            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(1.0))
+            inp_str += "%-15s %-10s %s\n"%("variable", "dt", "equal %.2f"%(self.timestep))
             inp_str += "%-15s %-10s %s\n"%("variable", "pdamp", "equal 1000*${dt}")
             inp_str += "%-15s %-10s %s\n"%("variable", "tdamp", "equal 100*${dt}")
             inp_str += "%-15s %s\n"%("print", "\"Step,Temp,CellA,Vol\" file %s.output.csv screen no"%(self.name))
@@ -1711,16 +2434,22 @@ class LammpsSimulation(object):
                     id = self.fixcount()
                     molecule_fixes.append(id)
                     inp_str += "%-15s %s\n"%("fix", "%i %i nve"%(id,molid))
-            if self.framework:
+            if self.rigid_bodies:
+                id = self.fixcount()
+                molecule_fixes.append(id)
+                inp_str += "%-15s %s\n"%("fix", "%i bodies rigid/small molecule langevin ${sim_temp} ${sim_temp} ${tdamp} %i"%(id,
+                                                                                        np.random.randint(1,3000000)
+                                                                                        ))
+            if self.framework and not self.options.rigid_framework and framework_group:
                 id = self.fixcount()
                 molecule_fixes.append(id)
                 inp_str += "%-15s %s\n"%("fix", "%i %s langevin ${sim_temp} ${sim_temp} ${tdamp} %i"%(id,
-                                                                                        "fram",
+                                                                                        framework_group,
                                                                                         np.random.randint(1,3000000)
                                                                                         ))
                 id = self.fixcount()
                 molecule_fixes.append(id)
-                inp_str += "%-15s %s\n"%("fix", "%i fram nve"%id)
+                inp_str += "%-15s %s\n"%("fix", "%i %s nve"%(id, framework_group))
             inp_str += "%-15s %i\n"%("thermo", 0)
             inp_str += "%-15s %i\n"%("run", equil_steps)
             while(molecule_fixes):
@@ -1729,11 +2458,9 @@ class LammpsSimulation(object):
             id = self.fixcount()
             # creating velocity may cause instability at high temperatures.
             #inp_str += "%-15s %s\n"%("velocity", "all create 50 %i"%(np.random.randint(1,3000000)))
-            inp_str += "%-15s %i %s %s %s %s\n"%("fix", id,
-                                        "all npt",
-                                        "temp ${sim_temp} ${sim_temp} ${tdamp}",
-                                        "tri ${sim_press} ${sim_press} ${pdamp}",
-                                        "tchain 5 pchain 5")
+            npt_str, npt_fixes = self.npt_fixes(id, "${sim_temp}", "${sim_press}", framework_group,
+                                                " tchain 5 pchain 5")
+            inp_str += npt_str
             inp_str += "%-15s %i\n"%("thermo", 0)
             inp_str += "%-15s %i\n"%("run", equil_steps)
             inp_str += "%-15s %s %s\n"%("fix", "output all print 10", "\"${sim_temp},$(temp),$(cella),$(vol)\"" +
@@ -1748,7 +2475,8 @@ class LammpsSimulation(object):
             #inp_str += "%-15s %-10s %s\n"%("variable", "inst_t", "delete")
             #inp_str += "%-15s %-10s %s\n"%("variable", "inst_a", "delete")
             #inp_str += "%-15s %-10s %s\n\n"%("variable", "inst_v", "delete")
-            inp_str += "%-15s %i\n"%("unfix", id)
+            for id in npt_fixes:
+                inp_str += "%-15s %i\n"%("unfix", id)
             #inp_str += "%-15s %i\n"%("unfix", fix1)
             inp_str += "\n%-15s %s\n"%("next", "sim_temp")
             inp_str += "%-15s %s\n"%("jump", "SELF loop_thermal")
@@ -1778,10 +2506,8 @@ class LammpsSimulation(object):
             inp_str += "%-15s %s\n"%("undump", "%s_restart"%(self.name))
 
             # write a string that tells you how to read the dump file for this structure
-            f=open("dump_restart_string.txt","w")
-            f.write("read_dump %s_restart.lammpstrj %d x y z box yes"%(self.name,
-                                                                       0))
-            f.close()
+            self.auxiliary_files["dump_restart_string.txt"] = "read_dump %s_restart.lammpstrj %d x y z box yes"%(self.name,
+                                                                                                    0)
 
         try:
             inp_str += "%-15s %i\n"%("unfix", shk_fix)
@@ -1827,37 +2553,229 @@ class LammpsSimulation(object):
                 print("something went wrong")
         return mgraph
 
+def force_field_names():
+    """Names of the force fields in ForceFields which can be requested
+    with force_field and mol_ff.
+
+    """
+    return sorted(name for name, obj in vars(ForceFields).items()
+                  if isinstance(obj, type) and issubclass(obj, ForceFields.ForceField)
+                  and obj not in (ForceFields.ForceField, ForceFields.UserFF,
+                                  ForceFields.OverwriteFF))
+
+def check_force_fields(options):
+    """Raise an OptionsError if options.force_field (a comma separated
+    list) or options.mol_ff are not force fields, before any work is done
+    with them.
+
+    """
+    names = force_field_names()
+    for ff in [ff.strip() for ff in options.force_field.split(",") if ff.strip()]:
+        if ff not in names:
+            raise OptionsError("Unrecognized force field: %s. The force fields are %s."%(
+                               ff, ", ".join(names)))
+    mol_ff = options.mol_ff
+    if mol_ff is not None:
+        # water models are requested as eg. TIP4P_Water
+        if mol_ff.endswith("_Water"):
+            mol_ff = mol_ff[:-6]
+        if mol_ff not in names:
+            raise OptionsError("Unrecognized molecule force field: %s. The force fields are %s."%(
+                               options.mol_ff, ", ".join(names)))
+
+def run_force_fields(options, profiler=NULL_PROFILER):
+    """Parameterize the structure with each of the comma separated force
+    fields in options.force_field. The topology of the structure is
+    computed once and each force field is assigned on an overlay of the
+    graph. The lammps files of each force field are written to a sub
+    directory named after the force field.
+
+    returns a list of the LammpsSimulations which completed.
+    """
+    check_force_fields(options)
+    force_fields = [ff.strip() for ff in options.force_field.split(",") if ff.strip()]
+    if options.output_cif or options.output_pdb or options.output_raspa:
+        print("WARNING: cif, pdb and RASPA output are not written when several force fields "+
+              "are requested.")
+    with profiler.stage("from_CIF"):
+        cell, graph = from_CIF(options.cif_file)
+    graph.profiler = profiler
+    with profiler.stage("compute_topology_information"):
+        graph.compute_topology_information(cell, options.tol, options.neighbour_size)
+
+    sims = []
+    for ff in force_fields:
+        print("Assigning the %s force field"%(ff))
+        ff_options = copy(options)
+        ff_options.force_field = ff
+        sim = LammpsSimulation(ff_options)
+        sim.profiler = profiler
+        try:
+            with profiler.stage(ff):
+                sim.set_cell(deepcopy(cell))
+                sim.set_overlay_graph(graph.overlay())
+                sim.split_graph()
+                sim.assign_force_fields()
+                sim.compute_simulation_size()
+                sim.merge_graphs()
+                wd = os.path.join(os.getcwd(), ff)
+                if not os.path.isdir(wd):
+                    os.makedirs(wd)
+                sim.write_lammps_files(wd)
+        except LammpsInterfaceError as e:
+            print("ERROR: the %s force field could not be assigned."%(ff))
+            print(e)
+            continue
+        sims.append(sim)
+    return sims
+
+def _sweep_points(grid):
+    """All combinations of the (option, [(label, value), ..]) in grid,
+    as lists of (option, label, value).
+
+    """
+    values = [[(key, label, value) for label, value in points] for key, points in grid]
+    return [list(point) for point in itertools.product(*values)]
+
+def _sweep_name(name, point):
+    return name + "".join(["_%s%s"%(key, label) for key, label, value in point])
+
+def run_sweep(options, profiler=NULL_PROFILER):
+    """Write the lammps files for every combination of the option
+    values in options.sweep. The options which only enter the input file
+    (InputHandler.INPUT_FILE_OPTIONS) share a data file, so the force
+    field is assigned and the data file written once for each
+    combination of the other options, and only the input file is
+    rendered for each value of the input options. The topology is
+    computed once for each tolerance and neighbour size.
+
+    returns a list of the input files written.
+    """
+    if "," in options.force_field:
+        raise OptionsError("Several force fields cannot be combined with --sweep, "+
+                           "use --sweep force_field=%s instead."%(options.force_field))
+    if options.output_cif or options.output_pdb or options.output_raspa:
+        print("WARNING: cif, pdb and RASPA output are not written in a sweep.")
+    data_grid = [(key, points) for key, points in options.sweep if key not in INPUT_FILE_OPTIONS]
+    input_grid = [(key, points) for key, points in options.sweep if key in INPUT_FILE_OPTIONS]
+    name = clean(options.cif_file)
+    wd = os.getcwd()
+
+    topologies = {}
+    written = []
+    for data_point in _sweep_points(data_grid):
+        data_options = copy(options)
+        for key, label, value in data_point:
+            setattr(data_options, key, value)
+        topology = (data_options.tol, data_options.neighbour_size)
+        if topology not in topologies:
+            with profiler.stage("from_CIF"):
+                cell, graph = from_CIF(options.cif_file)
+            graph.profiler = profiler
+            with profiler.stage("compute_topology_information"):
+                graph.compute_topology_information(cell, data_options.tol,
+                                                   data_options.neighbour_size)
+            topologies[topology] = (cell, graph)
+        cell, graph = topologies[topology]
+
+        sim = LammpsSimulation(data_options)
+        sim.profiler = profiler
+        sim.name = sim.data_name = _sweep_name(name, data_point)
+        try:
+            with profiler.stage(sim.data_name):
+                sim.set_cell(deepcopy(cell))
+                sim.set_overlay_graph(graph.overlay())
+                sim.split_graph()
+                sim.assign_force_fields()
+                sim.compute_simulation_size()
+                sim.merge_graphs()
+                sim.compute_unique_terms()
+                files = {"data.%s"%(sim.data_name): sim.construct_data_file()}
+                inputs = []
+                for input_point in _sweep_points(input_grid):
+                    sim.options = copy(data_options)
+                    for key, label, value in input_point:
+                        setattr(sim.options, key, value)
+                    sim.name = _sweep_name(sim.data_name, input_point)
+                    try:
+                        files["in.%s"%(sim.name)] = sim.construct_input_file()
+                    except OptionsError as e:
+                        print("ERROR: in.%s could not be written."%(sim.name))
+                        print(e)
+                        continue
+                    inputs.append("in.%s"%(sim.name))
+                files.update(sim.auxiliary_files)
+        except LammpsInterfaceError as e:
+            print("ERROR: %s could not be written."%(sim.data_name))
+            print(e)
+            continue
+        for filename, content in files.items():
+            with open(os.path.join(wd, filename), 'w') as f:
+                f.writelines(content)
+        print("%i input files share data.%s"%(len(inputs), sim.data_name))
+        written += inputs
+    print("Files created! -> %s" % wd)
+    return written
+
 def main():
 
     # command line parsing
     options = Options()
-    sim = LammpsSimulation(options)
-    cell, graph = from_CIF(options.cif_file)
-    sim.set_cell(cell)
-    sim.set_graph(graph)
-    sim.split_graph()
-    sim.assign_force_fields()
-    sim.compute_simulation_size()
-    sim.merge_graphs()
-    if options.output_cif:
-        print("CIF file requested. Exiting...")
-        write_CIF(graph, cell)
-        sys.exit()
-    if options.output_pdb:
-        print("PDB file requested. Exiting...")
-        write_PDB(graph, cell)
-        sys.exit()
-
-    sim.write_lammps_files()
-
-    # Additional capability to write RASPA files if requested
-    if options.output_raspa:
-        print("Writing RASPA files to current WD")
-        classifier=1
-        write_RASPA_CIF(graph, cell,classifier)
-        write_RASPA_sim_files(sim,classifier)
-        this_config = MDMC_config(sim)
-        sim.set_MDMC_config(this_config)
+    profiler = NULL_PROFILER
+    if options.profile or options.profile_trace:
+        profiler = Profiler(trace_memory=options.profile_memory,
+                            count_objects=options.profile_memory)
+    if options.sweep:
+        try:
+            run_sweep(options, profiler)
+        except LammpsInterfaceError as e:
+            print(e)
+            sys.exit()
+    elif "," in options.force_field:
+        try:
+            run_force_fields(options, profiler)
+        except LammpsInterfaceError as e:
+            print(e)
+            sys.exit()
+    else:
+        try:
+            sim = LammpsSimulation(options)
+            sim.profiler = profiler
+            with profiler.stage("from_CIF"):
+                cell, graph = from_CIF(options.cif_file)
+            sim.set_cell(cell)
+            sim.set_graph(graph)
+            sim.split_graph()
+            sim.assign_force_fields()
+            sim.compute_simulation_size()
+            sim.merge_graphs()
+            if options.output_cif:
+                print("CIF file requested. Exiting...")
+                write_CIF(graph, cell)
+                sys.exit()
+            if options.output_pdb:
+                print("PDB file requested. Exiting...")
+                write_PDB(graph, cell)
+                sys.exit()
+
+            sim.write_lammps_files()
+
+            # Additional capability to write RASPA files if requested
+            if options.output_raspa:
+                print("Writing RASPA files to current WD")
+                classifier=1
+                write_RASPA_CIF(graph, cell,classifier)
+                write_RASPA_sim_files(sim,classifier)
+                this_config = MDMC_config(sim)
+                sim.set_MDMC_config(this_config)
+        except LammpsInterfaceError as e:
+            print(e)
+            sys.exit()
+
+    if options.profile:
+        profiler.write_json(options.profile)
+    if options.profile_trace:
+        profiler.write_trace(options.profile_trace)
 
 if __name__ == "__main__":
     main()
@@ -1169,6 +1169,8 @@ class PairPotential(object):
             self.sig = 0.
             self.reduced = False
             self.cutoff = 0.
+            # 'long long' for long range dispersion (lj/long/coul/long..)
+            self.flags = ""
         def __str__(self):
             if self.reduced:
                 return "%15.6f %15.6f"%(self.eps,
@@ -1177,6 +1179,8 @@ class PairPotential(object):
                                          self.eps,
                                          self.sig)
         def __repr__(self):
+            if self.flags:
+                return "%s %s %.3f"%(self.name, self.flags, self.cutoff)
             return "%s %.3f"%(self.name, self.cutoff)
     
     class LjCut(object):
@@ -1277,6 +1281,8 @@ class PairPotential(object):
             self.C = 0.0
             self.reduced = False
             self.cutoff = 0.
+            # 'long long' for long range dispersion (lj/long/coul/long..)
+            self.flags = ""
 
         def __str__(self):
             if self.reduced:
@@ -1288,6 +1294,8 @@ class PairPotential(object):
                                                 self.rho,
                                                 self.C)
         def __repr__(self):
+            if self.flags:
+                return "%s %s %.3f"%(self.name, self.flags, self.cutoff)
             return "%s %.3f"%(self.name, self.cutoff)
 
     class HbondDreidingMorse(object):
@@ -0,0 +1,78 @@
+"""
+Space filling curves through the box, used to number atoms so that
+atoms close in space are close in memory.
+
+The fractional coordinates are wrapped into the box and quantized to
+2^bits cells along each vector. The Morton (Z-order) key interleaves
+the bits of the three cell indices; the Hilbert key does the same after
+the transform of J. Skilling (AIP Conf. Proc. 707, 381 (2004)), which
+makes consecutive cells on the curve share a face.
+"""
+import numpy as np
+
+CURVES = ('none', 'hilbert', 'morton')
+
+
+def _quantize(frac, bits):
+    frac = np.asarray(frac, dtype=np.float64) % 1.0
+    cells = np.floor(frac*(1 << bits)).astype(np.int64)
+    return np.clip(cells, 0, (1 << bits) - 1)
+
+
+def _interleave(cells, bits):
+    """Morton key of an (N, 3) array of cell indices, the bits of the
+    first index are the most significant at each level.
+
+    """
+    keys = np.zeros(len(cells), dtype=np.int64)
+    for level in range(bits - 1, -1, -1):
+        for i in range(3):
+            keys = (keys << 1) | ((cells[:, i] >> level) & 1)
+    return keys
+
+
+def morton_keys(frac, bits=10):
+    """Position of each row of fractional coordinates along the Morton curve."""
+    return _interleave(_quantize(frac, bits), bits)
+
+
+def hilbert_keys(frac, bits=10):
+    """Position of each row of fractional coordinates along the Hilbert curve."""
+    x = _quantize(frac, bits)
+    m = 1 << (bits - 1)
+    # inverse undo excess work
+    q = m
+    while q > 1:
+        p = q - 1
+        for i in range(3):
+            high = (x[:, i] & q) != 0
+            x[high, 0] ^= p
+            low = ~high
+            t = (x[low, 0] ^ x[low, i]) & p
+            x[low, 0] ^= t
+            x[low, i] ^= t
+        q >>= 1
+    # gray encode
+    for i in range(1, 3):
+        x[:, i] ^= x[:, i-1]
+    t = np.zeros(len(x), dtype=np.int64)
+    q = m
+    while q > 1:
+        t[(x[:, 2] & q) != 0] ^= q - 1
+        q >>= 1
+    x ^= t[:, None]
+    return _interleave(x, bits)
+
+
+def curve_order(frac, curve, bits=10):
+    """Indices which sort the rows of fractional coordinates along the
+    curve ('hilbert' or 'morton'). Ties keep their original order.
+
+    """
+    if curve == 'hilbert':
+        keys = hilbert_keys(frac, bits)
+    elif curve == 'morton':
+        keys = morton_keys(frac, bits)
+    else:
+        return np.arange(len(frac))
+    return np.argsort(keys, kind='mergesort')
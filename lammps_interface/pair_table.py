@@ -0,0 +1,91 @@
+"""
+Mixed pair coefficients between atom types.
+"""
+import numpy as np
+from copy import copy
+
+
+class PairTable(object):
+    """Type x type table of mixed pair coefficients.
+
+    The per-type parameters of the pair potentials are gathered into
+    arrays and mixed for all pairs of types at once.
+
+    Lorentz-Berthelot (lj styles)
+        eps_ij = sqrt(eps_i*eps_j)
+        sig_ij = (sig_i + sig_j)/2
+
+    buck styles
+        eps_ij = sqrt(eps_i*eps_j)
+        R_ij = sig_i + sig_j
+        A_ij = 1.84e5*eps_ij, rho_ij = R_ij/12, C_ij = 2.25*R_ij^6*eps_ij
+
+    The entries are stored under the same keys as
+    LammpsSimulation.unique_pair_types, (i, j, style name), (i, j, 'hb') and
+    (i, j, 'table'), and only hold references to potential objects rather
+    than copies of the node data.
+    """
+
+    def __init__(self, types, potentials, labels):
+        """types is a sorted list of atom type indices, potentials and labels
+        map each type to its pair potential and force field type.
+
+        """
+        self.types = list(types)
+        self.index = {t: k for k, t in enumerate(self.types)}
+        self.labels = labels
+        self.potentials = [potentials[t] for t in self.types]
+        self.entries = {}
+
+        names = [p.name for p in self.potentials]
+        self.lj = np.array(['lj' in name for name in names], dtype=bool)
+        self.buck = np.array(['buck' in name for name in names], dtype=bool)
+        eps = np.array([getattr(p, 'eps', 0.) for p in self.potentials], dtype=np.float64)
+        sig = np.array([getattr(p, 'sig', 0.) for p in self.potentials], dtype=np.float64)
+
+        self.eps = np.sqrt(np.outer(eps, eps))
+        self.sig = np.add.outer(sig, sig)/2.
+        Rv = np.add.outer(sig, sig)
+        self.A = 1.84e5 * self.eps
+        self.rho = Rv/12.0
+        self.C = 2.25*(Rv)**6*self.eps
+
+    def mixed(self, i, j):
+        """Return a shallow copy of the pair potential of type i carrying
+        the mixed (i, j) parameters, or None if the styles of i and j
+        do not mix.
+
+        """
+        ki, kj = self.index[i], self.index[j]
+        pot = copy(self.potentials[ki])
+        if self.buck[ki] and self.buck[kj]:
+            pot.A = self.A[ki, kj]
+            pot.rho = self.rho[ki, kj]
+            pot.C = self.C[ki, kj]
+        elif self.lj[ki] and self.lj[kj]:
+            pot.eps = self.eps[ki, kj]
+            pot.sig = self.sig[ki, kj]
+        else:
+            return None
+        return pot
+
+    def add_entry(self, key, pair_potential, h_bond_potential=None, table_potential=None):
+        """Store a pair entry in the form expected by define_styles."""
+        self.entries[key] = {'pair_potential': pair_potential,
+                             'h_bond_potential': h_bond_potential,
+                             'tabulated_potential': table_potential is not None,
+                             'table_potential': table_potential}
+
+    def pair_coeff(self):
+        """Yield (i, j, potential, label_i, label_j) for each entry in the
+        sorted order of the keys.
+
+        """
+        for (i, j, kind), entry in sorted(self.entries.items()):
+            if kind == 'hb':
+                pot = entry['h_bond_potential']
+            elif kind == 'table':
+                pot = entry['table_potential']
+            else:
+                pot = entry['pair_potential']
+            yield i, j, pot, self.labels[i], self.labels[j]
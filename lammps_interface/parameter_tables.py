@@ -0,0 +1,210 @@
+"""
+Structured array views of the tabulated force field parameters.
+"""
+import numpy as np
+from .uff import UFF_DATA
+from .uff4mof import UFF4MOF_DATA
+from .dreiding import DREIDING_DATA
+
+# field names follow the column comments in uff.py, uff4mof.py and dreiding.py
+UFF_FIELDS = ('r1', 'theta0', 'x1', 'D1', 'zeta', 'Z1', 'Vi', 'Uj', 'Xi', 'Hard', 'Radius')
+DREIDING_FIELDS = ('R1', 'theta', 'R0', 'D0', 'phi', 'S')
+
+DEG2RAD = np.pi / 180.
+
+
+class ParameterTable(object):
+    """Force field parameters stored as a numpy structured array.
+
+    Rows are in the insertion order of the original dictionary, and
+    'index' maps a force field type label to its row. Columns are
+    accessed by name, eg. table.array['r1'].
+    """
+
+    def __init__(self, data, fields):
+        self.labels = list(data.keys())
+        self.index = {label: i for i, label in enumerate(self.labels)}
+        self.fields = fields
+        self.array = np.array([tuple(data[label]) for label in self.labels],
+                              dtype=[(f, np.float64) for f in fields])
+
+    def __contains__(self, label):
+        return label in self.index
+
+    def __getitem__(self, label):
+        return self.array[self.index[label]]
+
+    def rows(self, labels):
+        """Return the row indices of a sequence of force field type labels."""
+        return np.array([self.index[label] for label in labels], dtype=np.int64)
+
+    def column(self, field, labels):
+        """Return the values of 'field' for a sequence of force field type labels."""
+        return self.array[field][self.rows(labels)]
+
+
+class TypeResolutionIndex(object):
+    """Lookup of force field types from (element, coordination), built
+    once from the labels of a ParameterTable.
+
+    A label such as 'Zn3+2' is split into the element, label[:2].strip('_'),
+    and the coordination digit, label[2]. Labels without a coordination
+    character (eg. 'Li', 'K_') match any coordination of their element.
+    Labels with a non-numeric third character (eg. 'C_R') never match a
+    coordination.
+
+    Priority rules:
+        1. lookup(element, coordination) returns the LAST label in table
+           order which is either a coordination match or has no
+           coordination character.
+        2. fallback(element) returns the LAST label of that element in
+           table order, irrespective of coordination.
+
+    These reproduce the assignments of the loops over the table keys
+    previously done for every atom, where later keys overwrote earlier
+    matches.
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self._exact = {}
+        self._any = {}
+        self._fallback = {}
+        for label in table.labels:
+            element = label[:2].strip("_")
+            self._fallback[element] = label
+            try:
+                coord = label[2]
+            except IndexError:
+                # no valency for this atom, the label matches all coordinations
+                self._any[element] = (table.index[label], label)
+                continue
+            if coord.isdigit():
+                self._exact[(element, int(coord))] = (table.index[label], label)
+
+    def lookup(self, element, coordination):
+        """Return the force field type for this element and coordination
+        number, or None if there is no match.
+
+        """
+        candidates = [i for i in (self._exact.get((element, coordination)),
+                                  self._any.get(element)) if i is not None]
+        if not candidates:
+            return None
+        return max(candidates)[1]
+
+    def fallback(self, element):
+        """Return the force field type of last resort for this element,
+        or None if the element is not in the table.
+
+        """
+        return self._fallback.get(element)
+
+    def resolve(self, signatures):
+        """Resolve a collection of (element, coordination) signatures at once.
+
+        returns a dictionary signature -> force field type (or None)
+        """
+        return {sig: self.lookup(*sig) for sig in set(signatures)}
+
+
+UFF_TABLE = ParameterTable(UFF_DATA, UFF_FIELDS)
+UFF4MOF_TABLE = ParameterTable(UFF4MOF_DATA, UFF_FIELDS)
+DREIDING_TABLE = ParameterTable(DREIDING_DATA, DREIDING_FIELDS)
+
+UFF_TYPE_INDEX = TypeResolutionIndex(UFF_TABLE)
+UFF4MOF_TYPE_INDEX = TypeResolutionIndex(UFF4MOF_TABLE)
+
+
+def lj_pair_parameters(table, labels, eps_field, r_field):
+    """Lennard-Jones epsilon and sigma for each label, where the table
+    stores the well depth and the distance at the potential minimum.
+
+    returns eps, sig
+    """
+    rows = table.rows(labels)
+    eps = table.array[eps_field][rows]
+    sig = table.array[r_field][rows]*(2**(-1./6.))
+    return eps, sig
+
+
+def uff_bond_parameters(table, labels1, labels2, orders):
+    """Vectorized UFF harmonic bond parameters.
+
+    r0 = r_1 + r_2 + r_BO - r_EN
+
+    The values for K in the UFF paper were set such that in the final
+    harmonic function, they would be divided by '2' to satisfy the
+    form K/2(R-Req)**2. In Lammps, the value for K is already assumed
+    to be divided by '2'.
+
+    returns r0, K
+    """
+    rows1, rows2 = table.rows(labels1), table.rows(labels2)
+    r_1, r_2 = table.array['r1'][rows1], table.array['r1'][rows2]
+    chi_1, chi_2 = table.array['Xi'][rows1], table.array['Xi'][rows2]
+    z_1, z_2 = table.array['Z1'][rows1], table.array['Z1'][rows2]
+
+    rbo = -0.1332*(r_1 + r_2)*np.log(np.asarray(orders, dtype=np.float64))
+    ren = r_1*r_2*(((np.sqrt(chi_1) - np.sqrt(chi_2))**2))/(chi_1*r_1 + chi_2*r_2)
+    r0 = (r_1 + r_2 + rbo - ren)
+    K = 664.12*(z_1*z_2)/(r0**3) / 2.
+    return r0, K
+
+
+def uff_angle_parameters(table, labels_a, labels_c, theta0, r_ab, r_bc):
+    """Vectorized UFF angle force constants and cosine expansion
+    coefficients for the general non-linear case
+
+    E_0 = K_{IJK} * [C_0 + C_1*cos(theta) + C_2*cos(2*theta)]
+
+    theta0 is in degrees, r_ab and r_bc are the equilibrium bond
+    lengths of the two bonds making up the angle.
+
+    returns ka, c0, c1, c2
+    """
+    theta0 = np.asarray(theta0, dtype=np.float64)
+    r_ab = np.asarray(r_ab, dtype=np.float64)
+    r_bc = np.asarray(r_bc, dtype=np.float64)
+    cosT0 = np.cos(theta0*DEG2RAD)
+    sinT0 = np.sin(theta0*DEG2RAD)
+
+    c2 = 1.0 / (4.0*sinT0*sinT0)
+    c1 = -4.0 * c2 * cosT0
+    c0 = c2 * (2.0*cosT0*cosT0 + 1.0)
+
+    za = table.column('Z1', labels_a)
+    zc = table.column('Z1', labels_c)
+
+    r_ac = np.sqrt(r_ab*r_ab + r_bc*r_bc - 2.*r_ab*r_bc*cosT0)
+
+    beta = 664.12/r_ab/r_bc
+    ka = beta*(za*zc /(r_ac**5.))*r_ab*r_bc
+    ka *= (3.*r_ab*r_bc*(1. - cosT0*cosT0) - r_ac*r_ac*cosT0)
+    return ka, c0, c1, c2
+
+
+def dreiding_bond_parameters(table, labels1, labels2, orders):
+    """Vectorized DREIDING bond parameters.
+
+    K = 700*n, D = 70*n and Req = R_1 + R_2 - 0.01, where n is the
+    bond order.
+
+    returns K, D, Re
+    """
+    orders = np.asarray(orders, dtype=np.float64)
+    K = orders*700.
+    D = orders*70.
+    Re = table.column('R1', labels1) + table.column('R1', labels2) - 0.01
+    return K, D, Re
+
+
+def cosine_squared_constants(theta0, K=100.0):
+    """Force constant of the harmonic cosine angle
+
+    E = 0.5*C*[cos(theta) - cos(theta0)]^2
+
+    scaled to match the harmonic force constant K at theta0 (degrees).
+    """
+    theta0 = np.asarray(theta0, dtype=np.float64)
+    return 0.5*K/(np.sin(theta0*DEG2RAD))**2
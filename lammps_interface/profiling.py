@@ -0,0 +1,145 @@
+"""
+Timing and memory instrumentation of the stages of a run.
+
+A Profiler records, for each stage, the wall time, cpu time, the peak
+resident memory of the process and how much the stage raised it, the
+tracemalloc high-water mark and the number of objects tracked by the
+garbage collector (if requested, counting them walks the whole heap).
+Stages can be nested, eg. the topology steps within set_graph.
+
+    profiler = Profiler()
+    with profiler.stage("from_CIF"):
+        cell, graph = from_CIF(cif_file)
+    profiler.write_json("profile.json")
+    profiler.write_trace("trace.json") # chrome://tracing or perfetto
+
+Objects which are not profiled carry a NullProfiler, which does nothing.
+"""
+from contextlib import contextmanager
+import functools
+import gc
+import json
+import os
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    # python 2
+    tracemalloc = None
+
+try:
+    process_time = time.process_time
+except AttributeError:
+    process_time = time.clock
+
+
+def max_rss_kb():
+    """Peak resident set size of this process in kB, or None."""
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+class Profiler(object):
+
+    def __init__(self, trace_memory=False, count_objects=False):
+        self.records = []
+        self.count_objects = count_objects
+        self.trace_memory = trace_memory and tracemalloc is not None
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self._depth = 0
+        self._origin = time.time()
+
+    @contextmanager
+    def stage(self, name):
+        """Record the resources used by the enclosed block."""
+        record = {'name': name, 'depth': self._depth,
+                  'start': time.time() - self._origin}
+        self.records.append(record)
+        if self.trace_memory:
+            traced_start = tracemalloc.get_traced_memory()[0]
+            if hasattr(tracemalloc, 'reset_peak'):
+                tracemalloc.reset_peak()
+        wall, cpu = time.time(), process_time()
+        rss_start = max_rss_kb()
+        self._depth += 1
+        try:
+            yield record
+        finally:
+            self._depth -= 1
+            record['wall'] = time.time() - wall
+            record['cpu'] = process_time() - cpu
+            # the peak is over the whole process, not only this stage
+            record['process_max_rss_kb'] = max_rss_kb()
+            if rss_start is not None:
+                record['max_rss_growth_kb'] = record['process_max_rss_kb'] - rss_start
+            if self.trace_memory:
+                current, peak = tracemalloc.get_traced_memory()
+                record['traced_kb'] = (current - traced_start)/1024.
+                record['traced_peak_kb'] = peak/1024.
+            if self.count_objects:
+                record['objects'] = len(gc.get_objects())
+
+    def totals(self, depth=0):
+        """Wall time of the stages at this depth, summed by name."""
+        totals = {}
+        for record in self.records:
+            if record['depth'] == depth:
+                totals[record['name']] = totals.get(record['name'], 0.) + record.get('wall', 0.)
+        return totals
+
+    def report(self):
+        return {'stages': self.records,
+                'totals': self.totals(),
+                'max_rss_kb': max_rss_kb()}
+
+    def write_json(self, filename):
+        with open(filename, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def write_trace(self, filename):
+        """Write the stages in the chrome trace-event format."""
+        events = []
+        pid = os.getpid()
+        for record in self.records:
+            args = {k: v for k, v in record.items() if k not in ('name', 'start', 'wall', 'depth')}
+            events.append({'name': record['name'], 'ph': 'X', 'pid': pid, 'tid': 0,
+                           'ts': record['start']*1e6, 'dur': record.get('wall', 0.)*1e6,
+                           'args': args})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class NullProfiler(object):
+    """Stand-in for a Profiler, records nothing."""
+
+    records = []
+
+    @contextmanager
+    def stage(self, name):
+        yield None
+
+    def totals(self, depth=0):
+        return {}
+
+    def report(self):
+        return {}
+
+
+NULL_PROFILER = NullProfiler()
+
+
+def profiled(method):
+    """Decorator recording a method as a stage of self.profiler"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.profiler.stage(method.__name__):
+            return method(self, *args, **kwargs)
+    return wrapper
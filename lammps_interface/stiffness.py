@@ -0,0 +1,142 @@
+"""
+Vibrational periods of the bonded terms, used to choose the timestep.
+
+Each bond stretch and angle bend is treated as an independent harmonic
+oscillator with the curvature of its potential at the equilibrium (or
+measured) geometry. For a bond the curvature is divided by the reduced
+mass of the two atoms, for an angle it is multiplied by the Wilson G
+matrix element of the bend,
+
+    G = 1/(m_a r1^2) + 1/(m_c r2^2) + 1/m_b (1/r1^2 + 1/r2^2 - 2 cos(theta)/(r1 r2))
+
+The velocity Verlet integrator stays accurate with about STEPS_PER_PERIOD
+steps over the fastest period, about 1 fs with X-H bonds and 2 fs
+without them. The non-bonded forces are not analysed, so the timestep
+is capped at MAX_TIMESTEP.
+
+With run_style respa the bonds, the other bonded terms, the pair forces
+and the kspace forces are integrated on levels with increasing timesteps.
+"""
+import math
+
+# angular frequency in 1/fs of a curvature in kcal/mol/A^2 over a mass in g/mol
+OMEGA = math.sqrt(4184.*1e3*1e20)*1e-15
+STEPS_PER_PERIOD = 10.
+MAX_TIMESTEP = 2.0
+# outer timesteps of the pair and kspace levels of run_style respa
+PAIR_TIMESTEP = 2.0
+KSPACE_TIMESTEP = 4.0
+
+
+def bond_curvature(pot):
+    """d2E/dr2 at the equilibrium distance (kcal/mol/A^2), None if the
+    style is not known.
+
+    """
+    if pot.name == "harmonic":
+        return 2.*pot.K
+    elif pot.name == "morse":
+        return 2.*pot.D*pot.alpha**2
+    elif pot.name == "class2":
+        return 2.*pot.K2
+    return None
+
+
+def angle_curvature(pot, theta):
+    """d2E/dtheta2 (kcal/mol/rad^2) at the equilibrium angle, or at the
+    measured angle theta (radians) for the cosine series. None if the
+    style is not known.
+
+    """
+    if pot.name in ("harmonic", "charmm"):
+        return abs(2.*pot.K)
+    elif pot.name == "cosine/delta":
+        return abs(pot.K)
+    elif pot.name in ("class2", "quartic"):
+        return abs(2.*pot.K2)
+    elif pot.name == "cosine/squared":
+        return abs(2.*pot.K*math.sin(math.radians(pot.theta0))**2)
+    elif pot.name == "cosine":
+        return abs(pot.K*math.cos(theta))
+    elif pot.name == "cosine/periodic":
+        # lammps evaluates 2/n^2*C*[1 - B*(-1)^n*cos(n*theta)]
+        return abs(2.*pot.C*pot.B*(-1)**pot.n*math.cos(pot.n*theta))
+    elif pot.name == "fourier":
+        return abs(pot.K*(pot.C1*math.cos(theta) + 4.*pot.C2*math.cos(2.*theta)))
+    elif pot.name == "fourier/simple":
+        return abs(pot.K*pot.c*pot.n**2*math.cos(pot.n*theta))
+    return None
+
+
+def _period(curvature, inverse_mass):
+    omega2 = curvature*inverse_mass
+    if omega2 <= 0.:
+        return None
+    return 2.*math.pi/(OMEGA*math.sqrt(omega2))
+
+
+def bond_period(curvature, m1, m2):
+    """Period (fs) of a bond stretch."""
+    return _period(curvature, 1./m1 + 1./m2)
+
+
+def angle_period(curvature, ma, mb, mc, r1, r2, theta):
+    """Period (fs) of the bend of the angle a-b-c, with arms r1 (a-b)
+    and r2 (c-b) in A and theta in radians.
+
+    """
+    g = 1./(ma*r1**2) + 1./(mc*r2**2) + \
+        1./mb*(1./r1**2 + 1./r2**2 - 2.*math.cos(theta)/(r1*r2))
+    return _period(curvature, g)
+
+
+def safe_timestep(period):
+    """STEPS_PER_PERIOD steps over the period, rounded down to 0.25 fs
+    (0.01 fs below 0.25 fs) and at most MAX_TIMESTEP.
+
+    """
+    dt = min(period/STEPS_PER_PERIOD, MAX_TIMESTEP)
+    if dt >= 0.25:
+        return math.floor(dt/0.25)*0.25
+    return max(math.floor(dt/0.01)*0.01, 0.01)
+
+
+def respa_levels(groups):
+    """Levels of run_style respa for groups of forces, from the fastest
+    to the slowest, given as (timestep, keywords). A group with no
+    timestep, or one which would not be at least twice as long as the
+    level below, shares that level. The levels of the faster groups are
+    no longer than the timestep of any slower group, so the inner
+    timestep is the shortest of all.
+
+    returns (outer timestep, loop factors, {keyword: level})
+    """
+    groups = [(target, keywords) for target, keywords in groups if keywords]
+    # the longest timestep each group can take with the groups above it
+    limits = []
+    limit = None
+    for target, keywords in reversed(groups):
+        if target is None:
+            limits.append(None)
+            continue
+        if limit is None or target < limit:
+            limit = target
+        limits.append(limit)
+    limits.reverse()
+    dt = None
+    level = 0
+    factors = []
+    levels = {}
+    for target, (_, keywords) in zip(limits, groups):
+        if dt is None:
+            dt = target
+            level = 1
+        elif target is not None:
+            n = int(target/dt + 1e-6)
+            if n > 1:
+                factors.append(n)
+                dt *= n
+                level += 1
+        for keyword in keywords:
+            levels[keyword] = level
+    return dt, factors, levels
@@ -19,6 +19,8 @@ import sys
 from .generic_raspa import GENERIC_PSEUDO_ATOMS_HEADER, GENERIC_PSEUDO_ATOMS
 from .generic_raspa import GENERIC_FF_MIXING_HEADER, GENERIC_FF_MIXING
 from .generic_raspa import GENERIC_FF_MIXING_FOOTER
+from .errors import StructureError
+from .profiling import NULL_PROFILER, profiled
 from .uff import UFF_DATA
 import networkx as nx
 import operator
@@ -40,6 +42,23 @@ from .ccdc import CCDC_BOND_ORDERS
 DEG2RAD = np.pi / 180.
 
 
+# attributes of networkx graphs, these are not copied by MolecularGraph.overlay
+_NX_GRAPH_ATTRIBUTES = ('graph', '_node', '_adj', 'nodes', 'edges', 'adj', 'degree')
+
+
+def _overlay_copy(value, copy_arrays=True):
+    """Copy the containers nested in value, sharing their contents."""
+    if isinstance(value, dict):
+        return value.__class__((k, _overlay_copy(v, copy_arrays)) for k, v in value.items())
+    elif isinstance(value, list):
+        return [_overlay_copy(v, copy_arrays) for v in value]
+    elif isinstance(value, set):
+        return set(value)
+    elif copy_arrays and isinstance(value, np.ndarray):
+        return value.copy()
+    return value
+
+
 class MolecularGraph(nx.Graph):
     """Class to contain all information relating a structure file
     to a fully described classical system.
@@ -59,6 +78,8 @@ class MolecularGraph(nx.Graph):
     - force_field_type
     """
     node_dict_factory = OrderedDict
+    # replaced by a profiling.Profiler to record the topology steps.
+    profiler = NULL_PROFILER
     def __init__(self, **kwargs):
         nx.Graph.__init__(self, **kwargs)
         # coordinates and distances will be kept in a matrix because
@@ -147,41 +168,34 @@ class MolecularGraph(nx.Graph):
         This issue only arises when a supercell is built, but isolated molecules
         are not replicated in the supercell (by user request).
         This creates a discontinuity in the indices of the atoms, which breaks
-        some features in LAMMPS.
+        some features in LAMMPS. Any permutation of the labels can be used,
+        all nodes are removed before they are added back.
 
         """
 
         old_nodes = sorted([(i,self.node[i]) for i in self.nodes()])
         #old_nodes = list(self.nodes_iter2(data=True))
         old_edges = list(self.edges_iter2(data=True))
+        old_images = [list(m) for m in self.molecule_images]
+        # the terms get new dictionaries, the old ones may be shared
+        # with the subgraphs merged into this graph.
         for node, data in old_nodes:
-
             if 'angles' in data:
-                ang_data = list(data['angles'].items())
-                for (a,c), val in ang_data:
-                    data['angles'].pop((a,c))
-                    data['angles'][(reorder_dic[a], reorder_dic[c])] = val
+                data['angles'] = {(reorder_dic[a], reorder_dic[c]): val
+                                  for (a, c), val in data['angles'].items()}
             if 'impropers' in data:
-                imp_data = list(data['impropers'].items())
-                for (a, c, d), val in imp_data:
-                    data['impropers'].pop((a,c,d))
-                    data['impropers'][(reorder_dic[a], reorder_dic[c], reorder_dic[d])] = val
-
+                data['impropers'] = {(reorder_dic[a], reorder_dic[c], reorder_dic[d]): val
+                                     for (a, c, d), val in data['impropers'].items()}
+            # also removes the edges
             self.remove_node(node)
+        for node, data in old_nodes:
             data['index'] = reorder_dic[node]
             self.add_node(reorder_dic[node], **data)
 
         for b, c, data in old_edges:
             if 'dihedrals' in data:
-                dihed_data = list(data['dihedrals'].items())
-                for (a, d), val in dihed_data:
-                    data['dihedrals'].pop((a,d))
-                    data['dihedrals'][(reorder_dic[a], reorder_dic[d])] = val
-            try:
-                self.remove_edge(b,c)
-            except nx.exception.NetworkXError:
-                # edge already removed from 'remove_node' above
-                pass
+                data['dihedrals'] = {(reorder_dic[a], reorder_dic[d]): val
+                                     for (a, d), val in data['dihedrals'].items()}
             self.add_edge(reorder_dic[b], reorder_dic[c], **data)
 
         old_edge_dict = self.sorted_edge_dict.items()
@@ -189,7 +203,6 @@ class MolecularGraph(nx.Graph):
         for (a,b), val in old_edge_dict:
             self.sorted_edge_dict[(reorder_dic[a], reorder_dic[b])] = (reorder_dic[val[0]], reorder_dic[val[1]])
 
-        old_images = self.molecule_images[:]
         self.molecule_images = []
         for m in old_images:
             newm = [reorder_dic[i] for i in m]
@@ -204,10 +217,9 @@ class MolecularGraph(nx.Graph):
         if(label not in kwargs):
             label = "_atom_site_label"
             if (label not in kwargs):
-                print("ERROR: could not find the keyword for the element types in the cif file!"+
-                        " Please use '_atom_site_type_symbol' or '_atom_site_label' for the element"+
-                        " column.")
-                sys.exit()
+                raise StructureError("ERROR: could not find the keyword for the element types in the cif file!"+
+                                       " Please use '_atom_site_type_symbol' or '_atom_site_label' for the element"+
+                                       " column.")
 
         charge_keywords = ["_atom_type_partial_charge",
                            "_atom_type_parital_charge",
@@ -257,6 +269,7 @@ class MolecularGraph(nx.Graph):
         #kwargs.update({'special_flag':None})
         self.add_node(idx, **kwargs)
 
+    @profiled
     def compute_bonding(self, cell, scale_factor = 0.9):
         """Computes bonds between atoms based on covalent radii."""
         # here assume bonds exist, populate data with lengths and
@@ -308,47 +321,52 @@ class MolecularGraph(nx.Graph):
         # Here we will determine bonding from all atom pairs using
         # covalent radii.
         for n1, n2 in itertools.combinations(self.nodes(), 2):
-            node1, node2 = self.node[n1], self.node[n2]
-            e1, e2 = node1['element'],\
-                    node2['element']
-            elements = set([e1, e2])
-            i1,i2 = node1['index']-1, node2['index']-1
-            rad = (COVALENT_RADII[e1] + COVALENT_RADII[e2])
-            dist = self.distance_matrix[i1,i2]
-            tempsf = scale_factor
-            # probably a better way to fix these kinds of issues..
-            if (set("F") < elements) and  (elements & metals):
-                tempsf = 0.8
-
-            if (set("O") < elements) and (elements & metals):
-                tempsf = 0.85
-            # fix for water particle recognition.
-            if(set(["O", "H"]) <= elements):
-                tempsf = 0.8
-            # fix for M-NDISA MOFs 
-            if(set(["O", "C"]) <= elements):
-                tempsf = 0.8
-            if (set("O") < elements) and (elements & metals):
-                tempsf = 0.82
-                                                            
-            # very specific fix for Michelle's amine appended MOF
-            if(set(["N","H"]) <= elements):
-                tempsf = 0.67
-            if(set(["Mg","N"]) <= elements):
-                tempsf = 0.80
-            if(set(["C","H"]) <= elements):
-                tempsf = 0.80
-            if dist*tempsf < rad and not (alkali & elements):
-
-                flag = self.compute_bond_image_flag(n1, n2, cell)
-                self.sorted_edge_dict.update({(n1,n2): (n1, n2), (n2, n1):(n1, n2)})
-                self.add_edge(n1, n2, key=self.number_of_edges() + 1,
-                              order=1.0,
-                              weight=1,
-                              length=dist,
-                              symflag = flag,
-                              potential = None
-                              )
+            self._bond_if_close(n1, n2, cell, scale_factor)
+
+    def _bond_if_close(self, n1, n2, cell, scale_factor=0.9):
+        """Add a bond between n1 and n2 if they are closer than the sum
+        of their covalent radii (scaled)."""
+        node1, node2 = self.node[n1], self.node[n2]
+        e1, e2 = node1['element'],\
+                node2['element']
+        elements = set([e1, e2])
+        i1,i2 = node1['index']-1, node2['index']-1
+        rad = (COVALENT_RADII[e1] + COVALENT_RADII[e2])
+        dist = self.distance_matrix[i1,i2]
+        tempsf = scale_factor
+        # probably a better way to fix these kinds of issues..
+        if (set("F") < elements) and  (elements & metals):
+            tempsf = 0.8
+
+        if (set("O") < elements) and (elements & metals):
+            tempsf = 0.85
+        # fix for water particle recognition.
+        if(set(["O", "H"]) <= elements):
+            tempsf = 0.8
+        # fix for M-NDISA MOFs 
+        if(set(["O", "C"]) <= elements):
+            tempsf = 0.8
+        if (set("O") < elements) and (elements & metals):
+            tempsf = 0.82
+                                                        
+        # very specific fix for Michelle's amine appended MOF
+        if(set(["N","H"]) <= elements):
+            tempsf = 0.67
+        if(set(["Mg","N"]) <= elements):
+            tempsf = 0.80
+        if(set(["C","H"]) <= elements):
+            tempsf = 0.80
+        if dist*tempsf < rad and not (alkali & elements):
+
+            flag = self.compute_bond_image_flag(n1, n2, cell)
+            self.sorted_edge_dict.update({(n1,n2): (n1, n2), (n2, n1):(n1, n2)})
+            self.add_edge(n1, n2, key=self.number_of_edges() + 1,
+                          order=1.0,
+                          weight=1,
+                          length=dist,
+                          symflag = flag,
+                          potential = None
+                          )
     #TODO(pboyd) update this
     def compute_bond_image_flag(self, n1, n2, cell):
         """Update bonds to contain bond type, distances, and min img
@@ -397,7 +415,7 @@ class MolecularGraph(nx.Graph):
         a = np.arccos(np.dot(v1, v2))
         if np.isnan(a):
             if np.allclose((v1 + v2),np.zeros(3)):
-                a = 180
+                a = np.pi
             else:
                 a = 0
 
@@ -451,6 +469,113 @@ class MolecularGraph(nx.Graph):
         angle = a / DEG2RAD
         return angle
 
+    def node_coordinates(self, nodes):
+        """Return an (M,3) array of the cartesian coordinates of nodes."""
+        return np.array([self.node[n]['cartesian_coordinates'] for n in nodes],
+                        dtype=np.float64).reshape(-1, 3)
+
+    def min_img_vectors(self, vectors):
+        """Minimum image convention applied to an (M,3) array of
+        vectors, the batched version of min_img. The vectors are
+        returned untouched if the graph has no cell.
+
+        """
+        try:
+            f = np.dot(vectors, self.cell.inverse.T)
+        except AttributeError:
+            return vectors
+        f -= np.around(f)
+        return np.dot(f, self.cell.cell)
+
+    def _batch_coordinates(self, indices, width):
+        """Coordinates of an (M,width) array of node labels, returned
+        as an (M,width,3) array.
+
+        """
+        indices = np.asarray(indices).reshape(-1, width)
+        nodes, inverse = np.unique(indices, return_inverse=True)
+        return self.node_coordinates(nodes)[inverse].reshape(-1, width, 3)
+
+    def compute_angles_between(self, triples):
+        """Batched compute_angle_between.
+
+        triples is an (M,3) array of node labels (l, m, r) where m is
+        the apex of the angle. Returns the M angles in degrees.
+
+        """
+        xyz = self._batch_coordinates(triples, 3)
+        v1 = self.min_img_vectors(xyz[:, 0] - xyz[:, 1])
+        v2 = self.min_img_vectors(xyz[:, 2] - xyz[:, 1])
+        v1 /= np.linalg.norm(v1, axis=1)[:, None]
+        v2 /= np.linalg.norm(v2, axis=1)[:, None]
+        with np.errstate(invalid='ignore'):
+            a = np.arccos(np.einsum('ij,ij->i', v1, v2))
+        # rounding can push the cosine outside of [-1, 1], exactly linear
+        # angles are 180 degrees (not 180/DEG2RAD as before)
+        nans = np.isnan(a)
+        if np.any(nans):
+            linear = np.all(np.isclose(v1 + v2, 0.), axis=1)
+            a[nans & linear] = np.pi
+            a[nans & ~linear] = 0.
+        return a / DEG2RAD
+
+    def compute_dihedrals_between(self, quads):
+        """Batched compute_dihedral_between.
+
+        quads is an (M,4) array of node labels (a, b, c, d) where b-c is
+        the central bond. Returns the M dihedral angles in degrees.
+
+        """
+        xyz = self._batch_coordinates(quads, 4)
+        v1 = self.min_img_vectors(xyz[:, 0] - xyz[:, 1])
+        v2 = self.min_img_vectors(xyz[:, 2] - xyz[:, 1])
+        v3 = self.min_img_vectors(xyz[:, 1] - xyz[:, 2])
+        v4 = self.min_img_vectors(xyz[:, 3] - xyz[:, 2])
+
+        n1 = np.cross(v1, v2)
+        n2 = np.cross(v3, v4)
+        n1 /= np.linalg.norm(n1, axis=1)[:, None]
+        n2 /= np.linalg.norm(n2, axis=1)[:, None]
+        with np.errstate(invalid='ignore'):
+            a = np.arccos(np.einsum('ij,ij->i', n1, n2))
+        a[np.isnan(a)] = 0.
+        return a / DEG2RAD
+
+    def coplanar_nodes(self, nodes, atol=0.02):
+        """Batched coplanar, with the minimum image convention applied
+        to the bond vectors.
+
+        Returns a boolean array, True where the node and its neighbours
+        lie in a plane. Nodes are grouped by degree so that each group
+        is evaluated in one pass.
+
+        """
+        nodes = list(nodes)
+        planar = np.zeros(len(nodes), dtype=bool)
+        by_degree = {}
+        for i, node in enumerate(nodes):
+            by_degree.setdefault(self.degree(node), []).append(i)
+        for degree, positions in by_degree.items():
+            if degree < 2:
+                continue
+            centres = [nodes[i] for i in positions]
+            neighbours = [list(self.neighbors(n)) for n in centres]
+            xyz = self._batch_coordinates([[c] + nn for c, nn in zip(centres, neighbours)],
+                                          degree + 1)
+            vects = self.min_img_vectors((xyz[:, 1:] - xyz[:, :1]).reshape(-1, 3))
+            vects = vects.reshape(-1, degree, 3)
+            # use the first two vectors to define a plane
+            n = np.cross(vects[:, 0], vects[:, 1])
+            n /= np.linalg.norm(n, axis=1)[:, None]
+            rest = vects[:, 2:]
+            rest = rest / np.linalg.norm(rest, axis=2)[:, :, None]
+            # what is a good tolerance for co-planarity in MOFs?
+            # this is used solely to determine if a 4-coordinated metal atom
+            # is square planar or tetrahedral..
+            dots = np.einsum('ijk,ik->ij', rest, n)
+            planar[positions] = np.all(np.abs(dots) <= atol, axis=1)
+        return planar
+
     def add_bond_edge(self, **kwargs):
         """Add bond edges (weight factor = 1)"""
         #TODO(pboyd) should figure out if there are other cif keywords to identify
@@ -491,6 +616,7 @@ class MolecularGraph(nx.Graph):
         self.sorted_edge_dict.update({(n1,n2): (n1, n2), (n2, n1):(n1, n2)})
         self.add_edge(n1, n2, key=self.number_of_edges()+1, **kwargs)
 
+    @profiled
     def compute_cartesian_coordinates(self, cell):
         """Compute the cartesian coordinates for each atom node"""
         coord_keys = ['_atom_site_x', '_atom_site_y', '_atom_site_z']
@@ -507,6 +633,7 @@ class MolecularGraph(nx.Graph):
 
             self.coordinates[data['index']-1] = coordinates
 
+    @profiled
     def compute_min_img_distances(self, cell):
         self.distance_matrix = np.empty((self.number_of_nodes(), self.number_of_nodes()))
         for n1, n2 in itertools.combinations(self.nodes(), 2):
@@ -517,7 +644,7 @@ class MolecularGraph(nx.Graph):
             try:
                 dist = self.min_img_distance(coords1, coords2, cell)
             except TypeError:
-                sys.exit()
+                raise StructureError("ERROR: could not compute the distance between atoms %i and %i"%(n1, n2))
             self.distance_matrix[id1][id2] = dist
             self.distance_matrix[id2][id1] = dist
 
@@ -534,6 +661,48 @@ class MolecularGraph(nx.Graph):
         f = np.dot(self.cell.inverse, coord)
         return f
 
+    def image_flags(self, nodes=None):
+        """Image flags which unwrap the bonded atoms, so that each bond
+        joins an atom to the nearest image of its neighbour. Flags are
+        propagated along the bonds from the lowest index of each
+        connected component. Components bonded to their own periodic
+        images (extended frameworks) can't be unwrapped, their atoms
+        keep flags of zero. With nodes, only these atoms and the bonds
+        between them are considered.
+
+        returns a dictionary node -> (nx, ny, nz), and True if some
+        component is bonded through the periodic boundaries.
+        """
+        if nodes is None:
+            nodes = self.nodes()
+        frac = {n: self.fractional(self.node[n]['cartesian_coordinates']) for n in nodes}
+        flags = {}
+        periodic = False
+        for start in sorted(frac.keys()):
+            if start in flags:
+                continue
+            flags[start] = np.zeros(3, dtype=int)
+            component = [start]
+            queue = [start]
+            loop = False
+            while queue:
+                n1 = queue.pop()
+                for n2 in self.neighbors(n1):
+                    if n2 not in frac:
+                        continue
+                    flag = flags[n1] - np.around(frac[n2] - frac[n1]).astype(int)
+                    if n2 not in flags:
+                        flags[n2] = flag
+                        component.append(n2)
+                        queue.append(n2)
+                    elif np.any(flags[n2] != flag):
+                        loop = True
+            if loop:
+                periodic = True
+                for n in component:
+                    flags[n] = np.zeros(3, dtype=int)
+        return {n: tuple(f) for n, f in flags.items()}, periodic
+
     def min_img_distance(self, coords1, coords2, cell):
         one = np.dot(cell.inverse, coords1) % 1
         two = np.dot(cell.inverse, coords2) % 1
@@ -541,17 +710,76 @@ class MolecularGraph(nx.Graph):
         four = np.dot(one - two - three, cell.cell)
         return np.linalg.norm(four)
 
-    def compute_init_typing(self):
+    def environment_hashes(self, nodes=None, depth=1, attributes=('element',)):
+        """Weisfeiler-Lehman hash of the environment of each atom, built
+        from the attributes, degree and ring sizes of the atoms within
+        'depth' bonds. Atoms with the same hash are typed the same way
+        by rules which only look that far.
+
+        The labels are compressed to integers at each iteration instead
+        of hashing strings, so distinct environments never collide, but
+        the hashes are only comparable within one call.
+
+        returns a dictionary node -> hash
+        """
+        if nodes is None:
+            region = self.nodes()
+        else:
+            region = self.neighbourhood(nodes, depth)
+        signatures = {}
+        labels = {}
+        for n in region:
+            data = self.node[n]
+            key = (tuple([data.get(a) for a in attributes]), self.degree(n),
+                   tuple(sorted([len(r) for r in data.get('rings', [])])))
+            labels[n] = signatures.setdefault(key, len(signatures))
+        for i in range(depth):
+            signatures = {}
+            # atoms at the edge of the region get incomplete signatures,
+            # but these don't reach nodes within 'depth' iterations.
+            labels = {n: signatures.setdefault(
+                          (labels[n], tuple(sorted([labels[j] for j in self.neighbors(n) if j in labels]))),
+                          len(signatures))
+                      for n in labels}
+        if nodes is not None:
+            labels = {n: labels[n] for n in nodes}
+        return labels
+
+    def environment_classes(self, nodes=None, depth=1, attributes=('element',)):
+        """Atoms grouped by environment_hashes, in the order of nodes.
+
+        returns a list of lists of atoms, the first atom of each list
+        appears first in nodes.
+        """
+        hashes = self.environment_hashes(nodes, depth, attributes)
+        if nodes is None:
+            nodes = self.nodes()
+        classes = OrderedDict()
+        for n in nodes:
+            classes.setdefault(hashes[n], []).append(n)
+        return list(classes.values())
+
+    @profiled
+    def compute_init_typing(self, nodes=None):
         """Find possible rings in the structure and
         initialize the hybridization for each atom.
         More refined determinations of atom and bond types
         is computed below in compute_bond_typing
 
+        If nodes is given, only these atoms are typed, along with the
+        rings passing through them.
+
         """
         #TODO(pboyd) return if atoms already 'typed' in the .cif file
         # compute and store cycles
+        subset = nodes is not None
+        if subset:
+            for node in nodes:
+                self.node[node].update({'cycle': False, 'rings': []})
+        else:
+            nodes = list(self.nodes())
         cycles = []
-        for node, data in self.nodes_iter2(data=True):
+        for node in nodes:
             for n in self.neighbors(node):
                 # fastest way I could think of..
                 edge = self[node][n].copy()
@@ -570,53 +798,12 @@ class MolecularGraph(nx.Graph):
                 # should be a harmless edit but maybe need to test
                 if(len(cycle) <= 10):
                     cycles += cycle
-        for label, data in self.nodes_iter2(data=True):
-            # N O C S
-            neighbours = self.neighbors(label)
-            element = data['element']
-            if element == "C":
-                if self.degree(label) >= 4:
-                    self.node[label].update({'hybridization':'sp3'})
-                elif self.degree(label) == 3:
-                    self.node[label].update({'hybridization':'sp2'})
-                elif self.degree(label) <= 2:
-                    self.node[label].update({'hybridization':'sp'})
-            elif element == "N":
-                if self.degree(label) >= 3:
-                    self.node[label].update({'hybridization':'sp3'})
-                elif self.degree(label) == 2:
-                    self.node[label].update({'hybridization':'sp2'})
-                elif self.degree(label) == 1:
-                    self.node[label].update({'hybridization':'sp'})
-                else:
-                    self.node[label].update({'hybridization':'sp3'})
-            elif element == "O":
-                n_elems = set([self.node[k]['element'] for k in neighbours])
-                if self.degree(label) >= 2:
-                    # if O is bonded to a metal, assume sp2 - like ...
-                    # there's probably many cases where this fails,
-                    # but carboxylate groups, bridging hydroxy groups
-                    # make this true.
-                    if (n_elems <= metals):
-                        self.node[label].update({'hybridization': 'sp2'})
-                    else:
-                        self.node[label].update({'hybridization':'sp3'})
-                elif self.degree(label) == 1:
-                    self.node[label].update({'hybridization':'sp2'})
-                else:
-                    # If it has no neighbours, just give it SP3
-                    self.node[label].update({'hybridization':'sp3'})
-            elif element == "S":
-                if self.degree(label) >= 2:
-                    self.node[label].update({'hybridization':'sp3'})
-                elif self.degree(label) == 1:
-                    self.node[label].update({'hybridization':'sp2'})
-                else:
-                    self.node[label].update({'hybridization':'sp3'})
-
-            else:
-                #default sp3
-                self.node[label].update({'hybridization':'sp3'})
+        # the hybridization only depends on the neighbours, so it is
+        # determined once for each environment.
+        for members in self.environment_classes(nodes if subset else None, depth=1):
+            hybridization = self.initial_hybridization(members[0])
+            for label in members:
+                self.node[label]['hybridization'] = hybridization
         # convert to aromatic
         # probably not a good test for aromaticity..
         arom = set(["C", "N", "O", "S"])
@@ -627,163 +814,107 @@ class MolecularGraph(nx.Graph):
                 for a in cycle:
                     self.node[a]['hybridization'] = 'aromatic'
                     self.node[a]['cycle'] = True
+                    # rings of atoms outside the subset were stored before
+                    if subset and cycle in self.node[a]['rings']:
+                        continue
                     self.node[a]['rings'].append(cycle)
 
-    def compute_bond_typing(self):
+    def initial_hybridization(self, label):
+        """Hybridization of an atom from its element and neighbours,
+        before the bonds are typed.
+
+        """
+        data = self.node[label]
+        # N O C S
+        neighbours = self.neighbors(label)
+        element = data['element']
+        if element == "C":
+            if self.degree(label) >= 4:
+                return 'sp3'
+            elif self.degree(label) == 3:
+                return 'sp2'
+            elif self.degree(label) <= 2:
+                return 'sp'
+        elif element == "N":
+            if self.degree(label) >= 3:
+                return 'sp3'
+            elif self.degree(label) == 2:
+                return 'sp2'
+            elif self.degree(label) == 1:
+                return 'sp'
+            else:
+                return 'sp3'
+        elif element == "O":
+            n_elems = set([self.node[k]['element'] for k in neighbours])
+            if self.degree(label) >= 2:
+                # if O is bonded to a metal, assume sp2 - like ...
+                # there's probably many cases where this fails,
+                # but carboxylate groups, bridging hydroxy groups
+                # make this true.
+                if (n_elems <= metals):
+                    return 'sp2'
+                else:
+                    return 'sp3'
+            elif self.degree(label) == 1:
+                return 'sp2'
+            else:
+                # If it has no neighbours, just give it SP3
+                return 'sp3'
+        elif element == "S":
+            if self.degree(label) >= 2:
+                return 'sp3'
+            elif self.degree(label) == 1:
+                return 'sp2'
+            else:
+                return 'sp3'
+
+        else:
+            #default sp3
+            return 'sp3'
+
+    @profiled
+    def compute_bond_typing(self, nodes=None):
         """ Compute bond types and atom types based on the local edge
         environment.
         Messy, loads of 'ifs'
         is there a better way to catch chemical features?
+
+        If nodes is given, only the bonds of these atoms are typed, with
+        the bonds between them starting again from single bonds.
         """
         #TODO(pboyd) return if bonds already 'typed' in the .cif file
         double_check = []
-        for n1, n2, data in self.edges_iter2(data=True):
-            elements = [self.node[a]['element'] for a in (n1,n2)]
-            hybridization = [self.node[a]['hybridization'] for a in (n1, n2)]
-            rings = [self.node[a]['rings'] for a in (n1, n2)]
-            samering = False
-
-            if set(hybridization) == set(['aromatic']):
-                for r in rings[0]:
-                    if n2 in r:
-                        samering = True
-                if(samering):
-                    data.update({"order" : 1.5})
-
-            if set(elements) == set(["C", "O"]):
-                car = n1 if self.node[n1]['element'] == "C" else n2
-                car_data = self.node[car]
-                oxy = n2 if self.node[n2]['element'] == "O" else n1
-                oxy_data = self.node[oxy]
-
-                carnn = [i for i in self.neighbors(car) if i != oxy]
-                try:
-                    carnelem = [self.node[j]['element'] for j in carnn]
-                except:
-                    carnelem = []
-
-                oxynn = [i for i in self.neighbors(oxy) if i != car]
-                try:
-                    oxynelem = [self.node[j]['element'] for j in oxynn]
-                except:
-                    oxynelem = []
-                if "O" in carnelem:
-                    at = carnn[carnelem.index("O")]
-                    at_data = self.node[at]
-                    if self.degree(at) == 1:
-                        if self.degree(oxy) == 1:
-                            #CO2
-                            car_data['hybridization'] = 'sp'
-                            oxy_data['hybridization'] = 'sp2'
-                            data['order'] = 2.
-                        else:
-                            # ester
-                            if set(oxynelem) <= organic:
-                                car_data['hybridization'] = 'sp2'
-                                oxy_data['hybridization'] = 'sp2'
-                                data['order'] = 1 # this is the ether part of an ester...
-                            #carboxylate?
-                            else:
-                                car_data['hybridization'] = 'aromatic'
-                                oxy_data['hybridization']= 'aromatic'
-                                data['order'] = 1.5
-
-                    else:
-                        atnelem = [self.node[k]['element'] for k in self.neighbors(at)]
-                        if (set(atnelem) <= organic):
-                            # ester
-                            if len(oxynn) == 0:
-                                car_data['hybridization'] = 'sp2'
-                                oxy_data['hybridization'] = 'sp2'
-                                data['order'] = 2. # carbonyl part of ester
-                            # some kind of resonance structure?
-                            else:
-                                car_data['hybridization'] = 'aromatic'
-                                oxy_data['hybridization'] = 'aromatic'
-                                data['order'] = 1.5
-                        else:
-                            car_data['hybridization'] = 'aromatic'
-                            oxy_data['hybridization'] = 'aromatic'
-                            data['order'] = 1.5
-
-                if "N" in carnelem:
-                    at = carnn[carnelem.index("N")]
-                    # C=O of amide group
-                    if self.degree(oxy) == 1:
-                        data['order'] = 1.5
-                        car_data['hybridization'] = 'aromatic'
-                        oxy_data['hybridization'] = 'aromatic'
-                # only one carbon oxygen connection.. could be C=O, R-C-O-R, R-C=O-R
-                if (not "O" in carnelem) and (not "N" in carnelem):
-                    if len(oxynn) > 0:
-                        # ether
-                        oxy_data['hybridization'] = 'sp3'
-                        data['order'] = 1.0
-                    else:
-                        if car_data['cycle'] and car_data['hybridization'] == 'aromatic':
-                            oxy_data['hybridization'] = 'aromatic'
-                            data['order'] = 1.5
-                        # carbonyl
-                        else:
-                            oxy_data['hybridization'] = 'sp2'
-                            data['order'] = 2.0
-            elif set(elements) == set(["C", "N"]) and not samering:
-                car = n1 if self.node[n1]['element'] == "C" else n2
-                car_data = self.node[car]
-                nit = n2 if self.node[n2]['element'] == "N" else n1
-                nit_data = self.node[nit]
-                carnn = [j for j in self.neighbors(car) if j != nit]
-                carnelem = [self.node[k]['element'] for k in carnn]
-                nitnn = [j for j in self.neighbors(nit) if j != car]
-                nitnelem = [self.node[k]['element'] for k in nitnn]
-                # aromatic amine connected -- assume part of delocalized system
-                if car_data['hybridization'] == 'aromatic' and set(['H']) == set(nitnelem):
-                    data['order'] = 1.5
-                    nit_data['hybridization'] = 'aromatic'
-                # amide?
-                elif self.degree(car) == 3 and len(nitnn) >=2:
-                    if "O" in carnelem:
-                        data['order'] = 1.5 # (amide)
-                        nit_data['hybridization'] = 'aromatic'
-                    # nitro
-                    if set(nitnelem) == set(["O"]):
-                        data['order'] = 1.
-                        nit_data['hybridization'] = 'aromatic'
-                        for oatom in nitnn:
-                            nobond = self[nit][oatom]['order'] = 1.5
-                            self.node[oatom]['hybridization'] = 'aromatic'
-
-            elif (not self.node[n1]['cycle']) and (not self.node[n2]['cycle']) and (set(elements) <= organic):
-                if set(hybridization) == set(['sp2']):
-                    try:
-                        cr1 = COVALENT_RADII['%s_2'%elements[0]]
-                    except KeyError:
-                        cr1 = COVALENT_RADII[elements[0]]
-                    try:
-                        cr2 = COVALENT_RADII['%s_2'%(elements[1])]
-                    except KeyError:
-                        cr2 = COVALENT_RADII[elements[1]]
-                    covrad = cr1 + cr2
-                    # first pass: assign all to 2.0 bond order
-                    data['order'] = 2.0
-                    double_check += [n1, n2]
-                    #if (data['length'] <= covrad*.95):
-                    #    data['order'] = 2.0
-                elif set(hybridization) == set(['sp']):
-                    try:
-                        cr1 = COVALENT_RADII['%s_1'%elements[0]]
-                    except KeyError:
-                        cr1 = COVALENT_RADII[elements[0]]
-                    try:
-                        cr2 = COVALENT_RADII['%s_1'%elements[1]]
-                    except KeyError:
-                        cr2 = COVALENT_RADII[elements[1]]
-                    # first pass: assign all to 3.0 bond order
+        if nodes is None:
+            edges = self.edges_iter2(data=True)
+        else:
+            for n1, n2, data in self.edges_between(nodes):
+                data['order'] = 1.0
+            edges = self.edges_touching(nodes)
+        # the rules look up to two bonds away from the atoms and read the
+        # hybridizations set by the bonds typed before, so each bond is
+        # typed once for every combination of these.
+        hashes = self.environment_hashes(None if nodes is None else self.neighbourhood(nodes, 1),
+                                         depth=2, attributes=('element', 'hybridization', 'cycle'))
+        typed = {}
+        for n1, n2, data in edges:
+            elements = set([self.node[n1]['element'], self.node[n2]['element']])
+            if elements == set(["C", "N"]):
+                # nitro groups change the neighbouring bonds too
+                if self.type_bond(n1, n2, data):
                     double_check += [n1, n2]
-                    data['order'] = 3.0
-                    #covrad = cr1 + cr2
-                    #if (data['length'] <= covrad*.95):
-                    #    data['order'] = 3.0
+                continue
+            samering = any([n2 in r for r in self.node[n1]['rings']])
+            key = (hashes[n1], hashes[n2], self.node[n1]['hybridization'],
+                   self.node[n2]['hybridization'], data['order'], samering)
+            if key in typed:
+                data['order'], self.node[n1]['hybridization'], \
+                        self.node[n2]['hybridization'], double = typed[key]
+            else:
+                double = self.type_bond(n1, n2, data)
+                typed[key] = (data['order'], self.node[n1]['hybridization'],
+                              self.node[n2]['hybridization'], double)
+            if double:
+                double_check += [n1, n2]
         # second pass, check organic unsaturated bonds to make
         # sure alkyl chains are alternating etc.
         while double_check:
@@ -864,6 +995,162 @@ class MolecularGraph(nx.Graph):
 
                 #print([self.node[r]['element'] for r in k])
 
+    def type_bond(self, n1, n2, data):
+        """Bond order of the edge n1-n2 and hybridization of its atoms
+        from their environment, see compute_bond_typing.
+
+        returns True if the bond is unsaturated and its order should be
+        checked along the chain it belongs to.
+        """
+        double = False
+        elements = [self.node[a]['element'] for a in (n1,n2)]
+        hybridization = [self.node[a]['hybridization'] for a in (n1, n2)]
+        rings = [self.node[a]['rings'] for a in (n1, n2)]
+        samering = False
+
+        if set(hybridization) == set(['aromatic']):
+            for r in rings[0]:
+                if n2 in r:
+                    samering = True
+            if(samering):
+                data.update({"order" : 1.5})
+
+        if set(elements) == set(["C", "O"]):
+            car = n1 if self.node[n1]['element'] == "C" else n2
+            car_data = self.node[car]
+            oxy = n2 if self.node[n2]['element'] == "O" else n1
+            oxy_data = self.node[oxy]
+
+            carnn = [i for i in self.neighbors(car) if i != oxy]
+            try:
+                carnelem = [self.node[j]['element'] for j in carnn]
+            except:
+                carnelem = []
+
+            oxynn = [i for i in self.neighbors(oxy) if i != car]
+            try:
+                oxynelem = [self.node[j]['element'] for j in oxynn]
+            except:
+                oxynelem = []
+            if "O" in carnelem:
+                at = carnn[carnelem.index("O")]
+                at_data = self.node[at]
+                if self.degree(at) == 1:
+                    if self.degree(oxy) == 1:
+                        #CO2
+                        car_data['hybridization'] = 'sp'
+                        oxy_data['hybridization'] = 'sp2'
+                        data['order'] = 2.
+                    else:
+                        # ester
+                        if set(oxynelem) <= organic:
+                            car_data['hybridization'] = 'sp2'
+                            oxy_data['hybridization'] = 'sp2'
+                            data['order'] = 1 # this is the ether part of an ester...
+                        #carboxylate?
+                        else:
+                            car_data['hybridization'] = 'aromatic'
+                            oxy_data['hybridization']= 'aromatic'
+                            data['order'] = 1.5
+
+                else:
+                    atnelem = [self.node[k]['element'] for k in self.neighbors(at)]
+                    if (set(atnelem) <= organic):
+                        # ester
+                        if len(oxynn) == 0:
+                            car_data['hybridization'] = 'sp2'
+                            oxy_data['hybridization'] = 'sp2'
+                            data['order'] = 2. # carbonyl part of ester
+                        # some kind of resonance structure?
+                        else:
+                            car_data['hybridization'] = 'aromatic'
+                            oxy_data['hybridization'] = 'aromatic'
+                            data['order'] = 1.5
+                    else:
+                        car_data['hybridization'] = 'aromatic'
+                        oxy_data['hybridization'] = 'aromatic'
+                        data['order'] = 1.5
+
+            if "N" in carnelem:
+                at = carnn[carnelem.index("N")]
+                # C=O of amide group
+                if self.degree(oxy) == 1:
+                    data['order'] = 1.5
+                    car_data['hybridization'] = 'aromatic'
+                    oxy_data['hybridization'] = 'aromatic'
+            # only one carbon oxygen connection.. could be C=O, R-C-O-R, R-C=O-R
+            if (not "O" in carnelem) and (not "N" in carnelem):
+                if len(oxynn) > 0:
+                    # ether
+                    oxy_data['hybridization'] = 'sp3'
+                    data['order'] = 1.0
+                else:
+                    if car_data['cycle'] and car_data['hybridization'] == 'aromatic':
+                        oxy_data['hybridization'] = 'aromatic'
+                        data['order'] = 1.5
+                    # carbonyl
+                    else:
+                        oxy_data['hybridization'] = 'sp2'
+                        data['order'] = 2.0
+        elif set(elements) == set(["C", "N"]) and not samering:
+            car = n1 if self.node[n1]['element'] == "C" else n2
+            car_data = self.node[car]
+            nit = n2 if self.node[n2]['element'] == "N" else n1
+            nit_data = self.node[nit]
+            carnn = [j for j in self.neighbors(car) if j != nit]
+            carnelem = [self.node[k]['element'] for k in carnn]
+            nitnn = [j for j in self.neighbors(nit) if j != car]
+            nitnelem = [self.node[k]['element'] for k in nitnn]
+            # aromatic amine connected -- assume part of delocalized system
+            if car_data['hybridization'] == 'aromatic' and set(['H']) == set(nitnelem):
+                data['order'] = 1.5
+                nit_data['hybridization'] = 'aromatic'
+            # amide?
+            elif self.degree(car) == 3 and len(nitnn) >=2:
+                if "O" in carnelem:
+                    data['order'] = 1.5 # (amide)
+                    nit_data['hybridization'] = 'aromatic'
+                # nitro
+                if set(nitnelem) == set(["O"]):
+                    data['order'] = 1.
+                    nit_data['hybridization'] = 'aromatic'
+                    for oatom in nitnn:
+                        nobond = self[nit][oatom]['order'] = 1.5
+                        self.node[oatom]['hybridization'] = 'aromatic'
+
+        elif (not self.node[n1]['cycle']) and (not self.node[n2]['cycle']) and (set(elements) <= organic):
+            if set(hybridization) == set(['sp2']):
+                try:
+                    cr1 = COVALENT_RADII['%s_2'%elements[0]]
+                except KeyError:
+                    cr1 = COVALENT_RADII[elements[0]]
+                try:
+                    cr2 = COVALENT_RADII['%s_2'%(elements[1])]
+                except KeyError:
+                    cr2 = COVALENT_RADII[elements[1]]
+                covrad = cr1 + cr2
+                # first pass: assign all to 2.0 bond order
+                data['order'] = 2.0
+                double = True
+                #if (data['length'] <= covrad*.95):
+                #    data['order'] = 2.0
+            elif set(hybridization) == set(['sp']):
+                try:
+                    cr1 = COVALENT_RADII['%s_1'%elements[0]]
+                except KeyError:
+                    cr1 = COVALENT_RADII[elements[0]]
+                try:
+                    cr2 = COVALENT_RADII['%s_1'%elements[1]]
+                except KeyError:
+                    cr2 = COVALENT_RADII[elements[1]]
+                # first pass: assign all to 3.0 bond order
+                double = True
+                data['order'] = 3.0
+                #covrad = cr1 + cr2
+                #if (data['length'] <= covrad*.95):
+                #    data['order'] = 3.0
+        return double
+
     def recurse_linear_chains(self, node, visited=[], excluded=[]):
         """Messy recursion function to return all unique chains from a set of atoms between two
         metals (or terminal atoms in the case of molecules)"""
@@ -901,7 +1188,24 @@ class MolecularGraph(nx.Graph):
     def atomic_node_sanity_check(self):
         """Check for specific keyword/value pairs. Exit if non-existent"""
 
-    def compute_angles(self):
+    def edges_between(self, nodes):
+        """The (n1, n2, data) of the bonds with both atoms in nodes,
+        with n1, n2 in the order of sorted_edge_dict."""
+        nodes = set(nodes)
+        return [(n1, n2, data) for n1, n2, data in self.edges_touching(nodes)
+                if n1 in nodes and n2 in nodes]
+
+    def edges_touching(self, nodes):
+        """The (n1, n2, data) of the bonds with at least one atom in
+        nodes, with n1, n2 in the order of sorted_edge_dict."""
+        edges = []
+        for n1, n2 in set(tuple(sorted(e)) for e in self.edges(nodes)):
+            v1, v2 = self.sorted_edge_dict[(n1, n2)]
+            edges.append((v1, v2, self[n1][n2]))
+        return sorted(edges, key=lambda e: (e[0], e[1]))
+
+    @profiled
+    def compute_angles(self, nodes=None):
         """angles are attached to specific nodes, this way
         if a node is cut out of a graph, the angle comes with it.
 
@@ -916,14 +1220,18 @@ class MolecularGraph(nx.Graph):
         periodic image.
 
         """
-        for b, data in self.nodes_iter2(data=True):
+        if nodes is None:
+            nodes = self.nodes()
+        for b in nodes:
+            data = self.node[b]
             if self.degree(b) < 2:
                 continue
             angles = itertools.combinations(self.neighbors(b), 2)
             for (a, c) in angles:
                 data.setdefault('angles', {}).update({(a,c):{'potential':None}})
 
-    def compute_dihedrals(self):
+    @profiled
+    def compute_dihedrals(self, nodes=None):
         """Dihedrals are attached to specific edges in the graph.
            a
             \
@@ -936,14 +1244,19 @@ class MolecularGraph(nx.Graph):
         and d and other possible bonded atoms)
 
         """
-        for b, c, data in self.edges_iter2(data=True):
+        if nodes is None:
+            edges = self.edges_iter2(data=True)
+        else:
+            edges = self.edges_touching(nodes)
+        for b, c, data in edges:
             b_neighbours = [k for k in self.neighbors(b) if k != c]
             c_neighbours = [k for k in self.neighbors(c) if k != b]
             for a in b_neighbours:
                 for d in c_neighbours:
                     data.setdefault('dihedrals',{}).update({(a, d):{'potential':None}})
 
-    def compute_improper_dihedrals(self):
+    @profiled
+    def compute_improper_dihedrals(self, nodes=None):
         """Improper Dihedrals are attached to specific nodes in the graph.
            a
             \
@@ -955,7 +1268,10 @@ class MolecularGraph(nx.Graph):
         angles between the neighbours of b
 
         """
-        for b, data in self.nodes_iter2(data=True):
+        if nodes is None:
+            nodes = self.nodes()
+        for b in nodes:
+            data = self.node[b]
             if self.degree(b) != 3:
                 continue
             # three improper torsion angles about each atom
@@ -978,6 +1294,182 @@ class MolecularGraph(nx.Graph):
         self.compute_dihedrals()
         self.compute_improper_dihedrals()
 
+    # Editing of a graph whose topology has been computed, to make
+    # variants of a structure (defects, functional groups, guests)
+    # without perceiving the whole structure again. Rings of up to 11
+    # atoms are found in compute_init_typing, so the typing of atoms up
+    # to EDIT_RADIUS bonds away from an edit can change.
+    EDIT_RADIUS = 5
+
+    def neighbourhood(self, nodes, radius):
+        """The atoms within 'radius' bonds of nodes, including nodes."""
+        region = set(n for n in nodes if n in self)
+        shell = set(region)
+        for i in range(radius):
+            shell = set(j for n in shell for j in self.neighbors(n)) - region
+            region |= shell
+        return region
+
+    def renumber(self):
+        """Label the atoms 1..N, in their current order, after atoms were
+        removed. The distance matrix and the rings are updated.
+
+        returns a dictionary old label -> new label
+        """
+        old = sorted(self.nodes())
+        relabel = {n: i+1 for i, n in enumerate(old)}
+        rows = [self.node[n]['index']-1 for n in old]
+        if self.distance_matrix is not None:
+            self.distance_matrix = self.distance_matrix[np.ix_(rows, rows)]
+        if self.coordinates is not None:
+            self.coordinates = self.coordinates[rows]
+        for n in old:
+            data = self.node[n]
+            data['rings'] = [[relabel[a] for a in ring] for ring in data['rings']
+                             if all(a in relabel for a in ring)]
+        if any(relabel[n] != n for n in old):
+            self.reorder_labels(relabel)
+        return relabel
+
+    def _delete_atoms(self, nodes, radius):
+        """Remove atoms without updating the topology.
+
+        returns the atoms which were bonded to the removed ones and the
+        atoms whose typing can change, with the new labels.
+        """
+        nodes = set(nodes)
+        region = self.neighbourhood(nodes, radius) - nodes
+        seeds = set()
+        for n in nodes:
+            for j in self.neighbors(n):
+                self.sorted_edge_dict.pop((n, j), None)
+                self.sorted_edge_dict.pop((j, n), None)
+                seeds.add(j)
+        seeds -= nodes
+        self.remove_nodes_from(nodes)
+        # terms with the removed atoms are stored on the seeds and their bonds
+        for n in seeds:
+            self.node[n].pop('angles', None)
+            self.node[n].pop('impropers', None)
+        for n1, n2, data in self.edges_touching(seeds):
+            data.pop('dihedrals', None)
+        relabel = self.renumber()
+        return set(relabel[n] for n in seeds), set(relabel[n] for n in region)
+
+    def _insert_atoms(self, elements, coordinates, charges=None, scale_factor=0.9):
+        """Add atoms at the cartesian coordinates and bond them to the
+        structure, without updating the topology.
+
+        returns the new atoms and the atoms bonded to them.
+        """
+        new = []
+        for i, (element, xyz) in enumerate(zip(elements, coordinates)):
+            kwargs = {'_atom_site_type_symbol': element,
+                      '_atom_site_label': "%s%i"%(element, self.number_of_nodes()+1)}
+            if charges is not None:
+                kwargs['_atom_site_charge'] = charges[i]
+            self.add_atomic_node(**kwargs)
+            node = self.number_of_nodes()
+            self.node[node]['cartesian_coordinates'] = np.array(xyz, dtype=np.float64)
+            new.append(node)
+
+        # distances from the new atoms to all others.
+        nnew, natoms = len(new), self.number_of_nodes()
+        coords = self.node_coordinates(range(1, natoms+1))
+        vects = self.min_img_vectors((coords[None, :, :] - coords[-nnew:, None, :]).reshape(-1, 3))
+        dists = np.linalg.norm(vects, axis=1).reshape(nnew, natoms)
+        matrix = np.zeros((natoms, natoms))
+        if self.distance_matrix is not None:
+            matrix[:natoms-nnew, :natoms-nnew] = self.distance_matrix
+        matrix[-nnew:, :] = dists
+        matrix[:, -nnew:] = dists.T
+        self.distance_matrix = matrix
+        self.coordinates = coords
+
+        # the smallest scale factor used in _bond_if_close is 0.67
+        max_radius = max(COVALENT_RADII[self.node[n]['element']] for n in self.nodes())
+        for n in new:
+            rad = COVALENT_RADII[self.node[n]['element']] + max_radius
+            for m in np.nonzero(self.distance_matrix[n-1, :n-1]*0.67 < rad)[0]:
+                self._bond_if_close(int(m)+1, n, self.cell, scale_factor)
+        seeds = set(new)
+        for n in new:
+            seeds.update(self.neighbors(n))
+        return new, seeds
+
+    def update_topology(self, seeds, region):
+        """Recompute the topology after the bonding of the atoms in seeds
+        has changed. The rings, hybridization and bond orders are
+        computed again for the atoms in region, and the angles,
+        dihedrals and impropers around the seeds.
+
+        """
+        self.compute_init_typing(nodes=sorted(region))
+        self.compute_bond_typing(nodes=region)
+        for n in seeds:
+            self.node[n].pop('angles', None)
+            self.node[n].pop('impropers', None)
+        for n1, n2, data in self.edges_touching(seeds):
+            data.pop('dihedrals', None)
+        self.compute_angles(nodes=sorted(seeds))
+        self.compute_dihedrals(nodes=seeds)
+        self.compute_improper_dihedrals(nodes=sorted(seeds))
+
+    @profiled
+    def remove_atoms(self, nodes, radius=EDIT_RADIUS):
+        """Remove atoms, eg. to create a missing linker defect. The
+        remaining atoms are numbered 1..N in their previous order.
+
+        returns the atoms (new labels) whose typing was recomputed.
+        """
+        seeds, region = self._delete_atoms(nodes, radius)
+        self.update_topology(seeds, region)
+        return region
+
+    @profiled
+    def add_fragment(self, elements, coordinates, charges=None, radius=EDIT_RADIUS):
+        """Add atoms with the elements and cartesian coordinates given,
+        eg. a functional group or a guest. Bonds are computed between
+        the new atoms and to the rest of the structure. The new atoms
+        are numbered after the existing ones.
+
+        returns the atoms whose typing was recomputed.
+        """
+        new, seeds = self._insert_atoms(elements, coordinates, charges)
+        region = self.neighbourhood(seeds, radius)
+        self.update_topology(seeds, region)
+        return region
+
+    @profiled
+    def substitute_group(self, nodes, elements, coordinates, charges=None, radius=EDIT_RADIUS):
+        """Replace the atoms in nodes by a fragment, eg. H by CH3. The
+        labels change as in remove_atoms and add_fragment.
+
+        returns the atoms whose typing was recomputed.
+        """
+        seeds, region = self._delete_atoms(nodes, radius)
+        new, new_seeds = self._insert_atoms(elements, coordinates, charges)
+        region |= self.neighbourhood(new_seeds, radius)
+        self.update_topology(seeds | new_seeds, region)
+        return region
+
+    def local_graph(self, nodes):
+        """A graph of the atoms in nodes and the bonds between them,
+        with copies of their data, to assign a force field to part of
+        a structure.
+
+        """
+        graph = self.__class__(name=self.name)
+        graph.cell = self.cell
+        graph.distance_matrix = self.distance_matrix
+        graph.coordinates = self.coordinates
+        graph.molecule_id = self.molecule_id
+        graph.add_nodes_from((n, _overlay_copy(self.node[n])) for n in sorted(nodes))
+        for n1, n2, data in self.edges_between(nodes):
+            graph.sorted_edge_dict.update({(n1, n2): (n1, n2), (n2, n1): (n1, n2)})
+            graph.add_edge(n1, n2, **_overlay_copy(data))
+        return graph
+
     def sorted_node_list(self):
         return [n[1] for n in sorted([(data['index'], node) for node, data in self.nodes_iter2(data=True)])]
 
@@ -1000,28 +1492,12 @@ class MolecularGraph(nx.Graph):
         imgcell = ocell % maxcell
         if redefine is None:
             return cells.index(tuple([tuple([i]) for i in imgcell]))
-
-        olde_imgcell = imgcell
-        newcell = cell + np.dot(cell, redefine)%maxcell
-        newocell = (newcell + translation) #% maxcell
-        rd2 = redefine - np.identity(3)*maxcell
-        # check if the newcell translation spans a periodic boundary
-        if (np.any(newocell >= maxcell, axis=0)) or (np.any(newocell < 0.)):
-
-            # get indices of where the newocell is spanning a pbc
-            indexes = np.where(newocell - maxcell >= 0)[0].tolist() + np.where(newocell < 0)[0].tolist()
-
-            # determine if the translation spans a lattice vector which is a linear combination
-            # of the other vectors, in which case, make a correction in the image cell
-            # this is checked by finding which lattice indices are spanning the cell, then
-            # checking if these vectors are a linear combination of the other ones by
-            # summing the columns together.
-            # this ONLY works if b and c are lin combs of a and a is the unit vector
-            newrd = np.sum(rd2[indexes], axis=0)%maxcell
-            #newrd = np.dot(newocell, redefine)%maxcell
-            if np.any(newrd != 0):
-                imgcell = (newocell - np.dot(newocell, redefine)) % maxcell
-
+        # redefine is lower triangular, the replicas are the distinct
+        # images modulo the supercell vectors.
+        imgcell = np.around(ocell).astype(int)
+        for i in (2, 1, 0):
+            row = np.around(redefine[i]).astype(int)
+            imgcell -= (imgcell[i]//row[i])*row
         return cells.index(tuple([tuple([i]) for i in imgcell]))
 
     def update_symflag(self, cell, symflag, mincell, maxcell):
@@ -1064,16 +1540,23 @@ class MolecularGraph(nx.Graph):
                 match = True
             if match:
                 cg.add_node((i,j))
-        # add edges to cg
-        for (a1, b1), (a2, b2) in itertools.combinations(cg.nodes(), 2):
-            if (a1 != a2) and (b1 != b2):
-                da = self.distance_matrix[a1-1, a2-1]
-                db = graph.distance_matrix[b1-1, b2-1]
-                if np.allclose(da, db, atol=tol):
-                    cg.add_edge((a1,b1), (a2,b2))
+        # add edges to cg, between pairs with the same distance in both
+        # graphs (np.allclose, for all pairs at once).
+        nodes = list(cg.nodes())
+        if not nodes:
+            return cg
+        a = np.array([n[0] for n in nodes])
+        b = np.array([n[1] for n in nodes])
+        da = self.distance_matrix[np.ix_(a-1, a-1)]
+        db = graph.distance_matrix[np.ix_(b-1, b-1)]
+        match = (np.abs(da - db) <= tol + 1e-5*np.abs(db)) & \
+                (a[:, None] != a[None, :]) & (b[:, None] != b[None, :])
+        for i, j in zip(*np.nonzero(np.triu(match, 1))):
+            cg.add_edge(nodes[i], nodes[j])
         return cg
 
-    def detect_clusters(self, num_neighbors, tol, type='Inorganic', general_metal=False):
+    @profiled
+    def detect_clusters(self, num_neighbors, tol, type='Inorganic', general_metal=False, skip_found=False):
         """Detect clusters such as the copper paddlewheel using
         maximum clique detection. This will assign specific atoms
         with a special flag for use when building their force field.
@@ -1083,6 +1566,9 @@ class MolecularGraph(nx.Graph):
         so long as it is a metal, it will be paired with other metals.
         This may increase the time for SBU recognition.
 
+        setting skip_found to True will not start a search from atoms of
+        a cluster already found, so each cluster is found about once.
+
         """
         print("Detecting %s clusters"%type)
 
@@ -1106,6 +1592,7 @@ class MolecularGraph(nx.Graph):
                 reference_nodes.append(node)
 
         no_cluster = []
+        found = set()
         #FIXME(pboyd): This routine doesn't work for finding 1-D rod SBUs.
         # At each step the atoms found that belong to an SBU are deleted
         # to improve the search efficiency. In 1-D rod SBUs there are
@@ -1116,6 +1603,8 @@ class MolecularGraph(nx.Graph):
         for node in reference_nodes:
         #while reference_nodes:
             #node = reference_nodes.pop()
+            if node in found:
+                continue
             data = self.node[node]
             possible_clusters = {}
             toln = tol
@@ -1160,7 +1649,14 @@ class MolecularGraph(nx.Graph):
                             cluster_found = True
                             print("Found %s"%(name))
                             store_sbus.setdefault(name, []).append([i for (i,j) in clique])
+                            if skip_found:
+                                # the other cliques map the same atoms
+                                # by the symmetry of the cluster.
+                                found.update([i for (i,j) in clique])
+                                break
                             #break
+                    if cluster_found and skip_found:
+                        break
 
                     #if(cluster_found):
                     #    for n in neighbour_nodes:
@@ -1180,21 +1676,27 @@ class MolecularGraph(nx.Graph):
         for j in set(no_cluster):
             print ("No recognizable %s clusters for %i elements %s"%(type.lower(), no_cluster.count(j),  j))
 
-    def redefine_lattice(self, redefinition, lattice):
+    @profiled
+    def redefine_lattice(self, redefinition, lattice, max_volume_change=20):
         """Redefines the lattice based on the old lattice vectors. This was designed to convert
         non-orthogonal cells to orthogonal boxes, but it could in principle be used to
         convert any cell to any other cell. (As long as the redefined lattice
         are integer multiples of the old vectors)
 
+        Cells larger than max_volume_change times the unit cell are refused,
+        unless it is None.
         """
         #print(redefinition)
         #redefinition = np.array([[1., 0., 0.], [ -2., 2.,0.], [ -1., 3., 2.]])
+        # the replicas are built from the lower triangular basis of the same
+        # supercell, which is a whole number of unit cells along each vector.
+        basis = np.array(np.around(redefinition), dtype=int)
+        redefinition = _lower_triangular(basis)
         # determine how many replicas of the atoms is necessary to produce the supercell.
         vol_change = np.prod(np.diag(redefinition))
-        if vol_change > 20:
-            print("ERROR: The volume change is %i times greater than the unit cell. "%(vol_change) +
-                    "I cannot process structures of this size!")
-            sys.exit()
+        if max_volume_change is not None and vol_change > max_volume_change:
+            raise StructureError("ERROR: The volume change is %i times greater than the unit cell. "%(vol_change) +
+                                   "I cannot process structures of this size!")
 
         print("The redefined cell will be %i times larger than the original."%(int(vol_change)))
 
@@ -1203,11 +1705,14 @@ class MolecularGraph(nx.Graph):
         self.build_supercell(sc, lattice, redefine=redefinition)
         # re-define the cell
         old_cell = np.multiply(self.cell._cell.T, sc).T
-        self.cell.set_cell(np.dot(redefinition, self.cell._cell))
-        # the node cartesian_coordinates must be shifted by the periodic boundaries.
+        new_cell = np.dot(basis, self.cell._cell)
+        inverse = np.linalg.inv(new_cell.T)
+        self.cell.set_cell(new_cell)
+        # the node cartesian_coordinates must be shifted by the periodic boundaries,
+        # and follow the cell if it was rotated to the lammps orientation.
         for node, data in self.nodes_iter2(data=True):
-            coord = data['cartesian_coordinates']
-            data['cartesian_coordinates'] = self.in_cell(coord)
+            fractional = np.dot(inverse, data['cartesian_coordinates']) % 1
+            data['cartesian_coordinates'] = np.dot(fractional, self.cell.cell)
 
         # the bonds which span a periodic boundary will change
         for n1, n2, data in self.edges_iter2(data=True):
@@ -1231,7 +1736,30 @@ class MolecularGraph(nx.Graph):
         gg.remove_nodes_from(delete_nodes)
         return gg
 
+    def overlay(self):
+        """Return a copy of the graph on which force fields can be assigned
+        independently of this one.
+
+        The containers (dicts, lists, sets) of the node, edge and graph
+        attributes are copied, as are the coordinates of each node, since
+        these are modified in place by the force fields and the supercell
+        construction. Everything else is shared, notably the distance
+        matrix and the immutable data computed during the topology
+        perception, which makes this much cheaper than a deepcopy.
 
+        """
+        graph = self.__class__(name=self.name)
+        for key, value in self.__dict__.items():
+            if key not in graph.__dict__ or key in _NX_GRAPH_ATTRIBUTES:
+                continue
+            setattr(graph, key, _overlay_copy(value, copy_arrays=False))
+        graph.graph = _overlay_copy(self.graph)
+        graph.add_nodes_from((n, _overlay_copy(data)) for n, data in self.nodes(data=True))
+        graph.add_edges_from((n1, n2, _overlay_copy(data)) for n1, n2, data in self.edges(data=True))
+        return graph
+
+
+    @profiled
     def build_supercell(self, sc, lattice, track_molecule=False, molecule_len=0, redefine=None):
         """Construct a graph with nodes supporting the size of the
         supercell (sc)
@@ -1277,7 +1805,7 @@ class MolecularGraph(nx.Graph):
             for i in range(1, totatomlen+1):
                 graph_image.node[unit_node_ids[i-1]+offset]['image'] = unit_node_ids[i-1]
             if track_molecule:
-                self.molecule_images.append(graph_image.nodes())
+                self.molecule_images.append(list(graph_image.nodes()))
                 graph_image.molecule_id = orig_copy.molecule_id + mol_offset
             # update cartesian coordinates for each node in the image
             for node in graph_image.nodes():
@@ -1527,35 +2055,59 @@ class MolecularGraph(nx.Graph):
 def del_parenth(string):
     return re.sub(r'\([^)]*\)', '' , string)
 
-def from_CIF(cifname):
+def from_CIF(cifname, name=None):
     """Reads the structure data from the CIF
     - currently does not read the symmetry of the cell
     - does not unpack the assymetric unit (assumes P1)
     - assumes that the appropriate keys are in the cifobj (no error checking)
+
+    cifname can also be an open file-like object, in which case the name
+    of the structure is taken from 'name', or the name of the stream.
     """
 
     cifobj = CIF()
     cifobj.read(cifname)
 
+    if name is None:
+        if not hasattr(cifname, 'readlines'):
+            name = clean(cifname)
+        elif isinstance(getattr(cifname, 'name', None), str):
+            name = clean(cifname.name)
+        else:
+            name = cifobj.name
     data = cifobj._data
     # obtain atoms and cell
     cell = Cell()
     # add data to molecular graph (to be parsed later..)
-    mg = MolecularGraph(name=clean(cifname))
-    cellparams = [float(del_parenth(i)) for i in [data['_cell_length_a'],
-                                     data['_cell_length_b'],
-                                     data['_cell_length_c'],
-                                     data['_cell_angle_alpha'],
-                                     data['_cell_angle_beta'],
-                                     data['_cell_angle_gamma']]]
+    mg = MolecularGraph(name=name)
+    cell_keys = ['_cell_length_a', '_cell_length_b', '_cell_length_c',
+                 '_cell_angle_alpha', '_cell_angle_beta', '_cell_angle_gamma']
+    try:
+        cellparams = [float(del_parenth(data[i])) for i in cell_keys]
+    except KeyError as e:
+        raise StructureError("ERROR: the cell parameter %s is missing from the cif file %s."%(e.args[0], name))
+    except ValueError as e:
+        raise StructureError("ERROR: could not read the cell parameters of the cif file %s: %s"%(name, e))
     cell.set_params(cellparams)
 
     #add atom nodes
-    id = cifobj.block_order.index('atoms')
-    atheads = cifobj._headings[id]
+    try:
+        id = cifobj.block_order.index('atoms')
+        atheads = cifobj._headings[id]
+    except (ValueError, KeyError):
+        raise StructureError("ERROR: no atom sites were found in the cif file %s."%(name))
+    coord_keys = [['_atom_site_x', '_atom_site_y', '_atom_site_z'],
+                  ['_atom_site_fract_x', '_atom_site_fract_y', '_atom_site_fract_z']]
+    if not any(all(i in atheads for i in keys) for keys in coord_keys):
+        raise StructureError("ERROR: the atom sites of the cif file %s have no "%(name)+
+                             "'_atom_site_fract_x/y/z' or '_atom_site_x/y/z' coordinates.")
     for atom_data in zip(*[data[i] for i in atheads]):
         kwargs = {a:j.strip() for a, j in zip(atheads, atom_data)}
-        mg.add_atomic_node(**kwargs)
+        try:
+            mg.add_atomic_node(**kwargs)
+        except (KeyError, ValueError):
+            element = kwargs.get('_atom_site_type_symbol', kwargs.get('_atom_site_label'))
+            raise StructureError("ERROR: unknown element %s in the atom sites of the cif file %s."%(element, name))
 
     # add bond edges, if they exist
     try:
@@ -1941,8 +2493,7 @@ def write_RASPA_sim_files(lammps_sim,classifier=0):
             MOF_FF_MIXING.append([type_spec_, potential_, eps_, sig_])
 
     if(len(MOF_PSEUDO_ATOMS) == 0):
-        print("Error! No MOF atoms found. Exiting...")
-        sys.exit()
+        raise StructureError("Error! No MOF atoms found. Exiting...")
 
     # Determine final column widths
     col_widths = [0 for i in range(len(MOF_PSEUDO_ATOMS[0]))]
@@ -2107,6 +2658,98 @@ class MDMC_config(object):
         return
 
 
+def _factorizations(n):
+    """All (n1, n2, n3) with n1*n2*n3 = n."""
+    return [(i, j, n//(i*j)) for i in range(1, n+1) if n % i == 0
+            for j in range(1, n//i+1) if (n//i) % j == 0]
+
+
+def _hermite_normal_forms(n):
+    """The lower triangular integer matrices in Hermite normal form with
+    determinant n, one for each sublattice with n times the volume.
+
+    """
+    matrices = []
+    for n1, n2, n3 in _factorizations(n):
+        for m21, m31, m32 in itertools.product(range(n1), range(n1), range(n2)):
+            matrices.append([[n1, 0, 0], [m21, n2, 0], [m31, m32, n3]])
+    return np.array(matrices, dtype=int)
+
+
+def _lower_triangular(matrix):
+    """Integer row operations bringing the rows of matrix to a lower
+    triangular basis, with a positive diagonal, of the same lattice.
+
+    """
+    m = np.array(np.around(matrix), dtype=int)
+    for col in (2, 1):
+        # euclid on this column, among the rows not yet fixed
+        while True:
+            nonzero = [i for i in range(col+1) if m[i, col] != 0]
+            if len(nonzero) <= 1:
+                break
+            pivot = min(nonzero, key=lambda i: abs(m[i, col]))
+            for i in nonzero:
+                if i != pivot:
+                    m[i] -= (m[i, col]//m[pivot, col])*m[pivot]
+        if nonzero:
+            m[[nonzero[0], col]] = m[[col, nonzero[0]]]
+    for i in range(3):
+        if m[i, i] < 0:
+            m[i] = -m[i]
+    return m
+
+
+def _reduced_bases(matrices, cell, sweeps=20):
+    """Bases of the sublattices matrices . cell with the largest
+    perpendicular widths, found by pairwise reduction of the reciprocal
+    vectors (the widths are their inverse lengths).
+
+    returns the integer matrices of the new bases
+    """
+    dual = np.linalg.inv(np.einsum('kij,jl->kil', matrices, cell)).transpose(0, 2, 1)
+    for sweep in range(sweeps):
+        changed = False
+        for i, j in itertools.permutations(range(3), 2):
+            mu = np.around(np.einsum('ki,ki->k', dual[:, i], dual[:, j]) /
+                           np.einsum('ki,ki->k', dual[:, j], dual[:, j]))
+            if np.any(mu != 0):
+                dual[:, i] -= mu[:, None]*dual[:, j]
+                changed = True
+        if not changed:
+            break
+    bases = np.einsum('kij,jl->kil', np.linalg.inv(dual).transpose(0, 2, 1), np.linalg.inv(cell))
+    bases = np.array(np.around(bases), dtype=int)
+    # keep the bases right handed
+    bases[np.linalg.det(bases) < 0, 0] *= -1
+    return bases
+
+
+def _perpendicular_widths(cells):
+    """Perpendicular widths of an array of cells, shape (k, 3, 3) with
+    the cell vectors as rows.
+
+    """
+    a, b, c = cells[:, 0], cells[:, 1], cells[:, 2]
+    volume = np.abs(np.einsum('ki,ki->k', a, np.cross(b, c)))
+    areas = np.stack([np.linalg.norm(np.cross(b, c), axis=1),
+                      np.linalg.norm(np.cross(c, a), axis=1),
+                      np.linalg.norm(np.cross(a, b), axis=1)], axis=1)
+    return volume[:, None]/areas
+
+
+def _max_angle_deviation(cells):
+    """Largest deviation of the cell angles from 90 degrees, for an
+    array of cells.
+
+    """
+    norms = np.linalg.norm(cells, axis=2)
+    cosines = [np.einsum('ki,ki->k', cells[:, i], cells[:, j])/(norms[:, i]*norms[:, j])
+               for i, j in ((1, 2), (0, 2), (0, 1))]
+    angles = np.degrees(np.arccos(np.clip(cosines, -1., 1.)))
+    return np.max(np.abs(angles - 90.), axis=0)
+
+
 class Cell(object):
     def __init__(self):
         self._cell = np.identity(3, dtype=np.float64)
@@ -2195,6 +2838,38 @@ class Cell(object):
         ##print(np.ceil(cutoff/diag*2.))
         #return tuple(int(i) for i in np.ceil(cutoff/diag*2.))
 
+    def minimum_supercell_matrix(self, cutoff, angle_tolerance=None, max_multiple=None):
+        """Search the integer matrices M, whose rows are the supercell
+        vectors in units of the unit cell vectors, for the supercell with
+        the fewest unit cells which supports a half-cell width cutoff.
+
+        Every sublattice with the same number of unit cells is tried,
+        with the basis of largest perpendicular widths that a pairwise
+        reduction finds, and the one with the largest shortest width is
+        kept. If angle_tolerance is given, the supercell angles must be
+        within this many degrees of 90. The supercell can be built with
+        MolecularGraph.redefine_lattice.
+
+        returns M, or None if there is no supercell of at most
+        max_multiple unit cells (default, the size of minimum_supercell).
+        """
+        if max_multiple is None:
+            max_multiple = int(np.prod(self.minimum_supercell(cutoff)))
+        # the product of the perpendicular widths is at most the volume.
+        multiple = max(1, int(math.floor((2.*cutoff)**3/self.volume)))
+        while multiple <= max_multiple:
+            matrices = _reduced_bases(_hermite_normal_forms(multiple), self.cell)
+            cells = np.einsum('kij,jl->kil', matrices, self.cell)
+            widths = _perpendicular_widths(cells)
+            allowed = np.all(widths >= 2.*cutoff - 1e-8, axis=1)
+            if angle_tolerance is not None:
+                allowed &= _max_angle_deviation(cells) <= angle_tolerance
+            if np.any(allowed):
+                shortest = np.where(allowed, widths.min(axis=1), 0.)
+                return matrices[int(np.argmax(shortest))]
+            multiple += 1
+        return None
+
     def orthogonal_transformation(self):
         """Compute the transformation from the original unit cell to a supercell which
         has 90 degree angles between it's basis vectors. This is somewhat approximate,
@@ -0,0 +1,86 @@
+"""
+On-disk cache of tabulated pair potentials.
+"""
+import os
+import hashlib
+import tempfile
+
+# part of every key, increase it when the tables generated change so
+# that the entries cached before are not used.
+TABLE_VERSION = 1
+
+
+def default_cache_dir():
+    """The cache is stored in $LAMMPS_INTERFACE_CACHE if it is set,
+    otherwise in ~/.cache/lammps_interface/tables
+
+    """
+    try:
+        return os.environ['LAMMPS_INTERFACE_CACHE']
+    except KeyError:
+        return os.path.join(os.path.expanduser('~'), '.cache', 'lammps_interface', 'tables')
+
+
+class TableCache(object):
+    """Table entries (the text written to the LAMMPS table file) stored
+    under a hash of the parameters which generated them.
+
+    The keys are tuples of the parameters, hashed with TABLE_VERSION.
+    Floats are hashed with repr so that they must be identical to be
+    reused. Entries are written to a temporary file and renamed, so
+    several processes may share a cache directory. A cache which cannot
+    be read or written is silently bypassed.
+    """
+
+    def __init__(self, directory=None):
+        if directory is None:
+            directory = default_cache_dir()
+        self.directory = directory
+
+    def path(self, key):
+        digest = hashlib.sha1(repr((TABLE_VERSION,) + tuple(key)).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, "%s.table"%(digest))
+
+    def get(self, key):
+        """Return the cached entry for key, or None."""
+        try:
+            with open(self.path(key), 'r') as f:
+                return f.read()
+        except (IOError, OSError):
+            return None
+
+    def put(self, key, entry):
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except (IOError, OSError):
+            return
+        renamed = False
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(entry)
+            os.rename(tmp, self.path(key))
+            renamed = True
+        except (IOError, OSError):
+            pass
+        finally:
+            # do not leave partial entries behind
+            if not renamed:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+
+def table_cache(directory=None):
+    """The cache of the --table-cache option: the default directory
+    if directory is None, no cache (None) if it is 'none'.
+
+    """
+    if directory is not None and directory.lower() == 'none':
+        return None
+    return TableCache(directory)
+
+
+TABLE_CACHE = TableCache()
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+"""
+Work queue on a shared filesystem, for screening many structures with
+workers on several nodes without a server.
+
+    python -m lammps_interface.workqueue init queue/ structures/ -- -ff UFF4MOF --minimize
+    python -m lammps_interface.workqueue work queue/ -j 8 --timeout 600   # on every node
+    python -m lammps_interface.workqueue status queue/
+
+The queue is a directory of json task files, one per structure, which
+move between the sub directories todo/, claimed/, done/ and failed/.
+A worker claims a task by renaming it from todo/ to claimed/, which
+only one worker can succeed at, so no locks or coordinator are needed.
+While a structure runs, the worker touches the claimed file as a
+heartbeat. Claims without a heartbeat for longer than the stale time
+(eg. the node died) are moved back to todo/ by any worker, up to
+max_attempts times; if the slow worker completes the structure after
+all, the requeued task is dropped. Each structure is run as in batch mode, in
+queue/runs/<name>.
+
+Times are compared to the modification time of a file the worker has
+just touched, so the clocks of the nodes need not agree.
+"""
+from argparse import ArgumentParser
+from multiprocessing import Process
+import json
+import os
+import random
+import socket
+import sys
+import time
+
+from .batch import BATCH_POLICY, find_structures, _worker, _collect, _directory_name
+
+STATES = ('todo', 'claimed', 'done', 'failed')
+
+
+def _write_json(filename, obj):
+    """Write atomically, so readers on other nodes never see a partial file."""
+    tmp = "%s.%s.%i.tmp"%(filename, socket.gethostname(), os.getpid())
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.rename(tmp, filename)
+
+
+def _read_json(filename):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+
+class WorkQueue(object):
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.settings = _read_json(os.path.join(self.directory, "queue.json")) or {}
+
+    def path(self, state, name=None):
+        if name is None:
+            return os.path.join(self.directory, state)
+        return os.path.join(self.directory, state, name + ".json")
+
+    def create(self, cif_files, args=()):
+        """Add the cif files to the queue, lammps_interface is run with
+        the command line arguments args.
+
+        """
+        for state in STATES + ('runs', 'workers'):
+            if not os.path.isdir(self.path(state)):
+                os.makedirs(self.path(state))
+        self.settings = {'args': list(args)}
+        _write_json(os.path.join(self.directory, "queue.json"), self.settings)
+        used = set(self.tasks())
+        for cif in cif_files:
+            name = _directory_name(cif, used)
+            _write_json(self.path('todo', name), {'name': name, 'cif_file': cif,
+                                                  'attempts': 0, 'worker': None})
+        return len(used)
+
+    def tasks(self, state=None):
+        """Names of the tasks, in one state or all of them."""
+        names = []
+        for s in ([state] if state else STATES):
+            names += [f[:-5] for f in os.listdir(self.path(s)) if f.endswith(".json")]
+        return names
+
+    def counts(self):
+        return {state: len(self.tasks(state)) for state in STATES}
+
+    def now(self, worker):
+        """Touch the file of this worker and return its modification
+        time, the current time as seen by the filesystem.
+
+        """
+        filename = os.path.join(self.path('workers'), worker)
+        with open(filename, 'a'):
+            os.utime(filename, None)
+        return os.stat(filename).st_mtime
+
+    def claim(self, worker):
+        """Claim a task for worker. returns the task or None if there
+        is nothing left to do.
+
+        """
+        names = self.tasks('todo')
+        # workers starting at the same time shouldn't all compete for
+        # the first task.
+        random.shuffle(names)
+        done = set(self.tasks('done'))
+        for name in names:
+            if name in done:
+                # completed by a slow worker after it was requeued
+                try:
+                    os.remove(self.path('todo', name))
+                except OSError:
+                    pass
+                continue
+            try:
+                # touched first, the rename keeps the modification time
+                # so the claim is not stale when it arrives in claimed/
+                os.utime(self.path('todo', name), None)
+                os.rename(self.path('todo', name), self.path('claimed', name))
+            except OSError:
+                # claimed by another worker
+                continue
+            task = _read_json(self.path('claimed', name))
+            if task is None:
+                task = {'name': name, 'attempts': 0}
+            task['attempts'] += 1
+            task['worker'] = worker
+            _write_json(self.path('claimed', name), task)
+            return task
+        return None
+
+    def heartbeat(self, task):
+        try:
+            os.utime(self.path('claimed', task['name']), None)
+        except OSError:
+            # the claim was requeued by another worker
+            pass
+
+    def complete(self, task, record):
+        """Store the result record of a task in done/ or failed/ and
+        release the claim.
+
+        """
+        name = task['name']
+        state = 'done' if record['status'] == 'ok' else 'failed'
+        task.update(record)
+        _write_json(self.path(state, name), task)
+        stale = [self.path('todo', name)]
+        claim = _read_json(self.path('claimed', name))
+        if claim is not None and claim.get('worker') == task['worker']:
+            stale.append(self.path('claimed', name))
+        # a slow worker's claim may have been requeued, or abandoned, in
+        # the meantime
+        if state == 'done':
+            failed = _read_json(self.path('failed', name))
+            if failed is not None and failed.get('status') == 'abandoned':
+                stale.append(self.path('failed', name))
+        for filename in stale:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+
+    def requeue_stale(self, worker, stale, max_attempts=3):
+        """Move claims without a heartbeat in the last 'stale' seconds
+        back to todo/, or to failed/ after max_attempts attempts.
+
+        returns the names of the requeued tasks
+        """
+        now = self.now(worker)
+        requeued = []
+        for name in self.tasks('claimed'):
+            filename = self.path('claimed', name)
+            try:
+                if now - os.stat(filename).st_mtime < stale:
+                    continue
+            except OSError:
+                continue
+            task = _read_json(filename) or {'name': name, 'attempts': max_attempts}
+            if task['attempts'] >= max_attempts:
+                task.update({'status': 'abandoned',
+                             'error': "no heartbeat from %s after %i attempts"%(task.get('worker'),
+                                                                               task['attempts'])})
+                target = self.path('failed', name)
+            else:
+                target = self.path('todo', name)
+            try:
+                os.rename(filename, target)
+            except OSError:
+                # another worker requeued it first
+                continue
+            if target == self.path('failed', name):
+                _write_json(target, task)
+            else:
+                requeued.append(name)
+        return requeued
+
+
+def work(queue_dir, jobs=1, timeout=None, memory=None, stale=300., heartbeat=30.,
+         max_attempts=3, wait=True):
+    """Claim and run tasks from the queue, up to 'jobs' at the same time,
+    until there are none left. If wait is True, the worker also waits
+    for the claims of other workers to complete, so that it can pick up
+    the stale ones.
+
+    returns the number of structures run by this worker.
+    """
+    queue = WorkQueue(queue_dir)
+    args = BATCH_POLICY + list(queue.settings.get('args', []))
+    worker = "%s.%i"%(socket.gethostname(), os.getpid())
+    running = []
+    nrun = 0
+    last_check = 0.
+    while True:
+        if time.time() - last_check > heartbeat:
+            for task, process, start in running:
+                queue.heartbeat(task)
+            for name in queue.requeue_stale(worker, stale, max_attempts):
+                print("requeued  %s"%(name))
+            last_check = time.time()
+
+        while len(running) < jobs:
+            task = queue.claim(worker)
+            if task is None:
+                break
+            wd = os.path.join(queue.path('runs'), task['name'])
+            if not os.path.isdir(wd):
+                os.makedirs(wd)
+            if os.path.isfile(os.path.join(wd, "result.json")):
+                os.remove(os.path.join(wd, "result.json"))
+            task['directory'] = wd
+            process = Process(target=_worker, args=(task['cif_file'], wd, args, memory))
+            process.start()
+            running.append((task, process, time.time()))
+
+        still_running = []
+        for task, process, start in running:
+            elapsed = time.time() - start
+            record = {'status': None, 'error': None}
+            if not process.is_alive():
+                process.join()
+                _collect(record, process, task['directory'])
+            elif timeout is not None and elapsed > timeout:
+                process.terminate()
+                process.join()
+                record['status'] = 'timeout'
+                record['error'] = "exceeded %.1f seconds"%(timeout)
+            else:
+                still_running.append((task, process, start))
+                continue
+            record['wall_time'] = elapsed
+            queue.complete(task, record)
+            nrun += 1
+            print("%-10s %s (%.1f s)"%(record['status'], task['name'], elapsed))
+        running = still_running
+
+        if not running and not queue.tasks('todo'):
+            if not wait or not queue.tasks('claimed'):
+                break
+            time.sleep(min(heartbeat, stale/10.))
+        else:
+            time.sleep(0.05)
+    return nrun
+
+
+def main(argv=None):
+    parser = ArgumentParser(description="Work queue on a shared filesystem",
+                            prog="lammps_interface.workqueue")
+    commands = parser.add_subparsers(dest="command")
+    init = commands.add_parser("init", help="Create a queue of structures. Options "+
+                                            "for lammps_interface are given after a '--'.")
+    init.add_argument("queue", help="queue directory.")
+    init.add_argument("inputs", nargs="+",
+                      help="directories, glob patterns, cif files or manifest "+
+                           "files (one cif path per line, or a json list).")
+    run = commands.add_parser("work", help="Run structures from the queue.")
+    run.add_argument("queue", help="queue directory.")
+    run.add_argument("-j", "--jobs", type=int, default=1,
+                     help="Number of structures to process at the same time. Default is 1.")
+    run.add_argument("--timeout", type=float, default=None,
+                     help="Wall time in seconds allowed for each structure.")
+    run.add_argument("--memory", type=float, default=None,
+                     help="Memory limit in MB for each structure.")
+    run.add_argument("--stale", type=float, default=300.,
+                     help="Seconds without a heartbeat after which a claim is "+
+                          "requeued. Default is 300.")
+    run.add_argument("--heartbeat", type=float, default=30.,
+                     help="Seconds between heartbeats. Default is 30.")
+    run.add_argument("--max-attempts", type=int, default=3, dest="max_attempts",
+                     help="Number of times a structure is claimed before it is "+
+                          "abandoned. Default is 3.")
+    run.add_argument("--no-wait", action="store_false", dest="wait",
+                     help="Exit when there is nothing left to claim, instead of "+
+                          "waiting for the claims of other workers.")
+    status = commands.add_parser("status", help="Number of structures in each state.")
+    status.add_argument("queue", help="queue directory.")
+
+    if argv is None:
+        argv = sys.argv[1:]
+    # everything after '--' is passed on to lammps_interface
+    lammps_args = []
+    if '--' in argv:
+        split = argv.index('--')
+        argv, lammps_args = argv[:split], argv[split+1:]
+    args = parser.parse_args(argv)
+
+    if args.command == "init":
+        cifs = find_structures(args.inputs)
+        if not cifs:
+            print("No structures found!")
+            sys.exit(1)
+        ntasks = WorkQueue(args.queue).create(cifs, lammps_args)
+        print("%i structures in the queue %s"%(ntasks, os.path.abspath(args.queue)))
+    elif args.command == "work":
+        if not os.path.isfile(os.path.join(args.queue, "queue.json")):
+            print("%s is not a queue, create it with 'init'"%(args.queue))
+            sys.exit(1)
+        nrun = work(args.queue, jobs=args.jobs, timeout=args.timeout, memory=args.memory,
+                    stale=args.stale, heartbeat=args.heartbeat,
+                    max_attempts=args.max_attempts, wait=args.wait)
+        print("%i structures run by this worker."%(nrun))
+    elif args.command == "status":
+        counts = WorkQueue(args.queue).counts()
+        print(" ".join(["%s: %i"%(state, counts[state]) for state in STATES]))
+    else:
+        parser.print_help()
+
+
+if __name__ == "__main__":
+    main()